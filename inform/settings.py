@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -83,6 +84,94 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+# builder results and job records are kept on disk here, shared by every web worker
+# process on the host (the SQLite database already pins the site to one host)
+BUILDER_CACHE_DIR = os.environ.get("BUILDER_CACHE_DIR", os.path.join(tempfile.gettempdir(), "inform-builder"))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # dashboard cards, one entry per league/season/per-90 variant (LRU-bounded)
+    'cards': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'cards',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 128,
+        },
+    },
+    # rendered dashboard card lists, one entry per CardList of each cached variant
+    'fragments': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'fragments',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1024,
+        },
+    },
+    # team page data, one entry per team/season
+    'teams': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'teams',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 512,
+        },
+    },
+    # builder query results, one entry per canonical query fingerprint
+    'builder': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BUILDER_CACHE_DIR, 'results'),
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 256,
+        },
+    },
+    # builder job records, so any worker process can report on or cancel a job
+    'jobs': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BUILDER_CACHE_DIR, 'jobs'),
+    },
+}
+
+# seconds between reads of the ingest data version (see web/cache.py)
+DATA_VERSION_TTL = 1.0
+
+# deploy name, part of page ETags so browsers revalidate after a deploy; when unset the
+# templates and static files are hashed instead (see web/cache.py)
+RELEASE = os.environ.get("RELEASE", "")
+
+# build every dashboard card variant in each worker at startup (see inform/wsgi.py)
+PRELOAD_CARD_CACHE = os.environ.get("PRELOAD_CARD_CACHE") == "1"
+
+# builder query engine: "orm" runs every query in SQLite, "columnar" evaluates them
+# over in-memory NumPy columns (needs NumPy, falls back to "orm" without it)
+BUILDER_ENGINE = os.environ.get("BUILDER_ENGINE", "orm")
+# seasons with more PlayerStat rows than this are never loaded by the columnar engine
+BUILDER_COLUMNAR_MAX_ROWS = int(os.environ.get("BUILDER_COLUMNAR_MAX_ROWS", "200000"))
+
+# builder queries run on a per-process thread pool (see web/jobs.py), a job that
+# has not finished `BUILDER_JOB_TIMEOUT` seconds after submission is aborted
+BUILDER_JOB_WORKERS = int(os.environ.get("BUILDER_JOB_WORKERS", "2"))
+BUILDER_JOB_TIMEOUT = float(os.environ.get("BUILDER_JOB_TIMEOUT", "30"))
+
+# builder queries estimated (see web/guard.py) above `BUILDER_QUERY_MAX_COST` are
+# rejected, the rest are interrupted after `BUILDER_QUERY_BUDGET` seconds
+BUILDER_QUERY_MAX_COST = float(os.environ.get("BUILDER_QUERY_MAX_COST", "5e6"))
+BUILDER_QUERY_BUDGET = float(os.environ.get("BUILDER_QUERY_BUDGET", "10"))
+# result exports stream in the request thread, checked against the same cost limit and
+# interrupted after `BUILDER_EXPORT_BUDGET` seconds
+BUILDER_EXPORT_BUDGET = float(os.environ.get("BUILDER_EXPORT_BUDGET", "30"))
+
+# "fts" searches names in the SQLite FTS5 index that ingest keeps in sync, "memory"
+# (and "fts" before the index is built) in a per-process prefix index
+SEARCH_ENGINE = os.environ.get("SEARCH_ENGINE", "fts")
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'inform.settings')
 
 application = get_wsgi_application()
+
+# optionally build every dashboard card variant before this worker accepts traffic
+# (enabled with the PRELOAD_CARD_CACHE setting)
+from web.card_data import preload_card_cache
+
+preload_card_cache()
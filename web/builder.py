@@ -1,36 +1,63 @@
-from django.db.models import F, FloatField, IntegerField, QuerySet
-from django.db.models.functions import Cast 
-from copy import deepcopy
-from typing import Callable, Dict, List, Tuple, Union
+from django.conf import settings
+from django.core.cache import caches
+from django.db import OperationalError
+from django.db.models import F, FloatField, IntegerField, Q, QuerySet, Window
+from django.db.models.functions import Cast, PercentRank, Rank
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
+import csv
+from functools import lru_cache
+import hashlib
+import json
+import logging
+import re
+import time
+from typing import Any, Callable, Dict, Iterator, List, Set, Tuple, Union
 
-from .card import BuilderCard, CardList
+from .cache import get_data_version, get_process_memo
+from .card import ENTRY_FIELDS, PERCENTILE_SUFFIX, RANK_SUFFIX, BuilderCard, CardList
+from .guard import QueryBudgetError, QueryCost, check_query_cost, estimate_query_cost, progress_check, run_with_budget
 from .models import Country, Season, League, Team, Player, PlayerStat 
-from .queryset import annotate_queryset, modify_queryset, filter_by_comparison, order_queryset
+from .queryset import comparison_q
 stat_list = [stat[0] for stat in PlayerStat.STATS]
 
 ############################
 #### VALIDATION HELPERS ####
 ############################
 
+# every id a query may reference, loaded once per process and data version
+def load_id_index() -> Dict[str, Set[int]]:
+    return {
+        "seasons": set(Season.objects.values_list("id", flat=True)),
+        "leagues": set(League.objects.values_list("league_id", flat=True)),
+        "teams": set(Team.objects.values_list("id", flat=True)),
+        "countries": set(Country.objects.values_list("id", flat=True)),
+    }
+
+def get_id_index() -> Dict[str, Set[int]]:
+    return get_process_memo("id-index", load_id_index)
+
+def valid_id(id: str, index: str) -> bool:
+    return id.isdecimal() and int(id) in get_id_index()[index]
+
 def valid_team(id: str) -> bool:
-    return id == "" or len(Team.objects.filter(id=int(id))) > 0
+    return id == "" or valid_id(id, "teams")
 
 def valid_league(id: str) -> bool:
-    return id == "" or len(League.objects.filter(league_id=int(id))) > 0
+    return id == "" or valid_id(id, "leagues")
 
 def valid_season(id: str) -> bool:
-    return len(Season.objects.filter(id=int(id))) > 0
+    return valid_id(id, "seasons")
 
 def valid_number(n_str: str) -> bool:
-    if '.' not in n_str: return n_str.isdecimal()
-    split_n_str = n_str.split('.')
-    return split_n_str[0].isdecimal() and split_n_str[1].isdecimal()
+    # plain non-negative decimals like "9" or "0.35", so every accepted value converts with float()
+    return re.fullmatch(r"[0-9]+(\.[0-9]+)?", n_str) is not None
 
 def valid_position(pos: str) -> bool:
     return pos == "" or PlayerStat.get_position(pos) != PlayerStat.DEFAULT_POSITION
 
 def valid_country(id: str) -> bool:
-    return id == "" or len(Country.objects.filter(id=int(id))) > 0
+    return id == "" or valid_id(id, "countries")
 
 def valid_arith_op(op: str) -> bool:
     return op in ["", "*", "/", "+", "-"]
@@ -38,6 +65,35 @@ def valid_arith_op(op: str) -> bool:
 def valid_logical_op(op: str) -> bool: 
     return op in ["<", ">", "=", "><"]
 
+# expected shape of builder post data, the stat lists hold at most `MAX_QUERY_STATS` stats,
+# an optional "percentiles" toggle adds percentile and rank columns to the results
+MAX_QUERY_STATS = 3
+STAT_SCHEMA = { "firstStat": str, "arithOp": str, "secondStat": str, "perNinety": object }
+COMPARISON_SCHEMA = { "logicalOp": str, "firstVal": str, "secondVal": str }
+QUERY_SCHEMA = {
+    "seasonId": str,
+    "selectStats": [STAT_SCHEMA],
+    "leagueId": str,
+    "team": { "id": str, "leagueId": str },
+    "minutesPlayed": COMPARISON_SCHEMA,
+    "age": COMPARISON_SCHEMA,
+    "filterStats": [dict(STAT_SCHEMA, **COMPARISON_SCHEMA)],
+    "country": str,
+    "position": str,
+    "orderByStat": STAT_SCHEMA,
+}
+
+def matches_schema(data: Any, schema: Any) -> bool:
+    if isinstance(schema, dict):
+        return isinstance(data, dict) and all(
+            key in data and matches_schema(data[key], value) for key, value in schema.items()
+        )
+    if isinstance(schema, list):
+        return isinstance(data, list) and len(data) <= MAX_QUERY_STATS and all(
+            matches_schema(item, schema[0]) for item in data
+        )
+    return isinstance(data, schema)
+
 def add_error(errors: Dict[str, List[str]], key: str, message: str) -> None:
     if key in errors:
         errors[key].append(message)
@@ -54,8 +110,8 @@ def check_comparison_val(
         add_error(errors, error_key, f"Logical operator for {field_name} field is invalid")
     if not valid_number(data["firstVal"]):
         add_error(errors, error_key, f"First value for {field_name} field is invalid")
-    if data["logicalOp"] == "><" and ( data["firstVal"] > data["secondVal"] or 
-        not valid_number(data["secondVal"])
+    if data["logicalOp"] == "><" and ( not valid_number(data["secondVal"]) or
+        valid_number(data["firstVal"]) and float(data["firstVal"]) > float(data["secondVal"])
     ):
         add_error(errors, error_key, f"Second value for {field_name} field is invalid")
 
@@ -92,9 +148,15 @@ def query_validator(
 ) -> Dict[str, List[str]]:
     errors: Dict[str, List[str]] = {}
 
+    ##### STRUCTURAL VALIDATIONS #####
+    # reject junk payloads before any lookups
+    if not matches_schema(postData, QUERY_SCHEMA):
+        add_error(errors, "queryErrors", "Query is malformed")
+        return errors
+
     ##### REQUIRED VALIDATIONS #####
     # ensure that at least one select stat is selected
-    if postData["selectStats"][0]["firstStat"] == "":
+    if len(postData["selectStats"]) == 0 or postData["selectStats"][0]["firstStat"] == "":
         add_error(errors, "selectStatsErrors", "At least one Select Stat must be specified")
     # ensure that a season is selected
     if postData["seasonId"] == "":
@@ -134,6 +196,9 @@ def query_validator(
         add_error(errors, "positionErrors", "Position field is invalid")
     # ensure that order by stat is valid
     check_stat(errors, postData["orderByStat"], "orderByStatErrors", "Order By Stat")
+    # ensure that the optional percentiles toggle is valid
+    if type(postData.get("percentiles", False)) != bool:
+        add_error(errors, "percentilesErrors", "Percentiles toggle is invalid")
 
     return errors
 
@@ -183,77 +248,401 @@ def get_comparison_field_value(
 ####### DB QUERY #######
 ########################
 
-def get_queryset_lambdas(
-    post_data: Dict[str, Union[float, int]]
-) -> List[Callable]:
-    # season lambda
-    queryset_lambdas = [ lambda q: q.filter( team__season__id=int(post_data["seasonId"])) ]
-    # minutesPlayed lambda
+# per 90 denominator, shared by every per 90 select, filter and order field
+PER_NINETY_VALUE = Cast(F("minutes_played")/90.0, FloatField())
+QUERY_RESULT_LIMIT = 50
+QUERY_PAGE_SIZE = 100
+QUERY_PAGE_MAX_SIZE = 1000
+
+def stat_shape(stat: Dict[str, Union[str, bool]]) -> Dict[str, Union[str, bool]]:
+    return {
+        "firstStat": stat["firstStat"],
+        "arithOp": stat["arithOp"],
+        "secondStat": stat["secondStat"] if stat["arithOp"] != "" else "",
+        "perNinety": stat["perNinety"],
+    }
+
+def get_stat_expression(stat: Dict[str, Union[str, bool]]) -> FloatField:
+    value = get_comparison_field_value(stat)
+    return Cast(value/PER_NINETY_VALUE if stat["perNinety"] is True else value, FloatField())
+
+def get_query_shape(post_data: Dict[str, Any]) -> str:
+    # the parts of a query that decide its annotations and ordering, independent of
+    # the filter values, so that e.g. the same query for another season shares a plan
+    select_stats = [stat_shape(stat) for stat in post_data["selectStats"] if stat["firstStat"] != ""]
+    order_by_stat = post_data["orderByStat"]
+    desc = True
+    if order_by_stat["firstStat"] != "":
+        desc = not order_by_stat["lowToHigh"] if "lowToHigh" in order_by_stat else True
+    else:
+        order_by_stat = post_data["selectStats"][0]
+    filter_stats = {
+        json.dumps(stat_shape(stat), sort_keys=True) for stat in post_data["filterStats"]
+        if stat["firstStat"] != "" and stat["logicalOp"] != ""
+    }
+    return json.dumps({
+        "select": select_stats,
+        "filter": sorted(filter_stats),
+        "orderBy": stat_shape(order_by_stat),
+        "desc": desc,
+        "percentiles": post_data.get("percentiles", False) is True,
+    }, sort_keys=True)
+
+@lru_cache(maxsize=128)
+def compile_query_shape(shape: str) -> Tuple[QuerySet, Tuple[str, ...]]:
+    # build every distinct annotation once and apply them in a single annotate call;
+    # the returned queryset is never evaluated, only cloned by `QueryPlan.queryset`
+    shape = json.loads(shape)
+    annotations = { "order_field": get_stat_expression(shape["orderBy"]) }
+    for stat in shape["select"] + [json.loads(stat) for stat in shape["filter"]]:
+        field_name = get_comparison_field_name(stat)
+        if field_name not in annotations:
+            annotations[field_name] = get_stat_expression(stat)
+    # window functions run over the whole filtered set, before the row limit
+    order_field = F("order_field").desc() if shape["desc"] is True else F("order_field").asc()
+    annotations["order_rank"] = Window(expression=Rank(), order_by=order_field)
+    header = []
+    for field_name in dict.fromkeys(get_comparison_field_name(stat) for stat in shape["select"]):
+        header.append(field_name)
+        if shape["percentiles"] is True:
+            annotations[field_name + PERCENTILE_SUFFIX] = Window(
+                expression=PercentRank(), order_by=F(field_name).asc()
+            )
+            annotations[field_name + RANK_SUFFIX] = Window(expression=Rank(), order_by=F(field_name).desc())
+            header += [field_name + PERCENTILE_SUFFIX, field_name + RANK_SUFFIX]
+    # PlayerStat id breaks ties, so results and pages are deterministic
+    ordering = ["-order_field", "-id"] if shape["desc"] is True else ["order_field", "id"]
+    queryset = PlayerStat.objects.annotate(**annotations).order_by(*ordering)
+    return queryset, tuple(header)
+
+def is_window_field(field_name: str) -> bool:
+    return field_name.endswith(PERCENTILE_SUFFIX) or field_name.endswith(RANK_SUFFIX)
+
+def get_query_filter(post_data: Dict[str, Any]) -> Q:
+    # every filter merged into one WHERE clause
+    where = Q(team__season__id=int(post_data["seasonId"]))
     if post_data["minutesPlayed"]["logicalOp"] != "":
-        queryset_lambdas.append( lambda q: filter_by_comparison(q, post_data["minutesPlayed"], "minutes_played") )
-    # age lambda
+        where &= comparison_q(post_data["minutesPlayed"], "minutes_played")
     if post_data["age"]["logicalOp"] != "":
-        queryset_lambdas.append( lambda q: filter_by_comparison(q, post_data["age"], "player__age") )
-    # league/team lambda
+        where &= comparison_q(post_data["age"], "player__age")
     if post_data["team"]["id"] != "":
-        queryset_lambdas.append( lambda q: q.filter(team__id=int(post_data["team"]["id"])) )
-    elif post_data["leagueId"] != "" :
-        queryset_lambdas.append( lambda q: q.filter(team__league__league_id=int(post_data["leagueId"])) )
-    # nationality lambda
+        where &= Q(team__id=int(post_data["team"]["id"]))
+    elif post_data["leagueId"] != "":
+        where &= Q(team__league__league_id=int(post_data["leagueId"]))
     if post_data["country"] != "":
-        queryset_lambdas.append( lambda q: q.filter(player__nationality__id=int(post_data["country"])) )
-    # position lambda
+        where &= Q(player__nationality__id=int(post_data["country"]))
     if post_data["position"] != "":
-        queryset_lambdas.append( lambda q: q.filter(position=PlayerStat.get_position(post_data["position"])) )
-    # filter stat lambdas
+        where &= Q(position=PlayerStat.get_position(post_data["position"]))
     for stat in post_data["filterStats"]:
-        if stat["firstStat"] == "" or stat["logicalOp"] == "": 
+        if stat["firstStat"] == "" or stat["logicalOp"] == "":
             continue
-        stat_copy = deepcopy(stat)
-        annotation_name = get_comparison_field_name(stat_copy)
-        annotation_value = get_comparison_field_value(stat_copy)
-        queryset_lambdas.append(
-            # new field annotation lambda, returns tuple, so must select 0th element
-            lambda q: filter_by_comparison(
-                queryset=annotate_queryset(
-                    queryset=q, 
-                    field_value=annotation_value,
-                    per_ninety=stat_copy["perNinety"],
-                    annotation_name=annotation_name
-                )[0], 
-                data=stat_copy, 
-                field=annotation_name
-            ) 
-        )
-    return queryset_lambdas
-
-def get_query_result(post_data: Dict[str, Union[int, float]]) -> BuilderCard:
-    select_fields = { 
-        get_comparison_field_name(stat): {
-            "value": get_comparison_field_value(stat),
-            "per_ninety": stat["perNinety"],
-            # "pct": ???
-        }
-        for stat in post_data["selectStats"] if stat["firstStat"] != ""
+        where &= comparison_q(stat, get_comparison_field_name(stat_shape(stat)))
+    return where
+
+class QueryPlan:
+    __slots__ = ("shape", "where", "limit")
+
+    def __init__(self, shape: str, where: Q, limit: int = QUERY_RESULT_LIMIT) -> None:
+        super().__setattr__("shape", shape)
+        super().__setattr__("where", where)
+        super().__setattr__("limit", limit)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    @classmethod
+    def compile(cls, post_data: Dict[str, Any]) -> Any:
+        return cls(get_query_shape(post_data), get_query_filter(post_data))
+
+    @property
+    def header(self) -> List[str]:
+        return list(compile_query_shape(self.shape)[1])
+
+    def queryset(self) -> QuerySet:
+        base_queryset, _ = compile_query_shape(self.shape)
+        return base_queryset.filter(self.where)[:self.limit]
+
+    def execute(self) -> CardList:
+        header = self.header
+        return CardList([
+            BuilderCard(header=header, data=BuilderCard.format_data(self.queryset(), header))
+        ])
+
+    @property
+    def desc(self) -> bool:
+        return json.loads(self.shape)["desc"]
+
+    def page(
+        self,
+        after: Union[Tuple[Union[float, None], int], None] = None,
+        limit: int = QUERY_PAGE_SIZE
+    ) -> QuerySet:
+        # keyset pagination on (order_field, id): seek past the last row of the previous
+        # page instead of using OFFSET, so every page costs the same
+        base_queryset, _ = compile_query_shape(self.shape)
+        queryset = base_queryset.filter(self.where)
+        if after is not None:
+            queryset = queryset.filter(self.seek(*after))
+        return queryset[:limit]
+
+    def seek(self, value: Union[float, None], id: int) -> Q:
+        # rows ordered after (value, id); SQLite sorts NULL below every value, so NULL
+        # order values come last in descending and first in ascending order
+        lookup = "lt" if self.desc is True else "gt"
+        same_value = Q(order_field__isnull=True) if value is None else Q(order_field=value)
+        after = same_value & Q(**{ f"id__{lookup}": id })
+        if value is None:
+            return after if self.desc is True else after | Q(order_field__isnull=False)
+        after |= Q(**{ f"order_field__{lookup}": value })
+        return after | Q(order_field__isnull=True) if self.desc is True else after
+
+    def unlimited_queryset(self) -> QuerySet:
+        base_queryset, _ = compile_query_shape(self.shape)
+        return base_queryset.filter(self.where)
+
+def get_query_result(post_data: Dict[str, Union[int, float]]) -> CardList:
+    plan = QueryPlan.compile(post_data)
+    run = plan.execute
+    if getattr(settings, "BUILDER_ENGINE", "orm") == "columnar":
+        # optional NumPy engine, falls back to the ORM when NumPy is not installed
+        # or the season has too many rows to hold in memory
+        from . import columnar
+        if columnar.np is not None and columnar.fits_column_store(int(post_data["seasonId"])):
+            run = lambda: columnar.get_query_result(post_data)
+    # both engines get the SQL plan's cost check and time budget, which interrupts the
+    # columnar season load like any other statement
+    return run_with_budget(plan.shape, get_query_cost(plan, post_data), run)
+
+def get_query_cost(plan: QueryPlan, post_data: Dict[str, Any]) -> QueryCost:
+    return estimate_query_cost(plan.queryset(), int(post_data["seasonId"]))
+
+def query_cost_errors(post_data: Dict[str, Any]) -> Dict[str, List[str]]:
+    # reject queries over the cost limit before they are queued
+    errors = {}
+    try:
+        check_query_cost(get_query_cost(QueryPlan.compile(post_data), post_data))
+    except QueryBudgetError as e:
+        add_error(errors, "queryErrors", str(e))
+    return errors
+
+########################
+##### RESULT PAGES #####
+########################
+
+def encode_cursor(value: Union[float, None], id: int) -> str:
+    # a NULL order value is encoded as null
+    return urlsafe_b64encode(json.dumps([value, id]).encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[Union[float, None], int]:
+    # raises ValueError for cursors that were not produced by `encode_cursor`
+    try:
+        value, id = json.loads(urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise ValueError(f"Invalid cursor '{cursor}'") from e
+    if type(value) not in [int, float, type(None)] or type(id) != int:
+        raise ValueError(f"Invalid cursor '{cursor}'")
+    return float(value) if value is not None else None, id
+
+def get_query_page(
+    post_data: Dict[str, Any],
+    after: Union[Tuple[Union[float, None], int], None] = None,
+    limit: int = QUERY_PAGE_SIZE
+) -> Dict[str, Any]:
+    plan = QueryPlan.compile(post_data)
+    # the seek filter would change the window functions' frame, so pages leave them out
+    header = [field_name for field_name in plan.header if not is_window_field(field_name)]
+    # fetch one extra row to know whether there is a next page; pages get the cost check
+    # and time budget of full results, raising QueryBudgetError past either
+    rows = run_with_budget(plan.shape, get_query_cost(plan, post_data), lambda: list(
+        plan.page(after, limit+1).values("id", "order_field", *ENTRY_FIELDS, "team__league__name", *header)
+    ))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["order_field"], rows[-1]["id"])
+    return {
+        "header": [BuilderCard.pretty_field(field_name) for field_name in header],
+        "result": [{
+            "player_id": row["player_id"],
+            "name": row["player__first_name"] + " " + row["player__last_name"],
+            "team": row["team__name"],
+            "team_id": row["team__team_id"],
+            "league": row["team__league__name"],
+            "order_value": row["order_field"],
+            "values": [row[field_name] for field_name in header],
+        } for row in rows],
+        "next": next_cursor,
+    }
+
+########################
+#### RESULT EXPORTS ####
+########################
+
+EXPORT_CHUNK_SIZE = 2000
+# exports stream in the request thread, so they are capped like a query result
+EXPORT_ROW_LIMIT = 50000
+EXPORT_COLUMNS = ["rank", "player_id", "name", "team", "team_id", "league"]
+# key of the last row of an export that was cut short, holding the reason
+EXPORT_TRUNCATED = "truncated"
+
+class EchoBuffer:
+    # file-like object for `csv.writer` that hands each written line back to the caller
+    def write(self, value: str) -> str:
+        return value
+
+def export_columns(plan: QueryPlan) -> List[str]:
+    return EXPORT_COLUMNS + [BuilderCard.pretty_field(field_name) for field_name in plan.header]
+
+def export_cost_errors(post_data: Dict[str, Any]) -> Dict[str, List[str]]:
+    # exports always run in SQLite, reject them over the cost limit before streaming
+    errors = {}
+    try:
+        check_query_cost(estimate_query_cost(
+            QueryPlan.compile(post_data).unlimited_queryset(), int(post_data["seasonId"])
+        ))
+    except QueryBudgetError as e:
+        add_error(errors, "queryErrors", str(e))
+    return errors
+
+def export_rows(plan: QueryPlan, raw: bool = False) -> Iterator[Dict[str, Any]]:
+    # result rows up to `EXPORT_ROW_LIMIT`, read from a server-side cursor in chunks. An
+    # export cut short by the row limit or time budget ends with an `EXPORT_TRUNCATED` row
+    header = plan.header
+    # one extra row tells a result of exactly `EXPORT_ROW_LIMIT` rows from a longer one
+    rows = plan.unlimited_queryset().values(
+        "order_field", "order_rank", *ENTRY_FIELDS, "team__league__name", *header
+    )[:EXPORT_ROW_LIMIT+1].iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    # the whole stream gets a wall-clock budget, an interrupted export ends the response early
+    budget = getattr(settings, "BUILDER_EXPORT_BUDGET", 30.0)
+    deadline = time.monotonic() + budget
+    try:
+        with progress_check(lambda: time.monotonic() > deadline):
+            for count, row in enumerate(rows):
+                if count == EXPORT_ROW_LIMIT:
+                    yield { EXPORT_TRUNCATED: f"Export is limited to {EXPORT_ROW_LIMIT} rows" }
+                    return
+                export_row = {
+                    "rank": row["order_rank"],
+                    "player_id": row["player_id"],
+                    "name": row["player__first_name"] + " " + row["player__last_name"],
+                    "team": row["team__name"],
+                    "team_id": row["team__team_id"],
+                    "league": row["team__league__name"],
+                }
+                for field_name in header:
+                    value = row[field_name]
+                    if raw is False:
+                        value = BuilderCard.display_value(field_name, value)
+                    export_row[BuilderCard.pretty_field(field_name)] = value
+                yield export_row
+    except OperationalError:
+        if time.monotonic() <= deadline:
+            raise
+        # the response has already started, so the reason goes in the body
+        yield { EXPORT_TRUNCATED: f"Export took longer than {budget:g}s" }
+
+def stream_query_csv(post_data: Dict[str, Any], raw: bool = False) -> Iterator[str]:
+    plan = QueryPlan.compile(post_data)
+    writer = csv.DictWriter(EchoBuffer(), fieldnames=export_columns(plan))
+    yield writer.writeheader()
+    for row in export_rows(plan, raw):
+        if EXPORT_TRUNCATED in row:
+            # marker row, with the reason in the first column
+            row = { EXPORT_COLUMNS[0]: f"{EXPORT_TRUNCATED}: {row[EXPORT_TRUNCATED]}" }
+        yield writer.writerow(row)
+
+def stream_query_ndjson(post_data: Dict[str, Any], raw: bool = False) -> Iterator[str]:
+    for row in export_rows(QueryPlan.compile(post_data), raw):
+        yield json.dumps(row) + "\n"
+
+########################
+##### RESULT CACHE #####
+########################
+
+# '{query fingerprint}' -> CardList, versioned with the ingest data version and
+# bounded by the backend's MAX_ENTRIES; on disk, so results computed by the job pool
+# of one worker process are read by all of them
+builder_cache = caches["builder"]
+builder_cache_stats = { "hits": 0, "misses": 0 }
+
+def canonical_stat(stat: Dict[str, Union[str, bool]]) -> Dict[str, Union[str, bool]]:
+    canonical = stat_shape(stat)
+    if "logicalOp" in stat:
+        canonical.update(canonical_comparison(stat))
+    if "lowToHigh" in stat:
+        canonical["lowToHigh"] = stat["lowToHigh"]
+    return canonical
+
+def canonical_comparison(data: Dict[str, str]) -> Dict[str, str]:
+    if data["logicalOp"] == "":
+        return { "logicalOp": "" }
+    return {
+        "logicalOp": data["logicalOp"],
+        "firstVal": data["firstVal"],
+        "secondVal": data["secondVal"] if data["logicalOp"] == "><" else "",
     }
+
+def canonical_query(post_data: Dict[str, Any]) -> Dict[str, Any]:
+    # reduce validated post data to the fields that affect the query result
+    select_stats = [canonical_stat(stat) for stat in post_data["selectStats"] if stat["firstStat"] != ""]
+    # an empty order by stat falls back to the first select stat, high to low
     order_by_stat = (
-        post_data["orderByStat"] if post_data["orderByStat"]["firstStat"]
-        else post_data["selectStats"][0]
+        canonical_stat(post_data["orderByStat"]) if post_data["orderByStat"]["firstStat"] != ""
+        else dict(select_stats[0], lowToHigh=False)
     )
-    order_by_field = {
-        "value": get_comparison_field_value(order_by_stat),
-        "per_ninety": order_by_stat["perNinety"],
-        "desc": (
-            True if "lowToHigh" not in order_by_stat 
-            else (not order_by_stat["lowToHigh"])
-        )
-        # "pct": ???
+    return {
+        "seasonId": post_data["seasonId"],
+        "selectStats": select_stats,
+        "leagueId": post_data["leagueId"] if post_data["team"]["id"] == "" else "",
+        "teamId": post_data["team"]["id"],
+        "minutesPlayed": canonical_comparison(post_data["minutesPlayed"]),
+        "age": canonical_comparison(post_data["age"]),
+        # filters are and-ed together, so their order does not matter
+        "filterStats": sorted(
+            [
+                canonical_stat(stat) for stat in post_data["filterStats"]
+                if stat["firstStat"] != "" and stat["logicalOp"] != ""
+            ],
+            key=lambda stat: json.dumps(stat, sort_keys=True)
+        ),
+        "country": post_data["country"],
+        "position": post_data["position"],
+        "orderByStat": order_by_stat,
+        "percentiles": post_data.get("percentiles", False) is True,
     }
-    return CardList([
-        BuilderCard.from_queryset(
-            queryset=PlayerStat.objects.all(),
-            lambdas=get_queryset_lambdas(post_data),
-            select_fields=select_fields,
-            order_by_field=order_by_field
-        )
-    ])
\ No newline at end of file
+
+def query_fingerprint(post_data: Dict[str, Any]) -> str:
+    canonical = json.dumps(canonical_query(post_data), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def peek_query_result(post_data: Dict[str, Any]) -> Union[CardList, None]:
+    # cached result or None, never runs the query
+    result = builder_cache.get(query_fingerprint(post_data), version=get_data_version())
+    if result is not None:
+        builder_cache_stats["hits"] += 1
+    return result
+
+def get_cached_query_result(post_data: Dict[str, Any]) -> CardList:
+    key = query_fingerprint(post_data)
+    version = get_data_version()
+    result = builder_cache.get(key, version=version)
+    if result is not None:
+        builder_cache_stats["hits"] += 1
+        return result
+    builder_cache_stats["misses"] += 1
+    result = get_query_result(post_data)
+    builder_cache.set(key, result, version=version)
+    logging.debug(
+        f"Builder cache miss for query '{key[:12]}' "
+        f"({builder_cache_stats['hits']} hits, {builder_cache_stats['misses']} misses)."
+    )
+    return result
+
+def get_builder_cache_stats() -> Dict[str, Union[int, float]]:
+    lookups = builder_cache_stats["hits"] + builder_cache_stats["misses"]
+    return dict(builder_cache_stats, hit_rate=builder_cache_stats["hits"]/lookups if lookups > 0 else 0.0)
+
+def clear_builder_cache() -> None:
+    builder_cache.clear()
+    builder_cache_stats["hits"] = 0
+    builder_cache_stats["misses"] = 0
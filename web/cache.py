@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from datetime import datetime
+import hashlib
+from pathlib import Path
+import time
+from typing import Any, Callable, Dict, Tuple, Union
+
+from .models import DataVersion
+
+#################################
+#####     DATA VERSION      #####
+#################################
+
+# the data version is re-read from the database at most once every
+# `DATA_VERSION_TTL` seconds so that cache lookups stay cheap
+version_memo = {
+    "version": None,
+    "updated_at": None,
+    "checked_at": 0.0,
+}
+
+def load_data_version() -> Tuple[int, Union[datetime, None]]:
+    rows = list(DataVersion.objects.filter(pk=1).values_list("version", "updated_at"))
+    return rows[0] if len(rows) > 0 else (0, None)
+
+def get_data_stamp() -> Tuple[int, Union[datetime, None]]:
+    now = time.monotonic()
+    ttl = getattr(settings, "DATA_VERSION_TTL", 1.0)
+    if version_memo["version"] is None or now - version_memo["checked_at"] >= ttl:
+        version_memo["version"], version_memo["updated_at"] = load_data_version()
+        version_memo["checked_at"] = now
+    return version_memo["version"], version_memo["updated_at"]
+
+def get_data_version() -> int:
+    return get_data_stamp()[0]
+
+def reset_data_version_memo() -> None:
+    version_memo["version"] = None
+    version_memo["updated_at"] = None
+    version_memo["checked_at"] = 0.0
+
+def bump_data_version() -> None:
+    def bump():
+        updated = DataVersion.objects.filter(pk=1).update(
+            version=F("version")+1,
+            updated_at=timezone.now()
+        )
+        if updated == 0:
+            DataVersion.objects.create(pk=1, version=1)
+        reset_data_version_memo()
+    # only invalidate caches once the ingested rows are visible to other workers
+    transaction.on_commit(bump)
+
+#################################
+#####    PROCESS MEMOS      #####
+#################################
+
+# small, hot values that every request needs (e.g. the navigation context) are kept
+# in-process as `key -> (data version, value)` and reloaded once the version moves on
+process_memos: Dict[str, Tuple[int, Any]] = {}
+
+def get_process_memo(key: str, loader: Callable[[], Any]) -> Any:
+    version = get_data_version()
+    memo = process_memos.get(key)
+    if memo is None or memo[0] != version:
+        memo = (version, loader())
+        process_memos[key] = memo
+    return memo[1]
+
+def clear_process_memos() -> None:
+    process_memos.clear()
+
+#################################
+#####       RELEASE         #####
+#################################
+
+# directories whose files change the rendered pages on a deploy
+RELEASE_DIRS = [Path(__file__).resolve().parent / "templates", Path(__file__).resolve().parent / "static"]
+
+# loaded once per process, a deploy restarts the workers
+release_memo: Dict[str, Any] = { "release": None }
+
+def load_release() -> str:
+    # `RELEASE` names the deploy, otherwise the templates and static files are hashed
+    digest = hashlib.sha1()
+    for path in sorted(path for directory in RELEASE_DIRS for path in directory.rglob("*") if path.is_file()):
+        digest.update(str(path).encode())
+        digest.update(path.read_bytes())
+    return getattr(settings, "RELEASE", "") or digest.hexdigest()[:12]
+
+def get_release() -> str:
+    if release_memo["release"] is None:
+        release_memo["release"] = load_release()
+    return release_memo["release"]
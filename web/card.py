@@ -1,15 +1,18 @@
-from django.db.models import FloatField, IntegerField, QuerySet
+from django.db.models import QuerySet
 import math
-from typing import Any, Callable, Dict, List, Union
+from typing import Any, Dict, Iterable, List, Tuple, Union
 
 from .models import PlayerStat
-from .queryset import annotate_queryset, order_queryset, modify_queryset
 
 #############################
 ######## CARDENTRY ##########
 #############################
 
+# entries are slotted and pickle as their constructor arguments, so cached cards only
+# hold the fields the templates render
 class CardEntry:
+    __slots__ = ("title", "value")
+
     def __init__(
         self, 
         title: str,
@@ -18,6 +21,9 @@ class CardEntry:
         self.title = title
         self.value = value
 
+    def __reduce__(self):
+        return (self.__class__, (self.title, self.value))
+
     @classmethod
     def display_float(cls, value: float, pct: bool) -> str:
         if pct is True:
@@ -28,6 +34,8 @@ class CardEntry:
         return float_string[0] + '.' + float_string[1][:2].ljust(2, '0')
 
 class BioCardEntry(CardEntry):
+    __slots__ = ("logo", "link")
+
     def __init__(
         self, 
         title: str,
@@ -39,48 +47,118 @@ class BioCardEntry(CardEntry):
         self.logo = logo
         self.link = link
 
-class DashCardEntry(CardEntry):
+    def __reduce__(self):
+        return (self.__class__, (self.title, self.value, self.logo, self.link))
+
+# joined player/team columns projected for dashboard and builder card entries
+ENTRY_FIELDS = [
+    "player_id",
+    "player__first_name",
+    "player__last_name",
+    "team__name",
+    "team__team_id",
+    "team__logo",
+]
+
+class PlayerCardEntry(CardEntry):
+    __slots__ = ("rank", "player_id", "first_name", "last_name", "team", "team_id", "team_logo")
+
     def __init__(
         self, 
-        value: Union[int, float],
-        data: PlayerStat,
-        rank: int
+        value: Union[int, float, str, None],
+        rank: int,
+        player_id: int,
+        first_name: str,
+        last_name: str,
+        team: str,
+        team_id: int,
+        team_logo: str
     ) -> None:
         super().__init__("", value)
-        self.data = data
         self.rank = rank
-        self.player_id = self.data.player.player_id
-        self.first_name = self.data.player.first_name
-        self.last_name = self.data.player.last_name
-        self.team = self.data.team.name
-        self.team_id = self.data.team.team_id
-        self.team_logo = self.data.team.logo
-        self.league = self.data.team.league.name
+        self.player_id = player_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.team = team
+        self.team_id = team_id
+        self.team_logo = team_logo
+
+    def __reduce__(self):
+        return (self.__class__, (self.value,) + self.player_fields())
+
+    def player_fields(self) -> Tuple[Any, ...]:
+        return (
+            self.rank, 
+            self.player_id, 
+            self.first_name, 
+            self.last_name, 
+            self.team, 
+            self.team_id, 
+            self.team_logo
+        )
+
+    @classmethod
+    def entry_fields(cls, row: Dict[str, Any]) -> Dict[str, Any]:
+        # map a row projected with ENTRY_FIELDS to entry keyword arguments
+        return {
+            "player_id": row["player_id"],
+            "first_name": row["player__first_name"],
+            "last_name": row["player__last_name"],
+            "team": row["team__name"],
+            "team_id": row["team__team_id"],
+            "team_logo": row["team__logo"],
+        }
 
     def get_player_name(self):
         return f"{self.first_name[0].upper()}. {self.last_name.title()}"
 
-class BuilderCardEntry(CardEntry):
+class DashCardEntry(PlayerCardEntry):
+    __slots__ = ()
+
+    @classmethod
+    def from_values(
+        cls, 
+        value: Union[int, float, str],
+        rank: int,
+        row: Dict[str, Any]
+    ) -> Any:
+        return cls(value=value, rank=rank, **cls.entry_fields(row))
+
+class BuilderCardEntry(PlayerCardEntry):
+    __slots__ = ("values", "league")
+
     def __init__(
         self, 
         values: Dict[str, Union[int, float]],
-        data: PlayerStat,
-        rank: int
+        rank: int,
+        player_id: int,
+        first_name: str,
+        last_name: str,
+        team: str,
+        team_id: int,
+        team_logo: str,
+        league: str
     ) -> None:
-        super().__init__("", None)
+        super().__init__(None, rank, player_id, first_name, last_name, team, team_id, team_logo)
         self.values = values
-        self.data = data
-        self.rank = rank
-        self.player_id = self.data.player.player_id
-        self.first_name = self.data.player.first_name
-        self.last_name = self.data.player.last_name
-        self.team = self.data.team.name
-        self.team_id = self.data.team.team_id
-        self.team_logo = self.data.team.logo
-        self.league = self.data.team.league.name
+        self.league = league
 
-    def get_player_name(self):
-        return f"{self.first_name[0].upper()}. {self.last_name.title()}"
+    def __reduce__(self):
+        return (self.__class__, (self.values,) + self.player_fields() + (self.league,))
+
+    @classmethod
+    def from_values(
+        cls, 
+        values: Dict[str, Union[int, float]],
+        rank: int,
+        row: Dict[str, Any]
+    ) -> Any:
+        return cls(
+            values=values, 
+            rank=rank, 
+            league=row["team__league__name"], 
+            **cls.entry_fields(row)
+        )
 
 #############################
 ########### CARD ############
@@ -118,7 +196,8 @@ class Card:
             formatted_title = stat["title"] + " Per 90" if format_per_ninety is True else stat["title"]
             pct = ("pct" in stat and stat["pct"] is True)
             if format_per_ninety:
-                formatted_value = CardEntry.display_float(float(stat["value"])*90/float(minutes_played), pct)
+                per_ninety_value = float(stat["value"])*90/float(minutes_played) if minutes_played > 0 else 0.0
+                formatted_value = CardEntry.display_float(per_ninety_value, pct)
             elif type(stat["value"]) == float or pct is True:
                 formatted_value = CardEntry.display_float(float(stat["value"]), pct)
             else:
@@ -161,20 +240,21 @@ class BioCard(Card):
             logo=playerstat.player.nationality.flag
         ))
         birthdate = playerstat.player.birthdate
-        birthdate_str = birthdate.strftime(f"%B {birthdate.day}, %Y")
+        birthdate_str = birthdate.strftime(f"%B {birthdate.day}, %Y") if birthdate is not None else "-"
         data.append(BioCardEntry(
             title="Date of Birth",
             value=f"{birthdate_str} ({playerstat.player.age})",
         ))
-        height_in = float(playerstat.player.height[:-3])*0.3937008
+        height_cm = playerstat.player.height_cm
+        height_in = height_cm*0.3937008 if height_cm is not None else None
         data.append(BioCardEntry(
             title="Height",
-            value=f"{math.floor(height_in/12)}'{round(height_in % 12)}''"
+            value=f"{math.floor(height_in/12)}'{round(height_in % 12)}''" if height_in is not None else "-"
         ))
-        weight_lb = float(playerstat.player.weight[:-3])*2.204623
+        weight_kg = playerstat.player.weight_kg
         data.append(BioCardEntry(
             title="Weight",
-            value=f"{round(weight_lb)} lbs"
+            value=f"{round(weight_kg*2.204623)} lbs" if weight_kg is not None else "-"
         ))
         return BioCard(data=data)
     
@@ -189,49 +269,28 @@ class DashCard(Card):
     @classmethod
     def format_data( 
         cls,
-        queryset: QuerySet, 
+        ordered_data: Iterable[Tuple[Union[int, float], Dict[str, Any]]], 
         pct: bool
     ) -> List[DashCardEntry]:
         entries = []
         prev_val = None
         prev_rank = None
         curr_rank = 0
-        for playerstat in queryset:
+        for val, row in ordered_data:
             curr_rank += 1
-            val = playerstat.order_field
             rank = curr_rank if (prev_val is None or prev_val != val) else prev_rank
             prev_rank = rank 
             prev_val = val
-            entries.append(DashCardEntry(
+            entries.append(DashCardEntry.from_values(
                 rank=rank, 
                 value=CardEntry.display_float(val, pct) if int(val) != val else int(val), 
-                data=playerstat
+                row=row
             ))
         return entries
 
-    @classmethod
-    def from_queryset(
-        cls,
-        queryset: QuerySet,
-        per_ninety: bool,
-        field: Union[str, IntegerField, FloatField],
-        title: Union[str, None] = None,
-        desc: bool = True,
-        pct: bool = False,
-        lambdas: List[Callable] = []
-    ) -> Any:
-        filtered_queryset = modify_queryset(queryset, lambdas)
-        ordered_queryset = order_queryset(
-            queryset=filtered_queryset, 
-            field_value=field, 
-            per_ninety=per_ninety, 
-            desc=desc
-        )
-        title = field.replace('_',' ').title() if title is None else title
-        return DashCard(
-            title=title if per_ninety is False else f"{title} Per 90", 
-            data=cls.format_data(ordered_queryset, pct)
-        )
+# optional window columns that follow each builder select field
+PERCENTILE_SUFFIX = "_Percentile"
+RANK_SUFFIX = "_Rank"
 
 class BuilderCard(Card):
     def __init__(
@@ -260,6 +319,18 @@ class BuilderCard(Card):
             pretty_header.append(self.__class__.pretty_field(field_name))
         return pretty_header
 
+    @classmethod
+    def display_value(cls, field_name: str, value: Union[int, float, None]) -> str:
+        # NULL for divisions by zero, e.g. per 90 stats without minutes played
+        if value is None:
+            return "-"
+        if field_name.endswith(PERCENTILE_SUFFIX):
+            return BuilderCardEntry.display_float(value, True)
+        if field_name.endswith(RANK_SUFFIX):
+            return str(value)
+        pct = cls.pretty_field(field_name) in [stat[1] for stat in PlayerStat.PCT_STATS]
+        return BuilderCardEntry.display_float(value, pct)
+
     @classmethod
     def format_data( 
         cls,
@@ -267,57 +338,27 @@ class BuilderCard(Card):
         select_fields: List[str],
         # pct: bool
     ) -> List[BuilderCardEntry]:
-        entries = []
-        prev_val = None
-        prev_rank = None
-        curr_rank = 0
-        for playerstat in queryset:
-            curr_rank += 1
-            val = playerstat.order_field
-            rank = curr_rank if (prev_val is None or prev_val != val) else prev_rank
-            prev_rank = rank 
-            prev_val = val
-            # create values dict
-            values_dict = {}
-            for field_name in select_fields:
-                field_value = getattr(playerstat, field_name)
-                pct = cls.pretty_field(field_name) in [stat[1] for stat in PlayerStat.PCT_STATS]
-                values_dict[field_name] = BuilderCardEntry.display_float(field_value, pct)
-            entries.append(
-                BuilderCardEntry(
-                    rank=rank, 
-                    values=values_dict,
-                    data=playerstat
-                )
-            )
-        return entries
+        return cls.format_rows(
+            queryset.values("order_rank", *ENTRY_FIELDS, "team__league__name", *select_fields),
+            select_fields
+        )
 
     @classmethod
-    def from_queryset(
+    def format_rows(
         cls,
-        queryset: QuerySet,
-        select_fields: Dict[str, Union[FloatField, IntegerField, bool]],
-        order_by_field: Dict[str, Union[FloatField, IntegerField, bool]],
-        lambdas: List[Callable] = []
-    ) -> Any:
-        filtered_queryset = modify_queryset(queryset, lambdas)
-        ordered_queryset = order_queryset(
-            queryset=filtered_queryset, 
-            field_value=order_by_field["value"], 
-            per_ninety=order_by_field["per_ninety"], 
-            desc=order_by_field["desc"]
-        )
-        for field_name, field_data in select_fields.items():
-            ordered_queryset, _ = annotate_queryset(
-                queryset=ordered_queryset,
-                field_value=field_data["value"],
-                per_ninety=field_data["per_ninety"],
-                annotation_name=field_name,
+        rows: Iterable[Dict[str, Any]],
+        select_fields: List[str],
+    ) -> List[BuilderCardEntry]:
+        # rows hold "order_rank", `ENTRY_FIELDS`, "team__league__name" and every select field,
+        # ranks come from a RANK() window over the filtered set, so ties share a rank
+        return [
+            BuilderCardEntry.from_values(
+                rank=row["order_rank"],
+                values={ field_name: cls.display_value(field_name, row[field_name]) for field_name in select_fields },
+                row=row
             )
-        return BuilderCard(
-            header=select_fields.keys(),
-            data=cls.format_data(ordered_queryset, select_fields.keys())
-        )
+            for row in rows
+        ]
 
 class CardList:
     def __init__(self, cards: List[Card]) -> None:
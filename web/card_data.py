@@ -1,162 +1,364 @@
-from django.db.models import F, FloatField, QuerySet
-from django.db.models.functions import Cast 
-from typing import Dict, List, Union
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError, transaction
+from django.db.models import Count, QuerySet, Sum
+from django.template.loader import render_to_string
+import heapq
+import json
+import logging
+from operator import itemgetter
+import time
+from typing import Any, Dict, Iterable, List, Tuple, Union
+import zlib
 
-from .card import Card, DashCard, BioCard, CardList
-from .models import Season, League, Player, PlayerStat
-from .queryset import get_max
+from .cache import get_data_version
+from .card import ENTRY_FIELDS, Card, CardEntry, DashCard, DashCardEntry, BioCard, BioCardEntry, CardList
+from .management.commands.helpers.config import international_league_ids
+from .models import Season, League, LeaderboardEntry, Player, PlayerProfile, PlayerStat, Team
+from .queryset import filter_by_summary, get_scope_queryset
 
 #################################
 #####   CACHE AND HELPERS   #####
 #################################
 
-card_cache = {
-    # '{League.league_id}-{Season.start_year}-{per_ninety}' -> List[ CardList ]
-}
+# '{League.league_id}-{Season.start_year}-{per_ninety}' -> List[ CardList ]
+# entries are versioned with the ingest data version, so a fresh `db_utils`
+# run invalidates every worker, and the backend evicts least recently used keys
+card_cache = caches["cards"]
+# '{card_cache_key}-{CardList index}' -> rendered dashboard card.html fragment, versioned the same way
+fragment_cache = caches["fragments"]
+# '{Team.team_id}-{Season.start_year}' -> team page data, versioned the same way
+team_cache = caches["teams"]
 
 def clear_cache() -> None:
-    card_cache = {}
+    card_cache.clear()
+    fragment_cache.clear()
+    team_cache.clear()
 
 def card_cache_key(season: Season, per_ninety: bool, league: League) -> str:
     league_str = "Top5" if league is None else league.league_id
     return f"{league_str}-{season.start_year}-{per_ninety}"
 
 def get_from_cache(season: Season, per_ninety: bool, league: League) -> List[CardList]:
-    return card_cache.get(card_cache_key(season, per_ninety, league))
+    return card_cache.get(
+        card_cache_key(season, per_ninety, league), 
+        version=get_data_version()
+    )
 
 def insert_to_cache(season: Season, per_ninety: bool, league: League, data: List[CardList]) -> None:
-    card_cache[card_cache_key(season, per_ninety, league)] = data
+    card_cache.set(
+        card_cache_key(season, per_ninety, league), 
+        data, 
+        version=get_data_version()
+    )
+
+def render_card_list(card_list: CardList, season: Season) -> str:
+    return render_to_string("card.html", {
+        "type": "dashboard",
+        "cards": card_list.cards,
+        "current_season": season,
+    })
+
+def get_card_fragments(
+    season: Season, 
+    per_ninety: bool, 
+    league: Union[League, None] = None
+) -> List[str]:
+    version = get_data_version()
+    keys = [
+        f"{card_cache_key(season, per_ninety, league)}-{card_list_idx}" 
+        for card_list_idx in range(len(DASHBOARD_CARDS))
+    ]
+    fragments = fragment_cache.get_many(keys, version=version)
+    if len(fragments) != len(keys):
+        # render every card list of the variant on a miss
+        card_data = get_card_data(season, per_ninety, league)
+        fragments = {
+            key: render_card_list(card_list, season) 
+            for key, card_list in zip(keys, card_data)
+        }
+        fragment_cache.set_many(fragments, version=version)
+    return [fragments[key] for key in keys]
 
 #################################
 ####   CARD DATA FUNCTIONS   ####
 #################################
 
-def get_dashboard_data(queryset: QuerySet, per_ninety: bool) -> List[CardList]:
+# dashboard cards grouped by CardList, each card is computed from one in-memory scan
+#   "field": PlayerStat field to rank by, or "value": callable computing it from a
+#       projected PlayerStat row along with the "fields" it reads
+#   "per_ninety": False/True forces the variant, otherwise the dashboard toggle is used
+#   "qualifier": (field, divisor) keeps rows where field >= max(field)/divisor
+#   "position": only rank rows with this position (applied before the qualifier)
+DASHBOARD_CARDS = [
     # GOALS CARDS
-    goals_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=per_ninety,
-        field="goals"
-    )
-    assists_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=per_ninety,
-        field="assists"
-    )
-    goal_contributions_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=per_ninety,
-        field=F("goals")+F("assists"),
-        title="Goal Contributions"
-    )
-    goals_per_shot_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=False,
-        field=Cast(F("goals"), FloatField())/Cast(F("shots"), FloatField()),
-        title="Goals Per Shot",
-        lambdas=[lambda q: q.filter( shots__gte=get_max(q, "shots")/5 )]
-    )
-    shots_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=per_ninety,
-        field="shots"
-    )
-    shots_on_target_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=per_ninety,
-        field="shots_on_target"
-    )
+    [
+        { "field": "goals" },
+        { "field": "assists" },
+        { 
+            "title": "Goal Contributions", 
+            "value": lambda row: row["goals"] + row["assists"], 
+            "fields": ["goals", "assists"],
+        },
+        { 
+            "title": "Goals Per Shot", 
+            "value": lambda row: float(row["goals"])/float(row["shots"]),
+            "fields": ["goals", "shots"],
+            "per_ninety": False,
+            "qualifier": ("shots", 5),
+        },
+    ],
+    [
+        { "field": "shots" },
+        { "field": "shots_on_target" },
+    ],
     # PASSES CARDS
-    key_passes_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=per_ninety,
-        field="passes_key",
-        title="Key Passes"
-    )
-    passes_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=per_ninety,
-        field="passes"
-    )
-    pass_accuracy_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=False,
-        field="passes_accuracy",
-        title="Pass Accuracy",
-        pct=True,
-        lambdas=[lambda q: q.filter( passes__gte=get_max(q, "passes")/5 )]
-    )
+    [
+        { "field": "passes_key", "title": "Key Passes" },
+        { "field": "passes" },
+        { 
+            "field": "passes_accuracy", 
+            "title": "Pass Accuracy", 
+            "per_ninety": False, 
+            "pct": True, 
+            "qualifier": ("passes", 5),
+        },
+    ],
     # DRIBBLES CARDS
-    successful_dribbles_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=per_ninety,
-        field="dribbles_succeeded",
-        title="Successful Dribbles"
-    )
-    attempted_dribbles_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=per_ninety,
-        field="dribbles_attempted",
-        title="Attempted Dribbles"
-    )
-    dribble_success_rate_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=False,
-        field="dribbles_succeeded_pct",
-        title="Dribble Success Rate",
-        pct=True,
-        lambdas=[
-            lambda q: q.filter(
-                dribbles_attempted__gte=get_max(q, "dribbles_attempted")/5 
-            )
-        ]
-    )
+    [
+        { "field": "dribbles_succeeded", "title": "Successful Dribbles" },
+        { "field": "dribbles_attempted", "title": "Attempted Dribbles" },
+        { 
+            "field": "dribbles_succeeded_pct", 
+            "title": "Dribble Success Rate", 
+            "per_ninety": False, 
+            "pct": True, 
+            "qualifier": ("dribbles_attempted", 5),
+        },
+    ],
     # DEFENSIVE CARDS
-    tackles_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=per_ninety,
-        field="tackles"
-    )
-    interceptions_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=per_ninety,
-        field="interceptions"
-    )
-    blocks_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=per_ninety,
-        field="blocks"
-    )
+    [
+        { "field": "tackles" },
+        { "field": "interceptions" },
+        { "field": "blocks" },
+    ],
     # EXTRA CARDS
-    rating_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=False,
-        field="rating",
-        title="Player Rating"
+    [
+        { "field": "rating", "title": "Player Rating", "per_ninety": False },
+        { 
+            "field": "goals_conceded", 
+            "per_ninety": True, 
+            "desc": False, 
+            "position": "goalkeeper",
+            "qualifier": ("minutes_played", 4),
+        },
+        { "field": "penalties_saved", "per_ninety": False },
+    ],
+]
+
+DASHBOARD_CARD_LIMIT = 50
+
+# rows must have played at least 1/5 of the scope's maximum minutes to be ranked
+DASHBOARD_QUALIFIER = ("minutes_played", 5)
+
+# PlayerStat columns projected for the dashboard scan
+DASHBOARD_FIELDS = sorted(set(
+    ["position", "minutes_played"] +
+    [
+        field 
+        for card_list in DASHBOARD_CARDS for card in card_list 
+        for field in (
+            ([card["field"]] if "field" in card else card["fields"]) + 
+            ([card["qualifier"][0]] if "qualifier" in card else [])
+        )
+    ]
+))
+
+def qualify(rows: List[Dict[str, Any]], field: str, divisor: int) -> List[Dict[str, Any]]:
+    if len(rows) == 0:
+        return rows
+    threshold = float(max(row[field] for row in rows))/divisor
+    return [row for row in rows if row[field] >= threshold]
+
+def card_value(row: Dict[str, Any], card: Dict[str, Any], per_ninety: bool) -> float:
+    value = float(card["value"](row) if "value" in card else row[card["field"]])
+    return value/(row["minutes_played"]/90.0) if per_ninety is True else value
+
+def build_dash_card(
+    rows: List[Dict[str, Any]], 
+    card: Dict[str, Any], 
+    per_ninety: bool
+) -> DashCard:
+    card_per_ninety = dash_card_per_ninety(card, per_ninety)
+    # narrow down the scanned rows to the ones that qualify for this card
+    if "position" in card:
+        position = PlayerStat.get_position(card["position"])
+        rows = [row for row in rows if row["position"] == position]
+    if "qualifier" in card:
+        rows = qualify(rows, *card["qualifier"])
+    # compute card values, skipping rows whose value is undefined (e.g. zero shots)
+    values = []
+    for row in rows:
+        try:
+            values.append( (card_value(row, card, card_per_ninety), row) )
+        except ZeroDivisionError:
+            continue
+    # top-k selection, keeps scan order for equal values like a stable sort would
+    select = heapq.nsmallest if card.get("desc") is False else heapq.nlargest
+    ordered_values = select(DASHBOARD_CARD_LIMIT, values, key=itemgetter(0))
+    return DashCard(
+        title=dash_card_title(card, card_per_ninety), 
+        data=DashCard.format_data(ordered_values, card.get("pct") is True)
     )
-    goals_conceded_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=True,
-        field="goals_conceded",
-        desc=False,
-        lambdas=[
-            lambda q: q.filter(position=PlayerStat.get_position("goalkeeper")),
-            lambda q: q.filter(minutes_played__gte=get_max(q, "minutes_played")/4)
+
+def dash_card_per_ninety(card: Dict[str, Any], per_ninety: bool) -> bool:
+    return card["per_ninety"] if "per_ninety" in card else per_ninety
+
+def dash_card_title(card: Dict[str, Any], per_ninety: bool) -> str:
+    title = card["title"] if "title" in card else card["field"].replace('_',' ').title()
+    return title if per_ninety is False else f"{title} Per 90"
+
+def get_dashboard_queryset(season: Season, league: Union[League, None]) -> QuerySet:
+    # qualifying rows of the dashboard scope, thresholded with the season's stat summary
+    return filter_by_summary(get_scope_queryset(season, league), season, league, *DASHBOARD_QUALIFIER)
+
+def get_dashboard_data(queryset: QuerySet) -> Dict[bool, List[CardList]]:
+    # rows are expected to be qualified already, see `get_dashboard_queryset`
+    rows = list(queryset.values(*ENTRY_FIELDS, *DASHBOARD_FIELDS))
+    return {
+        per_ninety: [
+            CardList([
+                build_dash_card(rows, card, per_ninety) 
+                for card in card_list
+            ])
+            for card_list in DASHBOARD_CARDS
         ]
-    )
-    penalties_saved_card = DashCard.from_queryset(
-        queryset=queryset,
-        per_ninety=False,
-        field="penalties_saved"
-    )
+        for per_ninety in [False, True]
+    }
+
+def get_card_data(
+    season: Season, 
+    per_ninety: bool, 
+    league: Union[League, None] = None
+) -> List[CardList]:
+    # return stored result if present
+    card_cache_data = get_from_cache(season, per_ninety, league)
+    if card_cache_data is not None:
+        return card_cache_data
+
+    # read materialized leaderboards if they have been built for this season
+    card_data = get_from_leaderboards(season, per_ninety, league)
+    if card_data is not None:
+        insert_to_cache(season, per_ninety, league, card_data)
+        return card_data
 
+    # generate raw and per 90 dashboard cards from one scan of the current league(s)
+    dashboard_data = get_dashboard_data(get_dashboard_queryset(season, league))
+    for per_ninety_key, card_data in dashboard_data.items():
+        insert_to_cache(season, per_ninety_key, league, card_data)
+    return dashboard_data[per_ninety]
+
+def warm_card_cache(seasons: Union[List[Season], None] = None) -> List[Tuple[str, float]]:
+    # build and render every league/season/per 90 variant into the card caches, timing each one
+    seasons = list(Season.objects.all()) if seasons is None else seasons
+    leagues = [None] + list(League.objects.all())
+    timings = []
+    for season in seasons:
+        for league in leagues:
+            for per_ninety in [False, True]:
+                start = time.perf_counter()
+                get_card_fragments(season, per_ninety, league)
+                elapsed = time.perf_counter() - start
+                key = card_cache_key(season, per_ninety, league)
+                logging.info(f"Card cache variant '{key}' built in {elapsed*1000:.1f}ms.")
+                timings.append((key, elapsed))
+    logging.info(f"{len(timings)} card cache variants built in {sum(t for _, t in timings):.2f}s.")
+    return timings
+
+def preload_card_cache() -> None:
+    # worker startup hook, see inform/wsgi.py and inform/asgi.py
+    if not getattr(settings, "PRELOAD_CARD_CACHE", False):
+        return
+    try:
+        warm_card_cache()
+    except DatabaseError as e:
+        logging.warning(f"Card cache was not preloaded.\n\tException: {e}")
+
+#################################
+####   LEADERBOARD TABLE    #####
+#################################
+
+def build_leaderboards(season: Season) -> int:
+    # compute every dashboard variant of the season
+    entries = []
+    for league in [None] + list(League.objects.all()):
+        dashboard_data = get_dashboard_data(get_dashboard_queryset(season, league))
+        for per_ninety, card_data in dashboard_data.items():
+            for card_list_idx, card_list in enumerate(card_data):
+                for card_idx, card in enumerate(card_list.cards):
+                    for row, entry in enumerate(card.data):
+                        entries.append(LeaderboardEntry(
+                            season=season,
+                            league=league,
+                            per_ninety=per_ninety,
+                            card_list=card_list_idx,
+                            card=card_idx,
+                            row=row,
+                            rank=entry.rank,
+                            value=str(entry.value),
+                            player_id=entry.player_id,
+                            first_name=entry.first_name,
+                            last_name=entry.last_name,
+                            team_id=entry.team_id,
+                            team_name=entry.team,
+                            team_logo=entry.team_logo,
+                        ))
+    # replace the season's leaderboards atomically so readers never see a partial table
+    with transaction.atomic():
+        LeaderboardEntry.objects.filter(season=season).delete()
+        LeaderboardEntry.objects.bulk_create(entries, batch_size=500)
+    return len(entries)
+
+def get_from_leaderboards(
+    season: Season, 
+    per_ninety: bool, 
+    league: Union[League, None]
+) -> Union[List[CardList], None]:
+    entries = list(LeaderboardEntry.objects.filter(
+        season=season, 
+        league=league, 
+        per_ninety=per_ninety
+    ).order_by("card_list", "card", "row").values_list(
+        "card_list", "card", "value", "rank", "player_id", 
+        "first_name", "last_name", "team_name", "team_id", "team_logo"
+    ))
+    # leaderboards have not been built for this season/league
+    if len(entries) == 0:
+        return None
+    # players and teams repeat across cards, share their strings between entries
+    strings = {}
+    share = lambda string: strings.setdefault(string, string)
+    card_entries = {}
+    for card_list, card, value, rank, player_id, first_name, last_name, team, team_id, team_logo in entries:
+        card_entries.setdefault((card_list, card), []).append(DashCardEntry(
+            value=value,
+            rank=rank,
+            player_id=player_id,
+            first_name=share(first_name),
+            last_name=share(last_name),
+            team=share(team),
+            team_id=team_id,
+            team_logo=share(team_logo)
+        ))
     return [
-        CardList([ goals_card, assists_card, goal_contributions_card, goals_per_shot_card ]),
-        CardList([ shots_card, shots_on_target_card ]),
-        CardList([ key_passes_card, passes_card, pass_accuracy_card ]),
-        CardList([ successful_dribbles_card, attempted_dribbles_card, dribble_success_rate_card ]),
-        CardList([ tackles_card, interceptions_card, blocks_card ] ),
-        CardList([ rating_card, goals_conceded_card, penalties_saved_card ])
+        CardList([
+            DashCard(
+                title=dash_card_title(card, dash_card_per_ninety(card, per_ninety)), 
+                data=card_entries.get((card_list_idx, card_idx), [])
+            )
+            for card_idx, card in enumerate(card_list)
+        ])
+        for card_list_idx, card_list in enumerate(DASHBOARD_CARDS)
     ]
 
 def get_player_data(
@@ -177,7 +379,7 @@ def get_player_data(
             { "title": "Goals", "value": playerstat.goals },
             { 
                 "title": "Goals Per Shot",
-                "value": float(playerstat.goals)/playerstat.shots if playerstat.goals > 0 else 0.0,
+                "value": float(playerstat.goals)/playerstat.shots if playerstat.shots > 0 else 0.0,
                 "per_ninety": False,
             },
             { "title": "Shots On Target", "value": playerstat.shots_on_target },
@@ -286,4 +488,185 @@ def get_player_data(
         goalkeeping_card
     ])
 
-    return player_data 
\ No newline at end of file
+    return player_data 
+
+#################################
+#####      TEAM PAGES       #####
+#################################
+
+# squad summary columns, summed per position in one GROUP BY
+TEAM_SUMMARY_COLUMNS = [
+    ("Players", "players"), ("Minutes", "minutes_played"), ("Goals", "goals"), ("Assists", "assists"),
+    ("Shots", "shots"), ("Key Passes", "passes_key"), ("Tackles", "tackles"), ("Interceptions", "interceptions"),
+]
+# columns that also get a per 90 value over the team's minutes, which are the squad's
+# player minutes shared by the players on the pitch
+TEAM_PER_NINETY_FIELDS = ["goals", "assists", "shots", "passes_key", "tackles", "interceptions"]
+PLAYERS_ON_PITCH = 11
+
+def team_cache_key(team_id: int, start_year: int) -> str:
+    return f"{team_id}-{start_year}"
+
+def load_team_page(team_id: int, start_year: int) -> Union[Dict[str, Any], None]:
+    # every season of the club with its league, in one query
+    team_rows = list(Team.objects.filter(team_id=team_id).order_by("-season__start_year", "id").values(
+        "id", "name", "logo", "league__league_id", "league__name", "season__start_year", "season__end_year"
+    ))
+    season_rows = [row for row in team_rows if row["season__start_year"] == start_year]
+    if len(season_rows) == 0:
+        return None
+    # clubs playing international competitions are shown with their domestic league
+    current = season_rows[0]
+    for row in season_rows:
+        if row["league__league_id"] not in international_league_ids:
+            current = row
+    # squad: one joined projection of the players, in squad order
+    squad = list(PlayerStat.objects.filter(team__id=current["id"]).order_by("id").values(
+        "position", "player__player_id", "player__first_name", "player__last_name"
+    ))
+    # squad totals per position: one GROUP BY
+    sum_fields = [field for _, field in TEAM_SUMMARY_COLUMNS if field != "players"]
+    position_totals = {
+        row["position"]: row
+        for row in PlayerStat.objects.filter(team__id=current["id"]).order_by().values("position").annotate(
+            players=Count("id"), **{ field: Sum(field) for field in sum_fields }
+        )
+    }
+    positions = [{
+        "name": name,
+        "players": [row for row in squad if row["position"] == position],
+        "totals": position_totals.get(position, {}),
+    } for position, name in PlayerStat.POSITIONS if position != PlayerStat.DEFAULT_POSITION]
+    totals = {
+        field: sum(row[field] or 0 for row in position_totals.values())
+        for _, field in TEAM_SUMMARY_COLUMNS
+    }
+    nineties = totals["minutes_played"]/(PLAYERS_ON_PITCH*90)
+    per_ninety = {
+        field: round(totals[field]/nineties, 2) if nineties > 0 else 0.0
+        for field in TEAM_PER_NINETY_FIELDS
+    }
+    return {
+        "team": {
+            "id": current["id"],
+            "team_id": team_id,
+            "name": current["name"],
+            "logo": current["logo"],
+            "league_id": current["league__league_id"],
+            "league_name": current["league__name"],
+        },
+        "seasons": [
+            { "start_year": start_year, "end_year": end_year }
+            for start_year, end_year in dict.fromkeys(
+                (row["season__start_year"], row["season__end_year"]) for row in team_rows
+            )
+        ],
+        "positions": positions,
+        "summary": {
+            "header": [title for title, _ in TEAM_SUMMARY_COLUMNS],
+            "rows": [
+                [position["name"]] + [position["totals"].get(field) or 0 for _, field in TEAM_SUMMARY_COLUMNS]
+                for position in positions
+            ] + [
+                ["total"] + [totals[field] for _, field in TEAM_SUMMARY_COLUMNS],
+                ["per 90"] + [per_ninety.get(field, "-") for _, field in TEAM_SUMMARY_COLUMNS],
+            ],
+        },
+    }
+
+def get_team_page(team_id: int, start_year: int) -> Union[Dict[str, Any], None]:
+    key = team_cache_key(team_id, start_year)
+    version = get_data_version()
+    page = team_cache.get(key, version=version)
+    if page is None:
+        page = load_team_page(team_id, start_year)
+        # teams without a row for the season are cached as well, as an empty dict
+        team_cache.set(key, page or {}, version=version)
+    return page or None
+
+#################################
+#####    PLAYER PROFILES    #####
+#################################
+
+# players whose profiles are built and replaced together
+PROFILE_BATCH_SIZE = 500
+
+def dump_card(card: Card) -> List[Any]:
+    return [card.title, [[entry.title, entry.value] for entry in card.data]]
+
+def load_card(card: List[Any]) -> Card:
+    title, entries = card
+    return Card(title=title, data=[CardEntry(title=entry_title, value=value) for entry_title, value in entries])
+
+def player_profile(first_name: str, last_name: str, playerstats: Iterable[PlayerStat]) -> Dict[str, Any]:
+    # bio and stat cards, raw and per 90, of every team the player played for, most recent season first
+    seasons = {}
+    for playerstat in sorted(playerstats, key=lambda playerstat: (-playerstat.team.season.start_year, playerstat.team.id)):
+        season = playerstat.team.season
+        player_data = get_player_data(playerstat, False)
+        seasons.setdefault(season.start_year, {
+            "start_year": season.start_year, "end_year": season.end_year, "teams": []
+        })["teams"].append({
+            "id": playerstat.team.id,
+            "name": playerstat.team.name,
+            "league_name": playerstat.team.league.name,
+            "bio": [
+                [entry.title, entry.value, entry.logo, entry.link]
+                for entry in player_data["bio"].cards[0].data
+            ],
+            "stats": [dump_card(card) for card in player_data["stats"].cards],
+            "stats_per_ninety": [dump_card(card) for card in get_player_data(playerstat, True)["stats"].cards],
+        })
+    return { "first_name": first_name, "last_name": last_name, "seasons": list(seasons.values()) }
+
+def load_player_profiles(player_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    # two queries for any number of players
+    playerstats = {}
+    for playerstat in PlayerStat.objects.filter(player__player_id__in=player_ids).select_related(
+        "player__nationality", "team__league", "team__season"
+    ).order_by("id"):
+        playerstats.setdefault(playerstat.player_id, []).append(playerstat)
+    return {
+        player_id: player_profile(first_name, last_name, playerstats.get(player_id, []))
+        for player_id, first_name, last_name in Player.objects.filter(player_id__in=player_ids).values_list(
+            "player_id", "first_name", "last_name"
+        )
+    }
+
+def pack_profile(profile: Dict[str, Any]) -> bytes:
+    return zlib.compress(json.dumps(profile, separators=(",", ":")).encode())
+
+def unpack_profile(data: bytes) -> Dict[str, Any]:
+    return json.loads(zlib.decompress(data))
+
+def build_player_profiles(season: Union[Season, None] = None) -> int:
+    # rebuild the profiles of every player, or of the players of one season
+    players = Player.objects.all() if season is None else Player.objects.filter(stats__team__season=season)
+    player_ids = list(players.order_by("player_id").values_list("player_id", flat=True).distinct())
+    for start in range(0, len(player_ids), PROFILE_BATCH_SIZE):
+        batch = player_ids[start:start+PROFILE_BATCH_SIZE]
+        profiles = [
+            PlayerProfile(player_id=player_id, data=pack_profile(profile))
+            for player_id, profile in load_player_profiles(batch).items()
+        ]
+        # replace the batch atomically so readers never miss a profile
+        with transaction.atomic():
+            PlayerProfile.objects.filter(player_id__in=batch).delete()
+            PlayerProfile.objects.bulk_create(profiles)
+    return len(player_ids)
+
+def get_player_profile(player_id: int) -> Union[Dict[str, Any], None]:
+    data = PlayerProfile.objects.filter(player_id=player_id).values_list("data", flat=True).first()
+    if data is not None:
+        return unpack_profile(data)
+    # players without a built profile yet
+    return load_player_profiles([player_id]).get(player_id)
+
+def get_profile_cards(team_profile: Dict[str, Any], per_ninety: bool) -> Dict[str, CardList]:
+    # the cards `get_player_data` builds, from a team entry of a profile
+    return {
+        "bio": CardList([BioCard(data=[BioCardEntry(*entry) for entry in team_profile["bio"]])]),
+        "stats": CardList([
+            load_card(card) for card in team_profile["stats_per_ninety" if per_ninety is True else "stats"]
+        ]),
+    }
@@ -0,0 +1,201 @@
+from django.conf import settings
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast
+import json
+import logging
+from typing import Any, Dict, List, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+    logging.info("NumPy is not installed, builder queries will use the ORM engine.")
+
+from .builder import (
+    QUERY_RESULT_LIMIT, get_comparison_field_name, get_query_shape, stat_list, stat_shape
+)
+from .cache import get_process_memo
+from .guard import get_row_stats
+from .card import ENTRY_FIELDS, PERCENTILE_SUFFIX, RANK_SUFFIX, BuilderCard, CardList
+from .models import PlayerStat
+
+# In-memory columnar engine for builder queries. Every PlayerStat of a season is
+# loaded once per process and data version into NumPy column arrays, then select,
+# filter and order expressions are evaluated as vectorized operations. SQLite
+# semantics are reproduced exactly: stats are read through the same CASTs as the
+# ORM path, division by zero is NULL (nan here), NULL never passes a comparison,
+# NULL sorts below every value, PlayerStat id breaks ties, and ranks and percentiles
+# are taken over the whole filtered set like the ORM path's window functions.
+
+COLUMN_FIELDS = stat_list + ["minutes_played"]
+CODE_FIELDS = ["id", "team__id", "team__league__league_id", "player__nationality__id", "position", "player__age"]
+ROW_FIELDS = ENTRY_FIELDS + ["team__league__name"]
+
+#################################
+#####     COLUMN STORE      #####
+#################################
+
+class ColumnStore:
+    __slots__ = ("codes", "columns", "rows")
+
+    def __init__(
+        self,
+        codes: Dict[str, Any],
+        columns: Dict[str, Any],
+        rows: List[Tuple[Any, ...]]
+    ) -> None:
+        # join codes and stat columns are NumPy arrays, rows hold the display fields
+        self.codes = codes
+        self.columns = columns
+        self.rows = rows
+
+    @classmethod
+    def load(cls, season_id: int) -> Any:
+        # one query for the whole season, stats cast to real exactly like the ORM path
+        queryset = PlayerStat.objects.filter(team__season__id=season_id).annotate(**{
+            f"column_{field}": Cast(F(field), FloatField()) for field in COLUMN_FIELDS
+        }).order_by("id")
+        values = list(queryset.values_list(
+            *CODE_FIELDS, *ROW_FIELDS, *[f"column_{field}" for field in COLUMN_FIELDS]
+        ))
+        num_codes, num_rows = len(CODE_FIELDS), len(ROW_FIELDS)
+        codes = {
+            field: np.array([row[i] for row in values], dtype=np.int64)
+            for i, field in enumerate(CODE_FIELDS)
+        }
+        columns = {
+            field: np.array([row[num_codes+num_rows+i] for row in values], dtype=np.float64)
+            for i, field in enumerate(COLUMN_FIELDS)
+        }
+        rows = [row[num_codes:num_codes+num_rows] for row in values]
+        return cls(codes, columns, rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def divide(self, numerator: Any, denominator: Any) -> Any:
+        # SQLite answers x/0 with NULL
+        with np.errstate(divide="ignore", invalid="ignore"):
+            quotient = numerator/denominator
+        quotient[denominator == 0] = np.nan
+        return quotient
+
+    def evaluate(self, stat: Dict[str, Union[str, bool]]) -> Any:
+        value = self.columns[stat["firstStat"]]
+        if stat["arithOp"] == "/":
+            value = self.divide(value, self.columns[stat["secondStat"]])
+        elif stat["arithOp"] == "*":
+            value = value*self.columns[stat["secondStat"]]
+        elif stat["arithOp"] == "+":
+            value = value+self.columns[stat["secondStat"]]
+        elif stat["arithOp"] == "-":
+            value = value-self.columns[stat["secondStat"]]
+        if stat["perNinety"] is True:
+            value = self.divide(value, self.columns["minutes_played"]/90.0)
+        return value
+
+def fits_column_store(season_id: int) -> bool:
+    # larger seasons are queried in SQLite instead of being loaded into memory
+    rows = get_row_stats()["seasons"].get(season_id, 0)
+    return rows <= getattr(settings, "BUILDER_COLUMNAR_MAX_ROWS", 200000)
+
+def get_column_store(season_id: int) -> ColumnStore:
+    return get_process_memo(f"columns-{season_id}", lambda: ColumnStore.load(season_id))
+
+#################################
+#####       QUERIES         #####
+#################################
+
+def comparison_mask(value: Any, data: Dict[str, str]) -> Any:
+    # mirrors `comparison_q`, comparisons with nan are always False like NULL in SQL
+    if data["logicalOp"] == "><":
+        return (value > float(data["firstVal"])) & (value < float(data["secondVal"]))
+    elif data["logicalOp"] == "<":
+        return value < float(data["firstVal"])
+    elif data["logicalOp"] == ">":
+        return value > float(data["firstVal"])
+    return np.ones(len(value), dtype=bool)
+
+def filter_mask(store: ColumnStore, post_data: Dict[str, Any]) -> Any:
+    # mirrors `get_query_filter`, the season is the store itself
+    mask = np.ones(len(store), dtype=bool)
+    if post_data["minutesPlayed"]["logicalOp"] != "":
+        mask &= comparison_mask(store.columns["minutes_played"], post_data["minutesPlayed"])
+    if post_data["age"]["logicalOp"] != "":
+        mask &= comparison_mask(store.codes["player__age"], post_data["age"])
+    if post_data["team"]["id"] != "":
+        mask &= store.codes["team__id"] == int(post_data["team"]["id"])
+    elif post_data["leagueId"] != "":
+        mask &= store.codes["team__league__league_id"] == int(post_data["leagueId"])
+    if post_data["country"] != "":
+        mask &= store.codes["player__nationality__id"] == int(post_data["country"])
+    if post_data["position"] != "":
+        mask &= store.codes["position"] == PlayerStat.get_position(post_data["position"])
+    for stat in post_data["filterStats"]:
+        if stat["firstStat"] == "" or stat["logicalOp"] == "":
+            continue
+        mask &= comparison_mask(store.evaluate(stat_shape(stat)), stat)
+    return mask
+
+def sort_keys(value: Any, desc: bool) -> Any:
+    # ascending sort keys with NULL below every value, like SQLite
+    sort_key = np.where(np.isnan(value), -np.inf, value)
+    return -sort_key if desc is True else sort_key
+
+def window_rank(value: Any, desc: bool) -> Any:
+    # RANK() over the whole filtered set: 1 + the number of rows ordered strictly before
+    sort_key = sort_keys(value, desc)
+    return np.searchsorted(np.sort(sort_key), sort_key, side="left") + 1
+
+def window_percent_rank(value: Any) -> Any:
+    # PERCENT_RANK() ordered low to high: (rank - 1)/(rows - 1), 0 for a single row
+    if len(value) < 2:
+        return np.zeros(len(value))
+    return (window_rank(value, False) - 1)/(len(value) - 1)
+
+def top_k(order_value: Any, ids: Any, desc: bool, k: int) -> Any:
+    # positions of the first k rows ordered by (order value, id), NULL below every value
+    sign = -1 if desc is True else 1
+    sort_key, sort_ids = sort_keys(order_value, desc), sign*ids
+    if len(sort_key) > k:
+        # keep everything up to the k-th value, including ties, before the exact sort
+        threshold = sort_key[np.argpartition(sort_key, k-1)[k-1]]
+        candidates = np.nonzero(sort_key <= threshold)[0]
+    else:
+        candidates = np.arange(len(sort_key))
+    order = np.lexsort((sort_ids[candidates], sort_key[candidates]))
+    return candidates[order][:k]
+
+def to_float(value: float) -> Union[float, None]:
+    return None if np.isnan(value) else float(value)
+
+def get_query_result(post_data: Dict[str, Any], limit: int = QUERY_RESULT_LIMIT) -> CardList:
+    shape = json.loads(get_query_shape(post_data))
+    store = get_column_store(int(post_data["seasonId"]))
+    indices = np.nonzero(filter_mask(store, post_data))[0]
+    order_value = store.evaluate(shape["orderBy"])[indices]
+    selected = top_k(order_value, store.codes["id"][indices], shape["desc"], limit)
+    columns = { "order_rank": window_rank(order_value, shape["desc"])[selected] }
+    header = []
+    for stat in shape["select"]:
+        field_name = get_comparison_field_name(stat)
+        if field_name in columns:
+            continue
+        value = store.evaluate(stat)[indices]
+        columns[field_name] = value[selected]
+        header.append(field_name)
+        if shape["percentiles"] is True:
+            columns[field_name + PERCENTILE_SUFFIX] = window_percent_rank(value)[selected]
+            columns[field_name + RANK_SUFFIX] = window_rank(value, True)[selected]
+            header += [field_name + PERCENTILE_SUFFIX, field_name + RANK_SUFFIX]
+    rows = []
+    for position, index in enumerate(indices[selected]):
+        row = dict(zip(ROW_FIELDS, store.rows[index]))
+        row["order_rank"] = int(columns["order_rank"][position])
+        for field_name in header:
+            row[field_name] = (
+                int(columns[field_name][position]) if field_name.endswith(RANK_SUFFIX)
+                else to_float(columns[field_name][position])
+            )
+        rows.append(row)
+    return CardList([BuilderCard(header=header, data=BuilderCard.format_rows(rows, header))])
@@ -0,0 +1,174 @@
+from django.conf import settings
+from django.db import OperationalError, connection
+from django.db.models import Count, QuerySet
+from contextlib import contextmanager
+import logging
+import math
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, TypeVar
+
+from .cache import get_process_memo
+from .models import PlayerStat
+
+# Cost guard for builder queries. Before a query runs, its cost is estimated from
+# SQLite's EXPLAIN QUERY PLAN and per-season row counts; queries over
+# `BUILDER_QUERY_MAX_COST` are rejected. Queries that do run get a wall-clock budget
+# of `BUILDER_QUERY_BUDGET` seconds, enforced by SQLite's progress handler, which
+# interrupts the statement once the budget is spent.
+
+# SQLite VM instructions between progress checks
+PROGRESS_STEPS = 1000
+# distinct query plans kept in the cost log
+COST_LOG_SIZE = 256
+
+T = TypeVar("T")
+
+class QueryBudgetError(Exception):
+    # the query is estimated to be too expensive, or ran out of its time budget
+    pass
+
+#################################
+#####    PROGRESS CHECKS    #####
+#################################
+
+# SQLite has one progress handler per connection, and Django keeps one connection
+# per thread, so nested checks (a job and the query budget inside it) share it
+progress_state = threading.local()
+
+def run_progress_checks() -> int:
+    # a non-zero return value interrupts the running statement
+    return 1 if any(check() for check in progress_state.checks) else 0
+
+@contextmanager
+def progress_check(check: Callable[[], bool]) -> Iterator[None]:
+    if connection.vendor != "sqlite":
+        yield
+        return
+    connection.ensure_connection()
+    raw_connection = connection.connection
+    if not hasattr(progress_state, "checks"):
+        progress_state.checks = []
+    progress_state.checks.append(check)
+    raw_connection.set_progress_handler(run_progress_checks, PROGRESS_STEPS)
+    try:
+        yield
+    finally:
+        progress_state.checks.remove(check)
+        if len(progress_state.checks) == 0:
+            raw_connection.set_progress_handler(None, 0)
+
+#################################
+#####    COST ESTIMATES     #####
+#################################
+
+class QueryCost:
+    __slots__ = ("rows", "expressions", "sorts", "full_scan", "cost")
+
+    def __init__(self, rows: int, expressions: int, sorts: int, full_scan: bool) -> None:
+        self.rows = rows
+        self.expressions = expressions
+        self.sorts = sorts
+        self.full_scan = full_scan
+        # every visited row evaluates every annotation, every temp b-tree sorts the rows
+        self.cost = rows*(1 + expressions) + sorts*rows*math.log2(rows + 1)
+
+    def __repr__(self) -> str:
+        return (
+            f"QueryCost(cost={self.cost:.0f}, rows={self.rows}, expressions={self.expressions}, "
+            f"sorts={self.sorts}, full_scan={self.full_scan})"
+        )
+
+def load_row_stats() -> Dict[str, Any]:
+    seasons = dict(PlayerStat.objects.order_by().values_list("team__season__id").annotate(rows=Count("id")))
+    return { "playerstats": sum(seasons.values()), "seasons": seasons }
+
+def get_row_stats() -> Dict[str, Any]:
+    return get_process_memo("row-stats", load_row_stats)
+
+def explain_query_plan(queryset: QuerySet) -> List[str]:
+    # the detail column of every EXPLAIN QUERY PLAN step
+    if connection.vendor != "sqlite":
+        return []
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        return [row[-1] for row in cursor.fetchall()]
+
+def estimate_query_cost(queryset: QuerySet, season_id: int) -> QueryCost:
+    row_stats = get_row_stats()
+    # the season filter normally reaches PlayerStat through the team index
+    rows = row_stats["seasons"].get(season_id, 0)
+    full_scan, sorts = False, 0
+    scan = re.compile(rf"SCAN (TABLE )?{PlayerStat._meta.db_table}\b")
+    for detail in explain_query_plan(queryset):
+        if scan.match(detail):
+            full_scan = True
+            rows = row_stats["playerstats"]
+        elif "TEMP B-TREE" in detail:
+            sorts += 1
+    return QueryCost(rows, len(queryset.query.annotations), sorts, full_scan)
+
+def check_query_cost(cost: QueryCost) -> None:
+    if cost.cost > getattr(settings, "BUILDER_QUERY_MAX_COST", 5e6):
+        raise QueryBudgetError("Query is too expensive, add filters or use fewer computed stats")
+
+#################################
+#####       COST LOG        #####
+#################################
+
+# per query plan: estimated cost, timings and outcomes, for tuning the limits
+cost_log: Dict[str, Dict[str, Any]] = {}
+cost_log_lock = threading.Lock()
+
+def log_query_cost(plan_key: str, cost: QueryCost, elapsed_ms: float, outcome: str) -> None:
+    with cost_log_lock:
+        entry = cost_log.pop(plan_key, None)
+        if entry is None:
+            entry = { "cost": 0.0, "runs": 0, "total_ms": 0.0, "max_ms": 0.0, "rejected": 0, "interrupted": 0 }
+            if len(cost_log) >= COST_LOG_SIZE:
+                # drop the least recently logged plan
+                del cost_log[next(iter(cost_log))]
+        entry["cost"] = cost.cost
+        if outcome == "done":
+            entry["runs"] += 1
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+        else:
+            entry[outcome] += 1
+        cost_log[plan_key] = entry
+    logging.info(f"Builder query {outcome}: {cost!r}, {elapsed_ms:.1f}ms.")
+
+def get_cost_log() -> Dict[str, Dict[str, Any]]:
+    with cost_log_lock:
+        return { plan_key: dict(entry) for plan_key, entry in cost_log.items() }
+
+def clear_cost_log() -> None:
+    with cost_log_lock:
+        cost_log.clear()
+
+#################################
+#####     QUERY BUDGET      #####
+#################################
+
+def run_with_budget(plan_key: str, cost: QueryCost, run: Callable[[], T]) -> T:
+    try:
+        check_query_cost(cost)
+    except QueryBudgetError:
+        log_query_cost(plan_key, cost, 0.0, "rejected")
+        raise
+    budget = getattr(settings, "BUILDER_QUERY_BUDGET", 10.0)
+    start = time.monotonic()
+    deadline = start + budget
+    try:
+        with progress_check(lambda: time.monotonic() > deadline):
+            result = run()
+    except OperationalError as e:
+        # interrupts by an enclosing check (e.g. a cancelled job) are not ours to report
+        if time.monotonic() <= deadline:
+            raise
+        log_query_cost(plan_key, cost, (time.monotonic() - start)*1000, "interrupted")
+        raise QueryBudgetError(f"Query took longer than {budget:g}s") from e
+    log_query_cost(plan_key, cost, (time.monotonic() - start)*1000, "done")
+    return result
@@ -0,0 +1,260 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import OperationalError, connection
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterator, Union
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .builder import get_cached_query_result, query_fingerprint
+from .guard import QueryBudgetError, progress_check
+
+# Builder queries run as jobs on a small per-process thread pool, so a wide query does
+# not hold a web worker for its whole duration. The job itself runs in the process that
+# queued it, but its record (state, submitters, cancellation) lives in the file-based
+# `jobs` cache and its result in the file-based `builder` cache, so any worker process
+# can answer the status polls, cancels and page reloads that follow.
+
+# job states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TIMEOUT = "timeout"
+FINISHED_STATES = [DONE, FAILED, CANCELLED, TIMEOUT]
+# finished jobs are kept this many seconds for polling clients
+JOB_RETENTION = 300
+# seconds between reads of the shared record by a running job, to notice cancels
+# made through another process
+CANCEL_CHECK_INTERVAL = 0.25
+
+job_cache = caches["jobs"]
+
+#################################
+#####      JOB RECORDS      #####
+#################################
+
+def job_key(job_id: str) -> str:
+    return f"job-{job_id}"
+
+def fingerprint_key(fingerprint: str) -> str:
+    return f"fingerprint-{fingerprint}"
+
+@contextmanager
+def records_lock() -> Iterator[None]:
+    # records are read, changed and written back by every worker process, so changes
+    # hold a lock on a file next to the cache (only the thread lock without fcntl)
+    with jobs_lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(settings.BUILDER_CACHE_DIR, exist_ok=True)
+        with open(os.path.join(settings.BUILDER_CACHE_DIR, "jobs.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def is_active(record: Union[Dict[str, Any], None]) -> bool:
+    # queued or running, and not left behind by a process that died mid-job
+    return (
+        record is not None and record["state"] in [PENDING, RUNNING]
+        and not record["cancelled"] and time.time() <= record["deadline"]
+    )
+
+def record_status(job_id: str, record: Dict[str, Any]) -> Dict[str, Any]:
+    state = record["state"]
+    if state in [PENDING, RUNNING] and time.time() > record["deadline"]:
+        state = TIMEOUT
+    return {
+        "job": job_id,
+        "status": state,
+        "error": record["error"],
+        "elapsed": round(time.time() - record["submitted_at"], 3),
+    }
+
+def update_record(job_id: str, **changes: Any) -> Union[Dict[str, Any], None]:
+    with records_lock():
+        record = job_cache.get(job_key(job_id))
+        if record is None:
+            return None
+        record.update(changes)
+        save_record(job_id, record)
+    return record
+
+def save_record(job_id: str, record: Dict[str, Any]) -> None:
+    # called with `records_lock` held
+    job_cache.set(job_key(job_id), record, timeout=JOB_RETENTION)
+    if not is_active(record) and job_cache.get(fingerprint_key(record["fingerprint"])) == job_id:
+        # later submits of the same query start a new job
+        job_cache.delete(fingerprint_key(record["fingerprint"]))
+
+#################################
+#####         JOBS          #####
+#################################
+
+class Job:
+    __slots__ = ("id", "fingerprint", "post_data", "state", "error", "deadline", "cancelled", "checked_at", "future")
+
+    def __init__(self, post_data: Dict[str, Any], timeout: float) -> None:
+        self.id = uuid.uuid4().hex
+        self.fingerprint = query_fingerprint(post_data)
+        self.post_data = post_data
+        self.state = PENDING
+        self.error = None
+        # the timeout counts from submission, so queued jobs cannot wait forever
+        self.deadline = time.monotonic() + timeout
+        self.cancelled = threading.Event()
+        self.checked_at = 0.0
+        self.future: Union[Future, None] = None
+
+    def record(self, timeout: float) -> Dict[str, Any]:
+        submitted_at = time.time()
+        return {
+            "fingerprint": self.fingerprint,
+            "state": self.state,
+            "error": self.error,
+            "submitted_at": submitted_at,
+            "deadline": submitted_at + timeout,
+            "submitters": 1,
+            "cancelled": False,
+        }
+
+    def stop_reason(self) -> Union[str, None]:
+        now = time.monotonic()
+        if not self.cancelled.is_set() and now - self.checked_at > CANCEL_CHECK_INTERVAL:
+            self.checked_at = now
+            record = job_cache.get(job_key(self.id))
+            if record is not None and record["cancelled"]:
+                self.cancelled.set()
+        if self.cancelled.is_set():
+            return CANCELLED
+        elif now > self.deadline:
+            return TIMEOUT
+        return None
+
+    def should_stop(self) -> bool:
+        return self.stop_reason() is not None
+
+    def save(self) -> None:
+        update_record(self.id, state=self.state, error=self.error)
+
+    def run(self) -> None:
+        try:
+            self.execute()
+        finally:
+            self.save()
+            # worker threads must not keep connections open between jobs
+            connection.close()
+
+    def execute(self) -> None:
+        if self.should_stop():
+            self.state = self.stop_reason()
+            return
+        self.state = RUNNING
+        self.save()
+        try:
+            # abort the running statement as soon as the job is cancelled or times out
+            with progress_check(self.should_stop):
+                # the result lands in the builder result cache, where the builder page reads it
+                get_cached_query_result(self.post_data)
+            self.state = DONE
+        except QueryBudgetError as e:
+            self.state = FAILED
+            self.error = str(e)
+        except OperationalError as e:
+            # an interrupted statement surfaces as an OperationalError too
+            reason = self.stop_reason()
+            if reason is not None:
+                self.state = reason
+                self.error = "Query took too long" if reason == TIMEOUT else None
+            else:
+                self.state = FAILED
+                self.error = "Query failed"
+                logging.warning(f"Builder job '{self.id}' failed.\n\tException: {e}")
+        except Exception as e:
+            self.state = FAILED
+            self.error = "Query failed"
+            logging.exception(f"Builder job '{self.id}' failed.\n\tException: {e}")
+
+#################################
+#####       JOB POOL        #####
+#################################
+
+# jobs run by this process, by id
+jobs: Dict[str, Job] = {}
+jobs_lock = threading.RLock()
+executor: Union[ThreadPoolExecutor, None] = None
+
+def get_executor() -> ThreadPoolExecutor:
+    global executor
+    if executor is None:
+        executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, "BUILDER_JOB_WORKERS", 2),
+            thread_name_prefix="builder-job"
+        )
+    return executor
+
+def prune_jobs() -> None:
+    # called with `jobs_lock` held
+    for job_id in [job_id for job_id, job in jobs.items() if job.future is not None and job.future.done()]:
+        del jobs[job_id]
+
+def submit_query_job(post_data: Dict[str, Any]) -> str:
+    fingerprint = query_fingerprint(post_data)
+    timeout = getattr(settings, "BUILDER_JOB_TIMEOUT", 30.0)
+    with records_lock():
+        prune_jobs()
+        # identical queries that are still queued or running share one job, which
+        # is only cancelled once every submitter has cancelled it
+        job_id = job_cache.get(fingerprint_key(fingerprint))
+        record = job_cache.get(job_key(job_id)) if job_id is not None else None
+        if is_active(record):
+            record["submitters"] += 1
+            save_record(job_id, record)
+            return job_id
+        job = Job(post_data, timeout)
+        job_cache.set(job_key(job.id), job.record(timeout), timeout=JOB_RETENTION)
+        job_cache.set(fingerprint_key(fingerprint), job.id, timeout=JOB_RETENTION)
+        jobs[job.id] = job
+        job.future = get_executor().submit(job.run)
+    return job.id
+
+def get_job(job_id: str) -> Union[Dict[str, Any], None]:
+    # status of a job run by any process
+    record = job_cache.get(job_key(job_id))
+    return record_status(job_id, record) if record is not None else None
+
+def cancel_job(job_id: str) -> Union[Dict[str, Any], None]:
+    with records_lock():
+        record = job_cache.get(job_key(job_id))
+        if record is None:
+            return None
+        if record["state"] in [PENDING, RUNNING] and not record["cancelled"]:
+            record["submitters"] -= 1
+            record["cancelled"] = record["submitters"] <= 0
+            save_record(job_id, record)
+        job = jobs.get(job_id)
+    if record["cancelled"] and job is not None:
+        job.cancelled.set()
+        # jobs that have not started are dropped from the queue, running ones are
+        # interrupted by their progress handler, also when run by another process
+        if job.future is not None and job.future.cancel():
+            job.state = CANCELLED
+            record = update_record(job_id, state=CANCELLED) or record
+    return record_status(job_id, record)
+
+def clear_jobs() -> None:
+    with records_lock():
+        job_cache.clear()
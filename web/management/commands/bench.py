@@ -0,0 +1,229 @@
+# admin stuff
+from django.core.management.base import BaseCommand
+from django.contrib.sessions.backends.db import SessionStore
+from django.test import RequestFactory
+# python libraries
+import logging
+import pickle
+import time
+import tracemalloc
+from typing import Any, Callable, Dict
+# project imports
+from web.builder import (
+    QueryPlan, clear_builder_cache, compile_query_shape, get_builder_cache_stats, get_cached_query_result,
+    get_query_cost, get_query_result
+)
+from web.card_data import (
+    clear_cache, get_card_data, get_card_fragments, get_from_cache, render_card_list, warm_card_cache
+)
+from web.guard import clear_cost_log, get_cost_log
+from web.models import Season, League
+from web.views import dashboard
+
+
+class DictCardEntry:
+    # baseline for the card-cache routine: a card entry keeping its attributes in a
+    # per-instance __dict__, as entries did before they were slotted
+    def __init__(self, entry: Any) -> None:
+        for cls in type(entry).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                setattr(self, name, getattr(entry, name))
+
+def loaded_size(pickled: bytes) -> int:
+    # bytes allocated by unpickling
+    tracemalloc.start()
+    loaded = pickle.loads(pickled)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del loaded
+    return size
+
+
+class Command(BaseCommand):
+    help="benchmarks for cached dashboard data and rendering"
+
+    def add_arguments(self, parser):
+
+        parser.add_argument(
+            "routine",
+            choices=["card-cache", "template", "builder", "plan", "columnar", "cost"],
+            help="""card-cache: warm every dashboard card variant and report the cache footprint.
+                template: time warm dashboard renders with and without the card fragment cache.
+                builder: time a StatBuilder query with and without the builder result cache.
+                plan: time StatBuilder query plan compilation and execution.
+                columnar: time a StatBuilder query on the ORM and the columnar engine.
+                cost: report the estimated cost and timings of StatBuilder query plans."""
+        )
+
+        parser.add_argument(
+            "-n",
+            "--iterations",
+            type=int,
+            default=50,
+            help="Number of timed iterations"
+        )
+
+    def handle(self, *args, **options):
+        logging.basicConfig(level=logging.WARNING)
+        self.iterations = options["iterations"]
+        routines = {
+            "card-cache": self.card_cache,
+            "template": self.template,
+            "builder": self.builder,
+            "plan": self.plan,
+            "columnar": self.columnar,
+            "cost": self.cost,
+        }
+        routines[options["routine"]]()
+
+    def time_ms(self, func: Callable[[], Any]) -> float:
+        start = time.perf_counter()
+        for _ in range(self.iterations):
+            func()
+        return (time.perf_counter() - start)*1000/self.iterations
+
+    ######## ROUTINES ########
+
+    def card_cache(self) -> None:
+        """ method to report the memory footprint of a fully warmed card cache """
+        clear_cache()
+        timings = warm_card_cache()
+        variants = [
+            (season, per_ninety, league)
+            for season in Season.objects.all()
+            for league in [None] + list(League.objects.all())
+            for per_ninety in [False, True]
+        ]
+        # size of the serialized variants held by the cache backend
+        pickled_bytes = sum(
+            len(pickle.dumps(get_from_cache(*variant), pickle.HIGHEST_PROTOCOL))
+            for variant in variants
+        )
+        # size of the card objects once every variant has been loaded from the cache
+        tracemalloc.start()
+        loaded = [get_from_cache(*variant) for variant in variants]
+        loaded_bytes, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        num_entries = sum(
+            len(card.data)
+            for card_data in loaded for card_list in card_data for card in card_list.cards
+        )
+        self.stdout.write(f"variants:       {len(variants)}")
+        self.stdout.write(f"entries:        {num_entries}")
+        self.stdout.write(f"warm time:      {sum(t for _, t in timings):.2f}s")
+        self.stdout.write(f"pickled size:   {pickled_bytes/1024:.1f} KiB ({pickled_bytes/max(num_entries, 1):.0f} B/entry)")
+        self.stdout.write(f"loaded size:    {loaded_bytes/1024:.1f} KiB ({loaded_bytes/max(num_entries, 1):.0f} B/entry)")
+        # the same entries as slotted records and as __dict__ instances
+        entries = [
+            entry
+            for card_data in loaded for card_list in card_data for card in card_list.cards for entry in card.data
+        ]
+        for name, layout in [("slotted", entries), ("dict-based", [DictCardEntry(entry) for entry in entries])]:
+            pickled = pickle.dumps(layout, pickle.HIGHEST_PROTOCOL)
+            self.stdout.write(
+                f"{name+':':<16}{len(pickled)/max(num_entries, 1):.0f} B/entry pickled, "
+                f"{loaded_size(pickled)/max(num_entries, 1):.0f} B/entry loaded"
+            )
+
+    def template(self) -> None:
+        """ method to time warm dashboard renders with and without the card fragment cache """
+        season = Season.objects.order_by("-start_year")[0]
+        # make sure both the card data and the rendered fragments are cached
+        clear_cache()
+        get_card_fragments(season, False)
+        # warm request before fragments: every card list is rendered from cached card data
+        render_ms = self.time_ms(lambda: [
+            render_card_list(card_list, season) for card_list in get_card_data(season, False)
+        ])
+        # warm request with fragments: rendered card lists are read from the fragment cache
+        fragment_ms = self.time_ms(lambda: get_card_fragments(season, False))
+        # whole dashboard view, fragments cached
+        request = RequestFactory().get(f"/dashboard/{season.start_year}")
+        request.session = SessionStore()
+        view_ms = self.time_ms(lambda: dashboard(request, season.start_year))
+        self.stdout.write(f"card lists rendered from card cache:  {render_ms:.2f}ms")
+        self.stdout.write(f"card lists read from fragment cache:  {fragment_ms:.2f}ms")
+        self.stdout.write(f"dashboard view with cached fragments: {view_ms:.2f}ms")
+
+    def builder_post_data(self) -> Dict[str, Any]:
+        season = Season.objects.order_by("-start_year")[0]
+        stat = lambda first_stat="", **kwargs: dict(
+            { "firstStat": first_stat, "arithOp": "", "secondStat": "", "perNinety": False }, **kwargs
+        )
+        comparison = { "logicalOp": "", "firstVal": "", "secondVal": "" }
+        return {
+            "seasonId": str(season.id),
+            "selectStats": [stat("goals", perNinety=True), stat("shots", arithOp="/", secondStat="goals"), stat()],
+            "leagueId": "",
+            "team": { "id": "", "leagueId": "" },
+            "minutesPlayed": { "logicalOp": ">", "firstVal": "900", "secondVal": "" },
+            "age": dict(comparison),
+            "filterStats": [
+                stat("shots", perNinety=True, logicalOp=">", firstVal="1", secondVal=""),
+                stat("passes", arithOp="-", secondStat="passes_key", logicalOp=">", firstVal="100", secondVal=""),
+                stat(**comparison),
+            ],
+            "country": "",
+            "position": "",
+            "orderByStat": stat(lowToHigh=False),
+        }
+
+    def builder(self) -> None:
+        """ method to time a StatBuilder query with and without the builder result cache """
+        post_data = self.builder_post_data()
+        clear_builder_cache()
+        uncached_ms = self.time_ms(lambda: get_query_result(post_data))
+        cached_ms = self.time_ms(lambda: get_cached_query_result(post_data))
+        stats = get_builder_cache_stats()
+        self.stdout.write(f"query without result cache: {uncached_ms:.2f}ms")
+        self.stdout.write(f"query with result cache:    {cached_ms:.2f}ms")
+        self.stdout.write(f"hits: {stats['hits']}, misses: {stats['misses']}")
+
+    def plan(self) -> None:
+        """ method to time StatBuilder query plan compilation and execution """
+        post_data = self.builder_post_data()
+        # compile: build the plan and its SQL, with and without a cached query shape
+        compile_sql = lambda: QueryPlan.compile(post_data).queryset().query.sql_with_params()
+        def cold_compile():
+            compile_query_shape.cache_clear()
+            compile_sql()
+        cold_ms = self.time_ms(cold_compile)
+        warm_ms = self.time_ms(compile_sql)
+        # execute: run the query and build the result card
+        plan = QueryPlan.compile(post_data)
+        execute_ms = self.time_ms(plan.execute)
+        self.stdout.write(f"compile, new query shape:    {cold_ms:.3f}ms")
+        self.stdout.write(f"compile, cached query shape: {warm_ms:.3f}ms")
+        self.stdout.write(f"execute:                     {execute_ms:.3f}ms")
+
+    def columnar(self) -> None:
+        """ method to time a StatBuilder query on the ORM and the columnar engine """
+        from web import columnar
+        if columnar.np is None:
+            self.stdout.write("NumPy is not installed.")
+            return
+        post_data = self.builder_post_data()
+        orm_ms = self.time_ms(lambda: QueryPlan.compile(post_data).execute())
+        start = time.perf_counter()
+        columnar.get_column_store(int(post_data["seasonId"]))
+        load_ms = (time.perf_counter() - start)*1000
+        columnar_ms = self.time_ms(lambda: columnar.get_query_result(post_data))
+        self.stdout.write(f"orm engine:            {orm_ms:.2f}ms")
+        self.stdout.write(f"columnar season load:  {load_ms:.2f}ms")
+        self.stdout.write(f"columnar engine:       {columnar_ms:.2f}ms")
+
+    def cost(self) -> None:
+        """ method to report the estimated cost and timings of StatBuilder query plans """
+        post_data = self.builder_post_data()
+        # the same query with and without its filters, so the estimates can be compared
+        unfiltered = dict(post_data, minutesPlayed=dict(post_data["age"]), filterStats=[])
+        clear_cost_log()
+        for query in [post_data, unfiltered]:
+            self.stdout.write(repr(get_query_cost(QueryPlan.compile(query), query)))
+            self.time_ms(lambda: get_query_result(query))
+        for plan_key, entry in get_cost_log().items():
+            mean_ms = entry["total_ms"]/max(entry["runs"], 1)
+            self.stdout.write(
+                f"cost {entry['cost']:>12.0f}  runs {entry['runs']:>4}  mean {mean_ms:.2f}ms  "
+                f"max {entry['max_ms']:.2f}ms  rejected {entry['rejected']}  interrupted {entry['interrupted']}"
+            )
@@ -8,7 +8,13 @@ from typing import Dict, List, Union, Tuple
 # project imports 
 from .helpers.api import Request, Json
 from .helpers.config import initial_league_ids, LogLevel
-from web.models import Season, Country, League, Team, Player, PlayerStat
+from web.cache import bump_data_version
+from web.card_data import build_leaderboards, build_player_profiles, warm_card_cache
+from web.models import Season, Country, League, LeaderboardEntry, Team, Player, PlayerStat
+from web.queryset import build_stat_summaries
+from web.search import (
+    build_name_index, ensure_name_index, index_league, index_player, index_team, update_name_index_minutes
+)
 
 
 class Command(BaseCommand):
@@ -18,9 +24,13 @@ class Command(BaseCommand):
         
         parser.add_argument(
             "routine",
-            choices=["update-db", "new-season"],
+            choices=["update-db", "new-season", "build-leaderboards", "build-profiles", "warm-cache", "build-search-index"],
             help="""new-season: add new season to DB and update countries. Takes requried -s/--start-year argument.
-                update-db: update leagues, teams, players, and player stats. Takes optional -s/--start-year argument."""
+                update-db: update leagues, teams, players, and player stats. Takes optional -s/--start-year argument.
+                build-leaderboards: rebuild stat summaries and materialized dashboard leaderboards. Takes optional -s/--start-year argument, defaults to all seasons.
+                build-profiles: normalize player heights/weights and rebuild materialized player profiles. Takes optional -s/--start-year argument, defaults to all seasons.
+                warm-cache: materialize leaderboards for seasons that have none, then build every dashboard card variant and report per-variant build times. Takes optional -s/--start-year argument, defaults to all seasons.
+                build-search-index: rebuild the full-text name index for players, teams, and leagues."""
         )
 
         parser.add_argument(
@@ -61,20 +71,33 @@ class Command(BaseCommand):
         # ensure that `start_year` is not None if routine is `new-season`
         if routine_str == "new-season" and start_year is None:
             raise AssertionError(f"manage.py db_utils: error: routine 'new-season' missing the following required arguments: -s/--start-year")
-        # ensure that routine is either `new-season` or `update-db`
-        if routine_str not in ["new-season", "update-db"]:
+        # ensure that routine is either `new-season`, `update-db`, `build-leaderboards`, `build-profiles`, `warm-cache`, or `build-search-index`
+        routines = {
+            "new-season": self.new_season,
+            "update-db": self.update_db,
+            "build-leaderboards": self.build_leaderboards,
+            "build-profiles": self.build_profiles,
+            "warm-cache": self.warm_cache,
+            "build-search-index": self.build_search_index,
+        }
+        if routine_str not in routines:
             raise AssertionError(f"manage.py db_utils: error: unrecognized value ('{routine_str}') provided for following arguments: routine")
         # and call routine with appropriate arguments
-        routine = self.new_season if routine_str == "new-season" else self.update_db
+        routine = routines[routine_str]
         if start_year is not None:
             routine(int(start_year))
         else:
             routine()
+        # invalidate cached data in every worker now that the ingest has committed, `warm-cache`
+        # only adds leaderboards equal to what workers already compute, so their caches stay valid
+        if routine_str != "warm-cache":
+            bump_data_version()
     
     ######## ROUTINES ########
 
     def new_season(self, start_year: int) -> None:
         """ method to add new season to DB and update countries """
+        ensure_name_index() # new leagues and teams are added to the name index as they are created
         season_object = self.add_season(start_year)
         self.add_countries() # check whether there are any new countries in database this season
         self.add_leagues(season_object, initial_league_ids) # add leagues to DB from API
@@ -88,10 +111,55 @@ class Command(BaseCommand):
             if len(seasons) == 0:
                 raise AssertionError(f"manage.py db_utils: error: routine 'new-season' must be run prior to 'update-db'.")
             start_year = seasons[0].start_year
+        ensure_name_index() # new players are added to the name index as they are created
         season_object = self.add_season(start_year)
         league_ids = [ league.league_id for league in League.objects.all() ]
         team_ids = list( set( [ team.team_id for team in Team.objects.filter(season=season_object) ] ) )
         self.update_players(season_object, team_ids, league_ids) # add players to and update player stats in DB from API
+        update_name_index_minutes() # rank search results by the updated minutes played
+        self.build_leaderboards(start_year) # summarize stats and materialize dashboard leaderboards for the updated season
+        self.build_profiles(start_year) # materialize the profiles of the updated season's players
+
+    def build_leaderboards(self, start_year: Union[int, None] = None) -> None:
+        """ method to rebuild stat summaries and materialized dashboard leaderboards for one or all seasons """
+        seasons = Season.objects.all() if start_year is None else Season.objects.filter(start_year=start_year)
+        if len(seasons) == 0:
+            raise AssertionError(f"manage.py db_utils: error: no Season objects found to build leaderboards for.")
+        for season_object in seasons:
+            # leaderboard qualification thresholds are read from the stat summaries
+            summaries_created: int = build_stat_summaries(season_object)
+            logging.info(f"{summaries_created} StatSummary objects created for Season '{season_object.start_year}'.")
+            entries_created: int = build_leaderboards(season_object)
+            logging.info(f"{entries_created} LeaderboardEntry objects created for Season '{season_object.start_year}'.")
+
+    def build_profiles(self, start_year: Union[int, None] = None) -> None:
+        """ method to normalize player heights/weights and rebuild player profiles for one or all seasons """
+        players_updated: int = self.normalize_measurements()
+        logging.info(f"{players_updated} Player heights/weights normalized.")
+        seasons = [None] if start_year is None else Season.objects.filter(start_year=start_year)
+        if len(seasons) == 0:
+            raise AssertionError(f"manage.py db_utils: error: no Season objects found to build profiles for.")
+        for season_object in seasons:
+            profiles_built: int = build_player_profiles(season_object)
+            logging.info(f"{profiles_built} PlayerProfile objects built.")
+
+    def warm_cache(self, start_year: Union[int, None] = None) -> None:
+        """ method to materialize missing leaderboards and time every dashboard card variant """
+        seasons = Season.objects.all() if start_year is None else Season.objects.filter(start_year=start_year)
+        if len(seasons) == 0:
+            raise AssertionError(f"manage.py db_utils: error: no Season objects found to warm the cache for.")
+        # the card caches live in each worker's memory, so what this process can share with
+        # them is the leaderboard table every cold variant is read from in one query
+        for season_object in seasons:
+            if not LeaderboardEntry.objects.filter(season=season_object).exists():
+                self.build_leaderboards(season_object.start_year)
+        for key, elapsed in warm_card_cache(list(seasons)):
+            self.stdout.write(f"{key}: {elapsed*1000:.1f}ms")
+
+    def build_search_index(self, start_year: Union[int, None] = None) -> None:
+        """ method to rebuild the full-text name index for players, teams, and leagues of every season """
+        names_indexed: int = build_name_index()
+        logging.info(f"{names_indexed} names added to the search index.")
 
     ######## SEASON FUNCTION ########
 
@@ -166,13 +234,17 @@ class Command(BaseCommand):
             logging.error("League response dictionary does not contain at least one of the following keys: 'league.id/name/type/logo'.")
         # check if league is already in DB.
         # if league is not in League model, add it, else, do nothing 
-        return League.objects.get_or_create(
+        league_object: League
+        league_object, created = League.objects.get_or_create(
             league_id=league["league"]["id"],
             name=league["league"]["name"].lower(),
             league_type=league["league"]["type"].lower(), 
             logo=league["league"]["logo"].lower(), 
             country=country_object
         )
+        if created:
+            index_league(league_object)
+        return league_object, created
 
     def add_leagues(self, season_object: Season, league_ids: List[int]) -> None:
         league_response: List[Json] = Request(
@@ -214,13 +286,18 @@ class Command(BaseCommand):
             logging.error("Team response dictionary does not contain key 'team' and/or 'team.id/name/logo'.")
         # check if team is already in DB
         # if team is not in Team model, add it, else, do nothing
-        return Team.objects.get_or_create(
+        team_object: Team
+        created: bool
+        team_object, created = Team.objects.get_or_create(
             team_id=team["team"]["id"],
             name=team["team"]["name"].lower(),
             logo=team["team"]["logo"].lower(),
             season=season_object,
             league=league_object
         )
+        if created:
+            index_team(team_object)
+        return team_object, created
 
     def add_teams(
         self, 
@@ -305,6 +382,20 @@ class Command(BaseCommand):
                 except:
                     logging.error(f"Invalid date format encountered: '{date_str}'.")
 
+    def normalize_measurements(self) -> int:
+        # players ingested before heights/weights were parsed at ingest. Only raw values
+        # that parse are selected, so unparseable ones are not read again on every run
+        players: List[Player] = list(Player.objects.filter(
+            height_cm__isnull=True, height__regex=Player.MEASUREMENT_PATTERN
+        ) | Player.objects.filter(
+            weight_kg__isnull=True, weight__regex=Player.MEASUREMENT_PATTERN
+        ))
+        for player_object in players:
+            player_object.height_cm = Player.parse_measurement(player_object.height)
+            player_object.weight_kg = Player.parse_measurement(player_object.weight)
+        Player.objects.bulk_update(players, ["height_cm", "weight_kg"], batch_size=500)
+        return len(players)
+
     def update_player(self, player: Json) -> Tuple[Player, bool]:
         # ensure necessary keys exist in API response
         if ( 
@@ -330,7 +421,8 @@ class Command(BaseCommand):
             logging.info(f"New Country object '{player['nationality'].lower()}' encountered and created.")
         # check if player is already in DB,, if it is not, add it
         birthdate: date = self.handle_birthdate(player["birth"]["date"])
-        return Player.objects.get_or_create(
+        player_object: Player
+        player_object, created = Player.objects.get_or_create(
             player_id=player["id"],
             first_name=player["firstname"].lower(),
             last_name=player["lastname"].lower(),
@@ -338,8 +430,15 @@ class Command(BaseCommand):
             height=player["height"].lower() if player["height"] is not None else None,
             weight=player["weight"].lower() if player["weight"] is not None else None,
             nationality=country_object,
-            birthdate=birthdate
+            birthdate=birthdate,
+            defaults={
+                "height_cm": Player.parse_measurement(player["height"]),
+                "weight_kg": Player.parse_measurement(player["weight"]),
+            }
         )
+        if created:
+            index_player(player_object)
+        return player_object, created
 
     def update_players(
         self, 
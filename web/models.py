@@ -1,5 +1,7 @@
 from django.db import models
 from datetime import *
+import re
+from typing import Union
 
 class Season(models.Model):
     start_year = models.IntegerField(unique=True)
@@ -41,11 +43,23 @@ class Player(models.Model):
     age = models.IntegerField()
     height = models.CharField(max_length=10, null=True)
     weight = models.CharField(max_length=10, null=True)
+    # `height`/`weight` parsed at ingest
+    height_cm = models.FloatField(null=True)
+    weight_kg = models.FloatField(null=True)
     birthdate = models.DateField(null=True)
     nationality = models.ForeignKey(Country, related_name="players", on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # raw measurements that `parse_measurement` turns into a number
+    MEASUREMENT_PATTERN = r"^\s*\d"
+
+    @classmethod
+    def parse_measurement(cls, measurement: Union[str, None]) -> Union[float, None]:
+        # "180 cm" -> 180.0, "75 kg" -> 75.0
+        match = re.match(r"\s*(\d+(\.\d+)?)", measurement) if measurement is not None else None
+        return float(match.group(1)) if match is not None else None
+
 class PlayerStat(models.Model):
     PCT_STATS = [
         ["passes_accuracy", "Pass Accuracy"],
@@ -150,4 +164,61 @@ class PlayerStat(models.Model):
         for n, position in cls.POSITIONS:
             if position == position_string.lower():
                 return n
-        return cls.DEFAULT_POSITION
\ No newline at end of file
+        return cls.DEFAULT_POSITION
+
+class StatSummary(models.Model):
+    # distribution of a PlayerStat column per season/league/position, rebuilt by `db_utils` after every ingest
+    class Meta:
+        indexes = [ models.Index(fields=["season", "league", "position", "field"]) ]
+    season = models.ForeignKey(Season, related_name="stat_summaries", on_delete=models.CASCADE)
+    # null for the Top 5 leagues
+    league = models.ForeignKey(League, related_name="stat_summaries", null=True, on_delete=models.CASCADE)
+    # null for all positions
+    position = models.PositiveSmallIntegerField(null=True, choices=PlayerStat.POSITIONS)
+    field = models.CharField(max_length=63)
+    count = models.IntegerField()
+    max_value = models.FloatField()
+    p25 = models.FloatField()
+    p50 = models.FloatField()
+    p75 = models.FloatField()
+    p90 = models.FloatField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+class LeaderboardEntry(models.Model):
+    # materialized dashboard leaderboards, rebuilt by `db_utils` after every ingest
+    class Meta:
+        # django compares boolean columns without an operator, so `per_ninety` trails
+        # the index and the (season, league) range scan comes back already ordered
+        indexes = [ models.Index(fields=["season", "league", "card_list", "card", "row", "per_ninety"]) ]
+    season = models.ForeignKey(Season, related_name="leaderboard_entries", on_delete=models.CASCADE)
+    # null for the Top 5 leagues dashboard
+    league = models.ForeignKey(League, related_name="leaderboard_entries", null=True, on_delete=models.CASCADE)
+    per_ninety = models.BooleanField()
+    # position of the card in `web.card_data.DASHBOARD_CARDS`
+    card_list = models.PositiveSmallIntegerField()
+    card = models.PositiveSmallIntegerField()
+    # position of the entry in the card, entries with tied values share a rank
+    row = models.PositiveSmallIntegerField()
+    rank = models.PositiveSmallIntegerField()
+    value = models.CharField(max_length=31)
+    # denormalized player/team data rendered by the card
+    player_id = models.IntegerField()
+    first_name = models.CharField(max_length=255)
+    last_name = models.CharField(max_length=255)
+    team_id = models.IntegerField()
+    team_name = models.CharField(max_length=255)
+    team_logo = models.CharField(max_length=255) # url
+    created_at = models.DateTimeField(auto_now_add=True)
+
+class PlayerProfile(models.Model):
+    # materialized player page, rebuilt by `db_utils` after every ingest
+    player = models.OneToOneField(Player, primary_key=True, related_name="profile", on_delete=models.CASCADE)
+    # zlib compressed JSON of the bio and stat cards of every season, see `web.card_data.pack_profile`
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+class DataVersion(models.Model):
+    # single row, bumped by `db_utils` whenever an ingest routine commits
+    version = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
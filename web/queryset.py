@@ -1,12 +1,103 @@
-from django.db.models import F, FloatField, IntegerField, Q, QuerySet, Max
-from django.db.models.functions import Cast 
+from django.db import transaction
+from django.db.models import (
+    DecimalField, F, FloatField, IntegerField, Q, QuerySet, Max, Subquery, Value
+)
+from django.db.models.functions import Cast, Coalesce
+import math
 from typing import Callable, Dict, List, Union
 
-from .models import Season, League, PlayerStat
+from .management.commands.helpers.config import top_five_league_ids
+from .models import Season, League, PlayerStat, StatSummary
+
+# numeric PlayerStat columns summarized per season/league/position
+SUMMARY_FIELDS = [
+    field.name for field in PlayerStat._meta.get_fields()
+    if isinstance(field, (IntegerField, DecimalField)) 
+    and not field.primary_key and field.name != "position"
+]
 
 def get_max( queryset: QuerySet, field: str ) -> QuerySet:
     return float( list(queryset.aggregate( Max(field) ).values())[0] )
 
+def get_scope_queryset(season: Season, league: Union[League, None]) -> QuerySet:
+    # PlayerStats of a season for one league, or for the Top 5 leagues
+    valid_league_ids = top_five_league_ids if league is None else [league.league_id]
+    return PlayerStat.objects.filter(
+        team__season=season, 
+        team__league__league_id__in=valid_league_ids
+    )
+
+#############################
+####### STAT SUMMARY ########
+#############################
+
+def quantile(sorted_values: List[float], q: float) -> float:
+    # linear interpolation between the closest ranks
+    position = q*(len(sorted_values) - 1)
+    lower = math.floor(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower])*(position - lower)
+
+def build_stat_summaries(season: Season) -> int:
+    summaries = []
+    for league in [None] + list(League.objects.all()):
+        rows = list(get_scope_queryset(season, league).values("position", *SUMMARY_FIELDS))
+        positions = sorted(set(row["position"] for row in rows))
+        for position in [None] + positions:
+            position_rows = [row for row in rows if position is None or row["position"] == position]
+            if len(position_rows) == 0:
+                continue
+            for field in SUMMARY_FIELDS:
+                values = sorted(float(row[field]) for row in position_rows)
+                summaries.append(StatSummary(
+                    season=season,
+                    league=league,
+                    position=position,
+                    field=field,
+                    count=len(values),
+                    max_value=values[-1],
+                    p25=quantile(values, 0.25),
+                    p50=quantile(values, 0.50),
+                    p75=quantile(values, 0.75),
+                    p90=quantile(values, 0.90),
+                ))
+    with transaction.atomic():
+        StatSummary.objects.filter(season=season).delete()
+        StatSummary.objects.bulk_create(summaries, batch_size=500)
+    return len(summaries)
+
+def summary_value(
+    season: Season, 
+    league: Union[League, None], 
+    field: str,
+    stat: str = "max_value",
+    position: Union[int, None] = None
+) -> Subquery:
+    return Subquery(StatSummary.objects.filter(
+        season=season, 
+        league=league, 
+        position=position, 
+        field=field
+    ).values(stat)[:1])
+
+def filter_by_summary(
+    queryset: QuerySet,
+    season: Season, 
+    league: Union[League, None], 
+    field: str,
+    divisor: float,
+    stat: str = "max_value",
+    position: Union[int, None] = None
+) -> QuerySet:
+    # keeps rows where field >= stat/divisor, in the same query as the rest of the filters.
+    # all rows are kept when the season has not been summarized yet
+    threshold = Coalesce(summary_value(season, league, field, stat, position), Value(0.0))/divisor
+    return queryset.filter(**{ f"{field}__gte": threshold })
+
+#############################
+###### QUERYSET HELPERS #####
+#############################
+
 def annotate_queryset(
     queryset: QuerySet,
     field_value: Union[FloatField, IntegerField],
@@ -36,24 +127,32 @@ def order_queryset(
     # may need to filter queryset more for per90 cards
     return annotated_queryset.order_by("-order_field" if desc is True else "order_field")[:limit]
 
-def filter_by_comparison(
-    queryset: QuerySet, 
+def comparison_q(
     data: Dict[str, Union[int, float]], 
     field: str,
     logical_op: str = "logicalOp",
     first_val: str = "firstVal",
     second_val: str = "secondVal",
-) -> QuerySet:
+) -> Q:
     field_lt = field + "__lt"
     field_gt = field + "__gt"
     if data[logical_op] == "><":
-        queryset = queryset.filter( Q(**{ field_gt: float(data[first_val]) }) ) 
-        queryset = queryset.filter( Q(**{ field_lt: float(data[second_val]) }) )
+        return Q(**{ field_gt: float(data[first_val]) }) & Q(**{ field_lt: float(data[second_val]) })
     elif data[logical_op] == "<":
-        queryset = queryset.filter( Q(**{ field_lt: float(data[first_val]) }) )
+        return Q(**{ field_lt: float(data[first_val]) })
     elif data[logical_op] == ">":
-        queryset = queryset.filter( Q(**{ field_gt: float(data[first_val]) }) )
-    return queryset
+        return Q(**{ field_gt: float(data[first_val]) })
+    return Q()
+
+def filter_by_comparison(
+    queryset: QuerySet, 
+    data: Dict[str, Union[int, float]], 
+    field: str,
+    logical_op: str = "logicalOp",
+    first_val: str = "firstVal",
+    second_val: str = "secondVal",
+) -> QuerySet:
+    return queryset.filter(comparison_q(data, field, logical_op, first_val, second_val))
 
 
 def modify_queryset( 
@@ -0,0 +1,308 @@
+from django.conf import settings
+from django.db import OperationalError, connection
+from django.db.models import Sum
+from bisect import bisect_left
+import heapq
+import logging
+import unicodedata
+from typing import Any, Dict, Iterable, List, Set, Tuple, Union
+
+from .cache import get_process_memo
+from .models import League, Team, Player, PlayerStat
+
+# Name search for the nav. On SQLite, names live in an FTS5 table that ingest keeps
+# in sync (`SEARCH_ENGINE = "fts"`). Otherwise, or when that table is unavailable,
+# every player, team and league name is split into lowercase, accent-free tokens kept
+# in one sorted in-process list, so the entries matching a prefix are a contiguous
+# slice found by binary search. Entries are numbered by relevance (minutes played,
+# then name), which makes the top k of a match the k smallest entry numbers. That
+# index is built once per process and data version.
+
+SEARCH_RESULT_LIMIT = 10
+SEARCH_RESULT_MAX_LIMIT = 50
+# seconds browsers may keep results fetched with the current data version
+SEARCH_CACHE_MAX_AGE = 365*24*60*60
+# words shorter than this are ignored, like the nav search always did
+MIN_WORD_LENGTH = 2
+# prefixes shorter than this match too many names to rank them per query, so only their
+# `SHORT_PREFIX_TOP_N` most relevant entries are kept, once per process and data version
+SHORT_PREFIX_LENGTH = 3
+SHORT_PREFIX_TOP_N = SEARCH_RESULT_MAX_LIMIT
+
+def search_tokens(text: str) -> List[str]:
+    # "Thomas Müller" -> ["thomas", "muller"]
+    folded = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in folded if not unicodedata.combining(c)).split()
+
+def load_name_entries() -> List[Dict[str, Any]]:
+    # relevance is the minutes played by a player, or by everyone on a team or in a league
+    player_minutes, team_minutes, league_minutes = load_minutes()
+    entries = [{
+        "type": "player",
+        "id": player_id,
+        "name": first_name + " " + last_name,
+        "logo": None,
+        "minutes": player_minutes.get(player_id) or 0,
+    } for player_id, first_name, last_name in Player.objects.values_list("player_id", "first_name", "last_name")]
+    # teams have one row per season, the most recent name and logo stand for the club
+    teams = {}
+    for team_id, name, logo in Team.objects.order_by("team_id", "season__start_year").values_list(
+        "team_id", "name", "logo"
+    ):
+        teams[team_id] = {
+            "type": "team", "id": team_id, "name": name, "logo": logo,
+            "minutes": team_minutes.get(team_id) or 0,
+        }
+    entries += teams.values()
+    entries += [{
+        "type": "league",
+        "id": league_id,
+        "name": name,
+        "logo": logo,
+        "minutes": league_minutes.get(league_id) or 0,
+    } for league_id, name, logo in League.objects.values_list("league_id", "name", "logo")]
+    return entries
+
+def load_minutes() -> Tuple[Dict[int, int], Dict[int, int], Dict[int, int]]:
+    # minutes played per player_id, team_id and league_id
+    return tuple(
+        dict(PlayerStat.objects.order_by().values_list(field).annotate(minutes=Sum("minutes_played")))
+        for field in ["player_id", "team__team_id", "team__league_id"]
+    )
+
+#################################
+#####    SHORT PREFIXES     #####
+#################################
+
+def query_words(query: str) -> List[str]:
+    return [word for word in search_tokens(query) if len(word) >= MIN_WORD_LENGTH]
+
+def is_short_query(words: List[str]) -> bool:
+    return len(words) > 0 and all(len(word) < SHORT_PREFIX_LENGTH for word in words)
+
+def matches_words(name: str, words: List[str]) -> bool:
+    tokens = search_tokens(name)
+    return all(any(token.startswith(word) for token in tokens) for word in words)
+
+def load_short_prefixes(entries: Iterable[Dict[str, Any]]) -> Dict[str, List[Dict[str, Any]]]:
+    # `entries` ordered by relevance, most relevant first
+    top_entries = {}
+    for entry in entries:
+        prefixes = set(
+            token[:length]
+            for token in search_tokens(entry["name"])
+            for length in range(MIN_WORD_LENGTH, min(len(token), SHORT_PREFIX_LENGTH - 1) + 1)
+        )
+        for prefix in prefixes:
+            prefix_entries = top_entries.setdefault(prefix, [])
+            if len(prefix_entries) < SHORT_PREFIX_TOP_N:
+                prefix_entries.append(entry)
+    return top_entries
+
+def search_short_prefixes(
+    top_entries: Dict[str, List[Dict[str, Any]]],
+    words: List[str],
+    limit: int
+) -> List[Dict[str, Any]]:
+    # the top entries of the first word that match the other words too; with several
+    # words this can miss matches ranked below the first word's top entries
+    return [entry for entry in top_entries.get(words[0], []) if matches_words(entry["name"], words[1:])][:limit]
+
+#################################
+#####     SEARCH INDEX      #####
+#################################
+
+class SearchIndex:
+    __slots__ = ("entries", "tokens", "postings", "short_prefixes")
+
+    def __init__(self, entries: List[Dict[str, Any]]) -> None:
+        # `entries` ordered by relevance, most relevant first
+        self.entries = entries
+        pairs = sorted(
+            (token, position)
+            for position, entry in enumerate(entries)
+            for token in set(search_tokens(entry["name"]))
+        )
+        self.tokens = [token for token, _ in pairs]
+        self.postings = [position for _, position in pairs]
+        self.short_prefixes = load_short_prefixes(entries)
+
+    @classmethod
+    def load(cls) -> Any:
+        entries = load_name_entries()
+        entries.sort(key=lambda entry: (-entry["minutes"], entry["name"].lower()))
+        return cls(entries)
+
+    def prefix_matches(self, prefix: str) -> Set[int]:
+        # every token starting with `prefix` sorts between `prefix` and `prefix` + U+FFFF
+        start = bisect_left(self.tokens, prefix)
+        end = bisect_left(self.tokens, prefix + "\uffff", start)
+        return set(self.postings[start:end])
+
+    def search(self, query: str, limit: int = SEARCH_RESULT_LIMIT) -> List[Dict[str, Any]]:
+        # entries with a token starting with every word of the query
+        words = query_words(query)
+        if is_short_query(words):
+            return search_short_prefixes(self.short_prefixes, words, limit)
+        matches = None
+        for word in words:
+            word_matches = self.prefix_matches(word)
+            matches = word_matches if matches is None else matches & word_matches
+            if len(matches) == 0:
+                break
+        if matches is None:
+            return []
+        return [self.entries[position] for position in heapq.nsmallest(limit, matches)]
+
+def get_search_index() -> SearchIndex:
+    return get_process_memo("search-index", SearchIndex.load)
+
+#################################
+#####    FTS NAME INDEX     #####
+#################################
+
+NAME_INDEX_TABLE = "web_nameindex"
+# rowids encode (type, id), so a name is replaced without scanning the table
+NAME_INDEX_TYPES = ["player", "team", "league"]
+
+# set by `ensure_name_index`, the ingest process only writes to an index it has checked
+name_index_state = { "synced": False }
+
+def name_index_rowid(entry_type: str, id: int) -> int:
+    return id*len(NAME_INDEX_TYPES) + NAME_INDEX_TYPES.index(entry_type)
+
+def name_index_exists() -> bool:
+    if connection.vendor != "sqlite":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [NAME_INDEX_TABLE])
+        return cursor.fetchone() is not None
+
+def create_name_index() -> None:
+    # the unicode61 tokenizer folds case and accents, the prefix option keeps
+    # 2 and 3 letter prefixes in the index so short queries do not scan every token
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {NAME_INDEX_TABLE} USING fts5("
+            "name, type UNINDEXED, id UNINDEXED, logo UNINDEXED, minutes UNINDEXED, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        )
+
+def index_names(entries: Iterable[Dict[str, Any]]) -> None:
+    # insert or replace entries shaped like `load_name_entries` rows
+    if not name_index_state["synced"]:
+        return
+    rows = [(
+        name_index_rowid(entry["type"], entry["id"]), entry["name"], entry["type"], entry["id"],
+        entry["logo"], entry.get("minutes") or 0
+    ) for entry in entries]
+    with connection.cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {NAME_INDEX_TABLE} WHERE rowid = %s", [row[:1] for row in rows])
+        cursor.executemany(
+            f"INSERT INTO {NAME_INDEX_TABLE} (rowid, name, type, id, logo, minutes) VALUES (%s, %s, %s, %s, %s, %s)",
+            rows
+        )
+
+def index_player(player: Player) -> None:
+    index_names([{
+        "type": "player", "id": player.player_id, "name": player.first_name + " " + player.last_name, "logo": None
+    }])
+
+def index_team(team: Team) -> None:
+    # one entry per team_id, the season ingested last names the club
+    index_names([{ "type": "team", "id": team.team_id, "name": team.name, "logo": team.logo }])
+
+def index_league(league: League) -> None:
+    index_names([{ "type": "league", "id": league.league_id, "name": league.name, "logo": league.logo }])
+
+def update_name_index_minutes() -> None:
+    # relevance is refreshed once per ingest, after the player stats are updated
+    if not name_index_state["synced"]:
+        return
+    player_minutes, team_minutes, league_minutes = load_minutes()
+    rows = [
+        (minutes, name_index_rowid(entry_type, id))
+        for entry_type, minutes_by_id in zip(NAME_INDEX_TYPES, [player_minutes, team_minutes, league_minutes])
+        for id, minutes in minutes_by_id.items()
+    ]
+    with connection.cursor() as cursor:
+        cursor.executemany(f"UPDATE {NAME_INDEX_TABLE} SET minutes = %s WHERE rowid = %s", rows)
+
+def build_name_index() -> int:
+    # (re)create the whole index from the database, returns the number of entries
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {NAME_INDEX_TABLE}")
+    create_name_index()
+    name_index_state["synced"] = True
+    entries = load_name_entries()
+    index_names(entries)
+    return len(entries)
+
+def ensure_name_index() -> None:
+    # ingest keeps the index in sync, so it only has to be built once per database
+    if connection.vendor != "sqlite":
+        return
+    try:
+        if name_index_exists():
+            name_index_state["synced"] = True
+        else:
+            logging.info(f"{build_name_index()} names added to the search index.")
+    except OperationalError as e:
+        # SQLite built without FTS5, searches use the in-process index
+        name_index_state["synced"] = False
+        logging.warning(f"Search index was not built.\n\tException: {e}")
+
+def match_expression(query: str) -> Union[str, None]:
+    # every word is a quoted prefix query, the words are implicitly AND-ed
+    words = query_words(query)
+    if len(words) == 0:
+        return None
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+def load_name_index_short_prefixes() -> Dict[str, List[Dict[str, Any]]]:
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT type, id, name, logo FROM {NAME_INDEX_TABLE} ORDER BY minutes DESC, name")
+        return load_short_prefixes(
+            { "type": entry_type, "id": id, "name": name, "logo": logo }
+            for entry_type, id, name, logo in cursor.fetchall()
+        )
+
+def search_name_index(query: str, limit: int = SEARCH_RESULT_LIMIT) -> List[Dict[str, Any]]:
+    words = query_words(query)
+    if is_short_query(words):
+        # sorting every match of a short prefix is a scan of most of the index
+        return search_short_prefixes(
+            get_process_memo("name-index-short-prefixes", load_name_index_short_prefixes), words, limit
+        )
+    expression = match_expression(query)
+    if expression is None:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT type, id, name, logo FROM {NAME_INDEX_TABLE} WHERE {NAME_INDEX_TABLE} MATCH %s "
+            "ORDER BY minutes DESC, name LIMIT %s",
+            [expression, limit]
+        )
+        return [
+            { "type": entry_type, "id": id, "name": name, "logo": logo }
+            for entry_type, id, name, logo in cursor.fetchall()
+        ]
+
+#################################
+#####        SEARCH         #####
+#################################
+
+def search_names(query: str, limit: int = SEARCH_RESULT_LIMIT) -> List[Dict[str, Any]]:
+    # the FTS index is used once ingest has built it, checked once per data version
+    if (
+        getattr(settings, "SEARCH_ENGINE", "fts") == "fts" and
+        get_process_memo("name-index-exists", name_index_exists)
+    ):
+        try:
+            return search_name_index(query, limit)
+        except OperationalError as e:
+            logging.warning(f"Name index search failed, using the in-process index.\n\tException: {e}")
+    return [
+        { key: entry[key] for key in ["type", "id", "name", "logo"] }
+        for entry in get_search_index().search(query, limit)
+    ]
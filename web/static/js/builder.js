@@ -23,24 +23,34 @@ const showBetweenSecondValue = prefix => {
     });
 }
 
-const showLeagueTeams = () => {
-    $("form#builderForm select[name='teamLeague']").change( e => {
-        const currStartYear = $("form#builderForm select[name='season']").text().split("/")[0].trim();
-        const currLeague = e.currentTarget.value;
-        const clubs = $("form#builderForm select[name='team'] option");
-        for (let club of clubs) {
+const loadLeagueTeams = () => {
+    const league = $("form#builderForm select[name='teamLeague']").first().val();
+    const season = $("form#builderForm select[name='season']").first().val();
+    const teamSelect = $("form#builderForm select[name='team']").first();
+    teamSelect.html("<option></option>");
+    if (league === "") return;
+    $.ajax({
+        method: "GET",
+        url: "/league_teams",
+        data: {"league": league, "season": season},
+        dataType: 'json',
+        success: res => {
+            // ignore responses for a league or season that is no longer selected
             if (
-                club.classList.contains(`league-${currLeague}`) &&
-                club.classList.contains(`season-${currStartYear}`)
-            ) {
-                club.classList.remove("hide");
-                continue;
-            }
-            club.classList.add("hide");
-        }
+                league !== $("form#builderForm select[name='teamLeague']").first().val() ||
+                season !== $("form#builderForm select[name='season']").first().val()
+            ) return;
+            teamSelect.append(res.result.map(team => $("<option></option>").val(team.id).text(team.name)));
+        },
+        error: errs => displayErrors(errs.responseJSON),
     });
 }
 
+const showLeagueTeams = () => {
+    $("form#builderForm select[name='teamLeague']").change(loadLeagueTeams);
+    $("form#builderForm select[name='season']").change(loadLeagueTeams);
+}
+
 const showQueryFilters = () => {
     $("form#builderForm select#queryFilterSelect").change( e => {
         const labelId = e.currentTarget.value;
@@ -133,6 +143,7 @@ const builderFormData = () => {
             perNinety: $("form#builderForm input[name='orderByStat-perNinety']").first().is(":checked"),
             lowToHigh: $("form#builderForm input[name='orderByStat-lowToHigh']").first().is(":checked"),
         },
+        percentiles: $("form#builderForm input[name='results-percentiles']").first().is(":checked"),
     }
 }
 
@@ -167,6 +178,47 @@ const builderFormSubmit = () => {
     });
 }
 
+const pollQueryJob = jobId => {
+    $.ajax({
+        method: "GET",
+        url: "/query_status",
+        data: {"job": jobId},
+        dataType: 'json',
+        success: res => {
+            if (res.status === "done") {
+                location.reload();
+            } else if (res.status === "pending" || res.status === "running") {
+                setTimeout(() => pollQueryJob(jobId), 500);
+            } else {
+                $("div#builderJob").addClass("hide");
+                displayErrors({"queryErrors": [res.error || `Query was ${res.status}`]});
+            }
+        },
+        error: errs => { $("div#builderJob").addClass("hide"); displayErrors(errs.responseJSON); },
+    });
+}
+
+const builderJob = () => {
+    const jobDiv = $("div#builderJob").first();
+    if (jobDiv.length === 0) return;
+    const jobId = jobDiv.attr("data-job");
+    pollQueryJob(jobId);
+    $("input#cancelQuery").click( () => {
+        const token = $("form#builderForm input[name='csrfmiddlewaretoken']").first().val();
+        $.ajax({
+            beforeSend: function(xhr, settings) {
+                if (!csrfSafeMethod(settings.type) && !this.crossDomain) {
+                    xhr.setRequestHeader("X-CSRFToken", token);
+                }
+            },
+            method: "POST",
+            url: "/cancel_query",
+            data: {"job": jobId},
+            dataType: 'json',
+        });
+    });
+}
+
 $(document).ready( () => {
     showMoreStats();
     showLeagueTeams();
@@ -177,4 +229,5 @@ $(document).ready( () => {
     showBetweenSecondValue("minutesPlayed");
     showQueryFilters();
     builderFormSubmit();
+    builderJob();
 });
\ No newline at end of file
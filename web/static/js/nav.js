@@ -48,114 +48,9 @@ const toggleCollapsedNav = () => {
 }
 
 //////////////////////////////////
-///////// TRIE FUNCTIONS /////////
+//////// SEARCH FUNCTIONS ////////
 //////////////////////////////////
 
-const searchTrie = (root, queryStr) => {
-    let searchResult = new Set();
-
-    const query = queryStr.trim().toLocaleLowerCase();
-    for (let word of query.split(' ')) {
-        // only count words with at least two letters
-        if (word.length < 2) continue;
-        // traverse trie to last node if it exists 
-        let currNode = root;
-        for (let letter of word) {
-            if (!currNode.children.hasOwnProperty(letter)) {
-                currNode = null;
-                break;
-            }
-            currNode = currNode.children[letter];
-        }
-
-        // if there was no node matching the word,
-        // continue to next word
-        if (currNode == null) continue;
-
-        // for each node in the subtree beginning at currNode
-        // add its value to tempResult
-        let tempResult = new Set();
-        const nodeQueue = [currNode];
-        while (nodeQueue.length > 0) {
-            const node = nodeQueue.shift();
-            // add elements of node.value to tempResult
-            if (node.value !== null) {
-                for (let entry of node.value) {
-                    tempResult.add(entry);
-                }
-            }
-            // add elements of node.children to nodeQueue
-            for (let letter in node.children) {
-                nodeQueue.push(node.children[letter]);
-            }
-        }
-
-        // on first iteration, all results are valid
-        if (searchResult.size === 0) {
-            searchResult = tempResult;
-            continue;
-        }
-        // set result to intersection with tempResult
-        searchResult = new Set([...searchResult].filter(elem => tempResult.has(elem)));
-    }
-
-    // return first 10 results sorted by name
-    return Array.from(searchResult)
-        .sort((a, b) => a.name.localeCompare(b.name))
-        .slice(0, 10);
-    
-}
-
-const addWord = (root, word, data) => {
-    let currNode = root;
-    // loop through trie with word's letters
-    for (let letter of word) {
-        if (!currNode.children.hasOwnProperty(letter)) {
-            currNode.children[letter] = { value: null, children: {} };
-        }
-        currNode = currNode.children[letter];
-    }
-    // add data to value of last node
-    if (currNode.value === null) currNode.value = [];
-    currNode.value.push(data);
-}
-
-const generateTrie = data => {
-    // create root node
-    let trie = {
-        value: null,
-        children: {},
-    }
-    // add each word from each name in data to trie
-    for (let entry of data) {
-        for (let word of entry.name.split(' ')) {
-            addWord(trie, word, entry);
-        }
-    }
-    return trie;
-}
-
-async function createTrie(url, token) {
-    // AJAX GET request to grab player, league, or team data 
-    return $.ajax({
-        beforeSend: function(xhr, settings) {
-            if (!csrfSafeMethod(settings.type) && !this.crossDomain) {
-                xhr.setRequestHeader("X-CSRFToken", token);
-            }
-        },
-        method: "GET",
-        url: url,
-        success: res => {
-            return res;
-        },
-        error: errs => {
-            console.log(`Request to '${url}' resulted in an error`)
-            // return null on error
-            return null;
-        },
-    });
-}
-
 const title = str => {
     let result = '';
     splitStr = str.split(' ');
@@ -165,12 +60,9 @@ const title = str => {
     return result.substring(0, result.length-1);
 }
 
-const playerSearch = (tries, e, currSeason) => {
-    const query = e.target.value;
-        
-    // player search result 
-    const playerResult = searchTrie(tries.players, query);
-    const playerList = playerResult.map(player =>
+const renderSearchResults = (e, result, currSeason) => {
+    // results arrive ranked, keep that order within each section
+    const playerList = result.filter(entry => entry.type === "player").map(player =>
         `<li class='entry'>
             <i class='bi bi-person-fill'></i>
             <a href='/player/${player.id}/${currSeason}'>
@@ -178,9 +70,7 @@ const playerSearch = (tries, e, currSeason) => {
             </a>
         </li>`
     );
-    // add teams to result
-    const teamResult = searchTrie(tries.teams, query);
-    const teamList = teamResult.map(team =>
+    const teamList = result.filter(entry => entry.type === "team").map(team =>
         `<li class='entry'>
             <div class='logo'><img src='${team.logo}' /></div>
             <a href='/team/${team.id}/${currSeason}'>
@@ -188,9 +78,7 @@ const playerSearch = (tries, e, currSeason) => {
             </a>
         </li>`
     );
-    // add leagues to result
-    const leagueResult = searchTrie(tries.leagues, query);
-    const leagueList = leagueResult.map(league =>
+    const leagueList = result.filter(entry => entry.type === "league").map(league =>
         `<li class='entry'>
             <div class='logo'><img src='${league.logo}' /></div>
             <a href='/league/${league.id}/${currSeason}'>
@@ -221,6 +109,31 @@ const playerSearch = (tries, e, currSeason) => {
     resultList.html(`${playerListStr}${teamListStr}${leagueListStr}`);
 }
 
+// pending search request and keyup timer, only the latest query is sent and shown
+let searchRequest = null;
+let searchTimer = null;
+
+const navSearch = (e, currSeason, searchVersion) => {
+    const query = e.target.value;
+    clearTimeout(searchTimer);
+    // wait until typing pauses before asking the server
+    searchTimer = setTimeout(() => {
+        if (searchRequest !== null) searchRequest.abort();
+        searchRequest = $.ajax({
+            method: "GET",
+            url: "/search",
+            // versioned URLs are cached by the browser until the next ingest
+            data: {"q": query.trim().toLocaleLowerCase(), "limit": 10, "v": searchVersion},
+            dataType: 'json',
+            success: res => renderSearchResults(e, res.result, currSeason),
+            error: (xhr, status) => {
+                if (status !== "abort") console.log("Request to '/search' resulted in an error");
+            },
+            complete: () => { searchRequest = null; },
+        });
+    }, 150);
+}
+
 //////////////////////////
 ///// DOCUMENT.READY /////
 //////////////////////////
@@ -1,3 +1,887 @@
-from django.test import TestCase
+from django.conf import settings
+from django.db import DatabaseError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+import json
+import pickle
+import threading
+from unittest import skipIf
+from unittest.mock import patch
 
-# Create your tests here.
+from . import columnar
+from .builder import (
+    QueryPlan, clear_builder_cache, get_builder_cache_stats, get_cached_query_result, get_query_result,
+    get_query_cost, peek_query_result, query_fingerprint, query_validator
+)
+from .cache import clear_process_memos, get_data_version, release_memo, reset_data_version_memo
+from .card import BioCardEntry, BuilderCardEntry, CardEntry, DashCardEntry
+from .card_data import (
+    DASHBOARD_CARDS, build_leaderboards, build_player_profiles, clear_cache, get_card_data, get_card_fragments,
+    get_dashboard_data, get_dashboard_queryset, get_from_leaderboards, get_player_profile, get_team_page,
+    preload_card_cache, render_card_list, warm_card_cache
+)
+from .guard import QueryBudgetError, clear_cost_log, get_cost_log
+from .jobs import Job, cancel_job, clear_jobs, get_job, jobs, submit_query_job
+from .management.commands.helpers.config import initial_league_ids
+from .models import (
+    Country, DataVersion, LeaderboardEntry, Season, League, Team, Player, PlayerProfile, PlayerStat, StatSummary
+)
+from .queryset import build_stat_summaries
+from .management.commands.db_utils import Command as DbUtilsCommand
+from .search import (
+    NAME_INDEX_TABLE, build_name_index, ensure_name_index, get_search_index, name_index_state, search_name_index, search_names,
+    search_tokens, update_name_index_minutes
+)
+from .views import default_context, get_league_hierarchy
+
+#############################
+########## HELPERS ##########
+#############################
+
+STAT_DEFAULTS = {
+    "position": 1, "rating": 7.0, "shots": 10, "shots_on_target": 5, "goals": 3,
+    "goals_conceded": 0, "goals_saved": 0, "assists": 2, "passes": 300, "passes_key": 10,
+    "passes_accuracy": 0.8, "blocks": 1, "tackles": 10, "interceptions": 5, "duels": 50,
+    "duels_won": 25, "dribbles_attempted": 20, "dribbles_succeeded": 10, "fouls_drawn": 5,
+    "fouls_committed": 5, "yellows": 1, "reds": 0, "penalties_won": 0, "penalties_committed": 0,
+    "penalties_scored": 0, "penalties_taken": 0, "penalties_saved": 0, "appearances": 10,
+    "starts": 10, "benches": 0, "minutes_played": 900, "substitutions_in": 0, "substitutions_out": 0,
+    "shots_on_target_pct": 0.5, "duels_won_pct": 0.5, "dribbles_succeeded_pct": 0.5,
+    "penalties_scored_pct": 0.0,
+}
+
+def create_playerstats(num_teams: int = 3, players_per_team: int = 20) -> Season:
+    country = Country.objects.create(name="england", code="GB")
+    season = Season.objects.create(start_year=2020, end_year=2021)
+    league = League.objects.create(
+        league_id=39, name="premier league", league_type="league", logo="", country=country
+    )
+    for t in range(num_teams):
+        team = Team.objects.create(team_id=t+1, league=league, season=season, name=f"team {t}", logo="")
+        for p in range(players_per_team):
+            player_id = t*players_per_team + p + 1
+            player = Player.objects.create(
+                player_id=player_id, first_name="first", last_name=f"last {player_id}",
+                age=20+p, nationality=country
+            )
+            stats = dict(STAT_DEFAULTS, goals=p, minutes_played=900+10*p, position=1+p%4)
+            PlayerStat.objects.create(team=team, player=player, **stats)
+    return season
+
+def builder_stat(first_stat: str = "", **kwargs) -> dict:
+    return dict({ "firstStat": first_stat, "arithOp": "", "secondStat": "", "perNinety": False }, **kwargs)
+
+def builder_post_data(season: Season) -> dict:
+    comparison = { "logicalOp": "", "firstVal": "", "secondVal": "" }
+    return {
+        "seasonId": str(season.id),
+        "selectStats": [builder_stat("goals"), builder_stat(), builder_stat()],
+        "leagueId": "",
+        "team": { "id": "", "leagueId": "" },
+        "minutesPlayed": dict(comparison),
+        "age": dict(comparison),
+        "filterStats": [builder_stat(**comparison) for _ in range(3)],
+        "country": "",
+        "position": "",
+        "orderByStat": builder_stat(lowToHigh=False),
+    }
+
+#############################
+########### CARDS ###########
+#############################
+
+class CardQueryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.season = create_playerstats()
+
+    def test_builder_card_is_one_query(self):
+        post_data = builder_post_data(self.season)
+        post_data["selectStats"][1] = builder_stat("assists", perNinety=True)
+        with self.assertNumQueries(1):
+            card = QueryPlan.compile(post_data).execute().cards[0]
+            names = [(entry.get_player_name(), entry.team, entry.league) for entry in card.data]
+        self.assertEqual(len(names), 50)
+        self.assertEqual(card.header, ["GoalsFloat", "AssistsFloatPer90"])
+
+    def test_dashboard_is_one_query(self):
+        with self.assertNumQueries(1):
+            dashboard_data = get_dashboard_data(PlayerStat.objects.filter(team__season=self.season))
+            # entry attributes must not trigger lazy loads
+            names = [
+                (entry.get_player_name(), entry.team, entry.team_logo)
+                for card_list in dashboard_data[True] for card in card_list.cards for entry in card.data
+            ]
+        self.assertGreater(len(names), 0)
+        self.assertEqual(sorted(dashboard_data.keys()), [False, True])
+        self.assertEqual(len(dashboard_data[False][0].cards[0].data), 50)
+
+class CardEntryPickleTests(TestCase):
+    # cached cards are pickled, every slot must survive the round trip
+
+    def slot_values(self, entry):
+        slots = [slot for cls in type(entry).__mro__ for slot in getattr(cls, "__slots__", ())]
+        return { slot: getattr(entry, slot) for slot in slots }
+
+    def test_entries_round_trip(self):
+        player_fields = dict(player_id=7, first_name="first", last_name="last", team="team", team_id=3, team_logo="logo")
+        entries = [
+            CardEntry(title="Goals", value=3),
+            BioCardEntry(title="Team", value="Team", logo="logo", link="/team/3/"),
+            DashCardEntry(value="0.52", rank=2, **player_fields),
+            BuilderCardEntry(values={ "goals": "3", "assists": "1" }, rank=1, league="league", **player_fields),
+        ]
+        for entry in entries:
+            copy = pickle.loads(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+            self.assertIs(type(copy), type(entry))
+            self.assertEqual(self.slot_values(copy), self.slot_values(entry))
+            self.assertFalse(hasattr(copy, "__dict__"))
+
+#############################
+########## BUILDER ##########
+#############################
+
+class BuilderTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.season = create_playerstats(num_teams=1, players_per_team=5)
+
+    def setUp(self):
+        clear_builder_cache()
+        clear_process_memos()
+        reset_data_version_memo()
+
+    def test_fingerprint_ignores_empty_slots_and_key_order(self):
+        post_data = builder_post_data(self.season)
+        reordered = dict(reversed(list(post_data.items())))
+        reordered["selectStats"] = [builder_stat(), builder_stat("goals"), builder_stat(arithOp="*")]
+        # an empty order by stat means the first select stat, high to low
+        reordered["orderByStat"] = builder_stat("goals", lowToHigh=False)
+        self.assertEqual(query_fingerprint(post_data), query_fingerprint(reordered))
+        reordered["orderByStat"]["lowToHigh"] = True
+        self.assertNotEqual(query_fingerprint(post_data), query_fingerprint(reordered))
+
+    def test_repeated_query_is_served_from_cache(self):
+        post_data = builder_post_data(self.season)
+        result = get_cached_query_result(post_data)
+        with self.assertNumQueries(0):
+            cached = get_cached_query_result(post_data)
+        self.assertEqual(
+            [(entry.player_id, entry.values) for entry in cached.cards[0].data],
+            [(entry.player_id, entry.values) for entry in result.cards[0].data]
+        )
+        self.assertEqual(cached.cards[0].header, ["GoalsFloat"])
+        stats = get_builder_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_validation_uses_id_index(self):
+        post_data = builder_post_data(self.season)
+        post_data["team"]["id"] = str(Team.objects.get().id)
+        post_data["leagueId"] = "39"
+        post_data["country"] = str(Country.objects.get().id)
+        self.assertEqual(query_validator(post_data), {})
+        with self.assertNumQueries(0):
+            self.assertEqual(query_validator(post_data), {})
+        post_data["leagueId"] = "1"
+        post_data["country"] = "x"
+        with self.assertNumQueries(0):
+            errors = query_validator(post_data)
+        self.assertEqual(sorted(errors.keys()), ["leagueErrors", "nationalityErrors"])
+
+    def test_comparison_values_are_numbers(self):
+        post_data = builder_post_data(self.season)
+        for first_val, second_val, valid in [
+            ("9", "10", True), ("0.35", "1", True), ("10", "9", False), ("1.2.3", "4", False),
+            ("1", "1.2.3", False), ("1e3", "2000", False), ("", "1", False), ("-1", "1", False),
+        ]:
+            post_data["filterStats"][0] = builder_stat(
+                "goals", logicalOp="><", firstVal=first_val, secondVal=second_val
+            )
+            self.assertEqual("filterStatsErrors" not in query_validator(post_data), valid, (first_val, second_val))
+        post_data["filterStats"][0] = builder_stat("goals", logicalOp=">", firstVal="1.2.3", secondVal="")
+        response = self.client.post(
+            "/make_query",
+            data=json.dumps(post_data),
+            content_type="application/x-www-form-urlencoded",
+            HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("filterStatsErrors", response.json())
+
+    def test_junk_payloads_are_rejected(self):
+        post_data = builder_post_data(self.season)
+        junk_payloads = [
+            "", "not json", "[]", "{}", json.dumps(dict(post_data, selectStats="goals")),
+            json.dumps(dict(post_data, team={ "id": 1 })), json.dumps(dict(post_data, seasonId=None)),
+            json.dumps(dict(post_data, filterStats=[builder_stat("goals")])),
+        ]
+        for payload in junk_payloads:
+            with self.assertNumQueries(0):
+                response = self.client.post(
+                    "/make_query",
+                    data=payload,
+                    content_type="application/x-www-form-urlencoded",
+                    HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+                )
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), { "queryErrors": ["Query is malformed"] })
+
+    def test_results_are_keyset_paginated(self):
+        # 1 team x 5 players with goals 0..4, add ties so the id breaks them
+        PlayerStat.objects.filter(goals=3).update(goals=4)
+        query = json.dumps(builder_post_data(self.season))
+        pages, cursor = [], None
+        while True:
+            params = { "query": query, "limit": 2 }
+            if cursor is not None:
+                params["cursor"] = cursor
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/query_results", params)
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(any("OFFSET" in query["sql"] for query in queries.captured_queries))
+            page = response.json()
+            pages.append([(row["order_value"], row["player_id"]) for row in page["result"]])
+            cursor = page["next"]
+            if cursor is None:
+                break
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        rows = [row for page in pages for row in page]
+        self.assertEqual([value for value, _ in rows], [4.0, 4.0, 2.0, 1.0, 0.0])
+        self.assertEqual(len(set(player_id for _, player_id in rows)), 5)
+        self.assertEqual(page["header"], ["Goals"])
+
+    def test_null_order_values_are_paginated(self):
+        # a player without minutes has no goals per 90, every output keeps the row
+        PlayerStat.objects.filter(goals=2).update(minutes_played=0)
+        for low_to_high in [False, True]:
+            post_data = builder_post_data(self.season)
+            post_data["selectStats"][0] = builder_stat("goals", perNinety=True)
+            post_data["orderByStat"] = builder_stat("goals", perNinety=True, lowToHigh=low_to_high)
+            query = json.dumps(post_data)
+            rows, cursor = [], None
+            while True:
+                params = { "query": query, "limit": 2 }
+                if cursor is not None:
+                    params["cursor"] = cursor
+                page = self.client.get("/query_results", params).json()
+                rows += [(row["order_value"], row["player_id"]) for row in page["result"]]
+                cursor = page["next"]
+                if cursor is None:
+                    break
+            self.assertEqual(len(rows), 5)
+            self.assertEqual(rows[-1 if low_to_high is False else 0][0], None)
+            card = QueryPlan.compile(post_data).execute().cards[0]
+            self.assertEqual([entry.player_id for entry in card.data], [player_id for _, player_id in rows])
+            response = self.client.get("/export_query", { "query": query, "format": "ndjson" })
+            exported = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+            self.assertEqual([row["player_id"] for row in exported], [player_id for _, player_id in rows])
+
+    def test_results_reject_bad_cursor_and_limit(self):
+        query = json.dumps(builder_post_data(self.season))
+        response = self.client.get("/query_results", { "query": query, "cursor": "junk" })
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get("/query_results", { "query": query, "limit": 0 })
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get("/query_results")
+        self.assertEqual(response.status_code, 400)
+
+    def test_results_are_guarded(self):
+        query = json.dumps(builder_post_data(self.season))
+        with override_settings(BUILDER_QUERY_MAX_COST=1.0):
+            response = self.client.get("/query_results", { "query": query })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("queryErrors", response.json())
+        with override_settings(BUILDER_QUERY_BUDGET=0.0), patch("web.guard.PROGRESS_STEPS", 1):
+            response = self.client.get("/query_results", { "query": query })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("took longer", response.json()["queryErrors"][0])
+
+    def test_export_streams_every_row(self):
+        post_data = builder_post_data(self.season)
+        post_data["selectStats"][1] = builder_stat("passes_accuracy")
+        query = json.dumps(post_data)
+        response = self.client.get("/export_query", { "query": query })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], "rank,player_id,name,team,team_id,league,Goals,Pass Accuracy")
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[1].endswith(",4,80"))
+        # raw numbers, one json object per line
+        response = self.client.get("/export_query", { "query": query, "format": "ndjson", "raw": "1" })
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row["Goals"] for row in rows], [4.0, 3.0, 2.0, 1.0, 0.0])
+        self.assertEqual(rows[0]["Pass Accuracy"], 0.8)
+        self.assertEqual(self.client.get("/export_query", { "query": query, "format": "xml" }).status_code, 400)
+
+    def test_export_is_guarded(self):
+        query = json.dumps(builder_post_data(self.season))
+        with override_settings(BUILDER_QUERY_MAX_COST=1.0):
+            response = self.client.get("/export_query", { "query": query })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("queryErrors", response.json())
+        # cut short exports end with a marker row
+        with override_settings(BUILDER_EXPORT_BUDGET=0.0), patch("web.guard.PROGRESS_STEPS", 10):
+            response = self.client.get("/export_query", { "query": query, "format": "ndjson" })
+            lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(json.loads(lines[-1]), { "truncated": "Export took longer than 0s" })
+        with patch("web.builder.EXPORT_ROW_LIMIT", 2):
+            response = self.client.get("/export_query", { "query": query })
+            lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines[-1], "truncated: Export is limited to 2 rows,,,,,,")
+        # a result of exactly the row limit is complete
+        with patch("web.builder.EXPORT_ROW_LIMIT", 5):
+            response = self.client.get("/export_query", { "query": query, "format": "ndjson" })
+            lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertNotIn("truncated", json.loads(lines[-1]))
+
+    def test_percentile_and_rank_columns(self):
+        # goals are 0..4, the filter keeps 1..4, so percentiles are taken over 4 players
+        post_data = builder_post_data(self.season)
+        post_data["percentiles"] = True
+        post_data["filterStats"][0] = builder_stat("goals", logicalOp=">", firstVal="0", secondVal="")
+        post_data["orderByStat"] = builder_stat("goals", lowToHigh=True)
+        with self.assertNumQueries(1):
+            card = QueryPlan.compile(post_data).execute().cards[0]
+        self.assertEqual(card.header, ["GoalsFloat", "GoalsFloat_Percentile", "GoalsFloat_Rank"])
+        self.assertEqual(card.get_pretty_header(), ["Goals", "Goals Percentile", "Goals Rank"])
+        self.assertEqual(
+            [(entry.rank, list(entry.values.values())) for entry in card.data],
+            [(1, ["1", "0", "4"]), (2, ["2", "33", "3"]), (3, ["3", "67", "2"]), (4, ["4", "100", "1"])]
+        )
+        self.assertNotEqual(query_fingerprint(post_data), query_fingerprint(dict(post_data, percentiles=False)))
+
+    @skipIf(columnar.np is None, "NumPy is not installed")
+    def test_columnar_engine_matches_orm(self):
+        # a division by zero and a zero minutes row exercise NULL handling
+        PlayerStat.objects.filter(goals=0).update(minutes_played=0)
+        post_data = builder_post_data(self.season)
+        post_data["selectStats"] = [
+            builder_stat("goals", perNinety=True), builder_stat("assists", arithOp="/", secondStat="goals"),
+            builder_stat("rating")
+        ]
+        post_data["filterStats"][0] = builder_stat("goals", logicalOp="<", firstVal="4", secondVal="")
+        for low_to_high, percentiles in [(False, False), (True, False), (False, True)]:
+            post_data["orderByStat"] = builder_stat("goals", perNinety=True, lowToHigh=low_to_high)
+            post_data["percentiles"] = percentiles
+            expected = QueryPlan.compile(post_data).execute().cards[0]
+            result = columnar.get_query_result(post_data).cards[0]
+            self.assertEqual(result.header, expected.header)
+            self.assertEqual(
+                [(entry.rank, entry.player_id, entry.values) for entry in result.data],
+                [(entry.rank, entry.player_id, entry.values) for entry in expected.data]
+            )
+
+    @skipIf(columnar.np is None, "NumPy is not installed")
+    @override_settings(BUILDER_ENGINE="columnar")
+    def test_columnar_engine_is_guarded(self):
+        post_data = builder_post_data(self.season)
+        season_id = int(post_data["seasonId"])
+        with patch("web.columnar.get_query_result", wraps=columnar.get_query_result) as columnar_query:
+            get_query_result(post_data)
+            self.assertEqual(columnar_query.call_count, 1)
+            # too many rows for the column store, the ORM answers
+            clear_process_memos()
+            with override_settings(BUILDER_COLUMNAR_MAX_ROWS=4):
+                self.assertFalse(columnar.fits_column_store(season_id))
+                get_query_result(post_data)
+            self.assertEqual(columnar_query.call_count, 1)
+        with override_settings(BUILDER_QUERY_MAX_COST=1.0), self.assertRaises(QueryBudgetError):
+            get_query_result(post_data)
+
+    def test_every_filter_stat_is_applied(self):
+        # goals are 0..4 and minutes 900..940, so goals/90 of 4 goals is above 0.35
+        post_data = builder_post_data(self.season)
+        post_data["filterStats"][0] = builder_stat("goals", logicalOp=">", firstVal="0", secondVal="")
+        post_data["filterStats"][2] = builder_stat("goals", perNinety=True, logicalOp="<", firstVal="0.35", secondVal="")
+        with self.assertNumQueries(1):
+            result = QueryPlan.compile(post_data).execute()
+        self.assertEqual([entry.values["GoalsFloat"] for entry in result.cards[0].data], ["3", "2", "1"])
+
+    def test_league_teams_are_loaded_per_league_and_season(self):
+        # data version and one joined query, then the hierarchy is served from memory
+        with self.assertNumQueries(2):
+            self.assertEqual(get_league_hierarchy()["leagues"], [{ "id": 39, "name": "Premier League (England)" }])
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                "/league_teams", { "league": 39, "season": self.season.id }, HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+            )
+        team = Team.objects.get(team_id=1)
+        self.assertEqual(response.json(), { "result": [{ "id": team.id, "name": "Team 0" }] })
+        response = self.client.get(
+            "/league_teams", { "league": 39, "season": self.season.id+1 }, HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+        )
+        self.assertEqual(response.json(), { "result": [] })
+        response = self.client.get("/league_teams", { "league": "x", "season": 1 }, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 400)
+
+    def test_expensive_query_is_rejected(self):
+        post_data = builder_post_data(self.season)
+        cost = get_query_cost(QueryPlan.compile(post_data), post_data)
+        self.assertEqual((cost.rows, cost.full_scan), (5, False))
+        self.assertGreater(cost.sorts, 0)
+        clear_cost_log()
+        get_query_result(post_data)
+        with override_settings(BUILDER_QUERY_MAX_COST=1.0):
+            with self.assertRaises(QueryBudgetError):
+                get_query_result(post_data)
+            response = self.client.post(
+                "/make_query",
+                data=json.dumps(post_data),
+                content_type="application/x-www-form-urlencoded",
+                HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("queryErrors", response.json())
+        (entry,) = get_cost_log().values()
+        self.assertEqual((entry["runs"], entry["rejected"]), (1, 1))
+
+    @override_settings(BUILDER_QUERY_BUDGET=0.0)
+    def test_query_over_budget_is_interrupted(self):
+        clear_cost_log()
+        with patch("web.guard.PROGRESS_STEPS", 10), self.assertRaises(QueryBudgetError):
+            get_query_result(builder_post_data(self.season))
+        (entry,) = get_cost_log().values()
+        self.assertEqual((entry["runs"], entry["interrupted"]), (0, 1))
+
+class BuilderJobTests(TransactionTestCase):
+    # jobs run on worker threads with their own connections, so the data must be committed
+
+    def setUp(self):
+        self.season = create_playerstats(num_teams=1, players_per_team=5)
+        clear_builder_cache()
+        clear_jobs()
+        clear_process_memos()
+        reset_data_version_memo()
+
+    def test_job_fills_result_cache(self):
+        post_data = builder_post_data(self.season)
+        job_id = submit_query_job(post_data)
+        job = jobs[job_id]
+        # identical queries share the queued or running job
+        self.assertIn(submit_query_job(post_data), [job_id, submit_query_job(post_data)])
+        job.future.result(timeout=10)
+        self.assertEqual(get_job(job_id)["status"], "done")
+        self.assertEqual(len(peek_query_result(post_data).cards[0].data), 5)
+
+    def test_running_job_is_interrupted(self):
+        # let the job start, then make every progress check ask it to stop
+        checks = []
+        def stop_reason(job):
+            checks.append(job.id)
+            return "timeout" if len(checks) > 1 else None
+        with patch.object(Job, "stop_reason", stop_reason), patch("web.guard.PROGRESS_STEPS", 10):
+            job = jobs[submit_query_job(builder_post_data(self.season))]
+            job.future.result(timeout=10)
+        self.assertGreater(len(checks), 1)
+        self.assertEqual(job.state, "timeout")
+        self.assertEqual(get_job(job.id)["status"], "timeout")
+        self.assertIsNone(peek_query_result(job.post_data))
+
+    @override_settings(BUILDER_JOB_TIMEOUT=0.0)
+    def test_expired_job_does_not_run(self):
+        job = jobs[submit_query_job(builder_post_data(self.season))]
+        job.future.result(timeout=10)
+        self.assertEqual(job.state, "timeout")
+
+    def test_shared_job_is_cancelled_by_its_last_submitter(self):
+        post_data = builder_post_data(self.season)
+        # hold the job in the queue so both submitters share it
+        gate = threading.Event()
+        with patch.object(Job, "execute", lambda job: gate.wait(10)):
+            job_id = submit_query_job(post_data)
+            self.assertEqual(submit_query_job(post_data), job_id)
+            self.assertEqual(cancel_job(job_id)["status"], "pending")
+            self.assertFalse(jobs[job_id].cancelled.is_set())
+            cancel_job(job_id)
+            self.assertTrue(jobs[job_id].cancelled.is_set())
+            # the cancelled job is not shared with new submitters
+            self.assertNotEqual(submit_query_job(post_data), job_id)
+            gate.set()
+
+    def test_cancel_made_through_the_record_stops_the_job(self):
+        # a cancel by another process only reaches the job through its shared record
+        with patch.object(Job, "execute", lambda job: None):
+            job = jobs[submit_query_job(builder_post_data(self.season))]
+            job.future.result(timeout=10)
+        job.state = "running"
+        job.save()
+        self.assertIsNone(job.stop_reason())
+        cancel_job(job.id)
+        job.cancelled.clear()
+        job.checked_at = 0.0
+        self.assertEqual(job.stop_reason(), "cancelled")
+
+    def test_cancel_endpoint(self):
+        job = jobs[submit_query_job(builder_post_data(self.season))]
+        response = self.client.post("/cancel_query", { "job": job.id }, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 200)
+        job.future.result(timeout=10) if not job.future.cancelled() else None
+        self.assertIn(get_job(job.id)["status"], ["cancelled", "done"])
+        response = self.client.get("/query_status", { "job": "missing" }, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 404)
+
+#############################
+####### STAT SUMMARY ########
+#############################
+
+class StatSummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.season = create_playerstats(num_teams=1, players_per_team=5)
+        cls.league = League.objects.get(league_id=39)
+        build_stat_summaries(cls.season)
+
+    def test_summary_distribution(self):
+        # goals are 0..4, one player per goal count
+        summary = StatSummary.objects.get(season=self.season, league=self.league, position=None, field="goals")
+        self.assertEqual(summary.count, 5)
+        self.assertEqual(summary.max_value, 4.0)
+        self.assertEqual(summary.p50, 2.0)
+        self.assertEqual(summary.p90, 3.6)
+        # positions cycle through 1..4, so attackers scored 0 and 4 goals
+        summary = StatSummary.objects.get(season=self.season, league=self.league, position=1, field="goals")
+        self.assertEqual((summary.count, summary.max_value), (2, 4.0))
+
+    def test_dashboard_qualification_reads_summary(self):
+        # minutes played are 900..940, so everyone clears 1/5 of the max in the same query
+        with self.assertNumQueries(1):
+            get_dashboard_data(get_dashboard_queryset(self.season, self.league))
+        self.assertEqual(get_dashboard_queryset(self.season, self.league).count(), 5)
+
+class LeaderboardTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.season = create_playerstats(num_teams=2, players_per_team=5)
+        cls.league = League.objects.get(league_id=39)
+        build_stat_summaries(cls.season)
+
+    def setUp(self):
+        clear_cache()
+        clear_process_memos()
+        reset_data_version_memo()
+
+    def card_rows(self, card_data):
+        return [[(card.title, [
+            (entry.rank, entry.player_id, str(entry.value), entry.first_name, entry.last_name, entry.team,
+             entry.team_id, entry.team_logo)
+            for entry in card.data
+        ]) for card in card_list.cards] for card_list in card_data]
+
+    def test_leaderboards_match_dashboard_scan(self):
+        self.assertIsNone(get_from_leaderboards(self.season, False, None))
+        self.assertGreater(build_leaderboards(self.season), 0)
+        for league in [None, self.league]:
+            expected = get_dashboard_data(get_dashboard_queryset(self.season, league))
+            self.assertEqual(len(expected[False][0].cards[0].data), 10)
+            for per_ninety in [False, True]:
+                with self.assertNumQueries(1):
+                    card_data = get_from_leaderboards(self.season, per_ninety, league)
+                self.assertEqual(self.card_rows(card_data), self.card_rows(expected[per_ninety]))
+
+    def test_season_without_leaderboards_falls_back_to_scan(self):
+        build_leaderboards(self.season)
+        season = Season.objects.create(start_year=2021, end_year=2022)
+        team = Team.objects.create(team_id=1, league=self.league, season=season, name="team 0", logo="")
+        PlayerStat.objects.create(team=team, player=Player.objects.get(player_id=1), **STAT_DEFAULTS)
+        build_stat_summaries(season)
+        self.assertFalse(LeaderboardEntry.objects.filter(season=season).exists())
+        expected = get_dashboard_data(get_dashboard_queryset(season, None))
+        for per_ninety in [False, True]:
+            card_data = get_card_data(season, per_ninety)
+            self.assertEqual(self.card_rows(card_data), self.card_rows(expected[per_ninety]))
+            self.assertEqual(len(card_data[0].cards[0].data), 1)
+
+class CardCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.season = create_playerstats(num_teams=2, players_per_team=5)
+        build_stat_summaries(cls.season)
+
+    def setUp(self):
+        clear_cache()
+        clear_process_memos()
+        reset_data_version_memo()
+
+    def test_fragments_are_cached_per_data_version(self):
+        fragments = get_card_fragments(self.season, False)
+        self.assertEqual(len(fragments), len(DASHBOARD_CARDS))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_card_fragments(self.season, False), fragments)
+        # ingest bumps the data version (what `bump_data_version` does once committed)
+        DataVersion.objects.create(pk=1, version=1)
+        reset_data_version_memo()
+        with patch("web.card_data.render_card_list", wraps=render_card_list) as render:
+            self.assertEqual(get_card_fragments(self.season, False), fragments)
+            self.assertEqual(render.call_count, len(DASHBOARD_CARDS))
+            with self.assertNumQueries(0):
+                get_card_fragments(self.season, False)
+            self.assertEqual(render.call_count, len(DASHBOARD_CARDS))
+
+    def test_warm_card_cache_builds_every_variant(self):
+        timings = warm_card_cache()
+        leagues = [None] + list(League.objects.all())
+        self.assertEqual(len(timings), 2*len(leagues))
+        with self.assertNumQueries(0):
+            for league in leagues:
+                for per_ninety in [False, True]:
+                    get_card_fragments(self.season, per_ninety, league)
+
+    def test_preload_card_cache_is_optional(self):
+        with patch("web.card_data.warm_card_cache") as warm:
+            with override_settings(PRELOAD_CARD_CACHE=False):
+                preload_card_cache()
+            self.assertEqual(warm.call_count, 0)
+            with override_settings(PRELOAD_CARD_CACHE=True):
+                preload_card_cache()
+                self.assertEqual(warm.call_count, 1)
+                # workers still start when the database is unavailable
+                warm.side_effect = DatabaseError("no such table")
+                preload_card_cache()
+
+#############################
+########## SEARCH ###########
+#############################
+
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.season = create_playerstats(num_teams=2, players_per_team=6)
+
+    def setUp(self):
+        clear_process_memos()
+        reset_data_version_memo()
+
+    def test_prefix_search_is_ranked_by_minutes(self):
+        # players 6 and 12 played the most minutes, ties are broken by name
+        self.assertEqual([entry["id"] for entry in search_names("fi", limit=2)], [12, 6])
+        self.assertEqual([entry["name"] for entry in search_names("first last 12")], ["first last 12"])
+        # every word has to match, words shorter than two letters are ignored
+        self.assertEqual([entry["name"] for entry in search_names("TE 1")], ["team 0", "team 1"])
+        self.assertEqual(search_names("team premier"), [])
+        self.assertEqual(search_names("x"), [])
+        self.assertEqual(search_names("prem"), [{ "type": "league", "id": 39, "name": "premier league", "logo": "" }])
+        self.assertEqual(search_tokens("Thomas  Müller"), ["thomas", "muller"])
+        # the index is built once per data version
+        with self.assertNumQueries(0):
+            search_names("last")
+
+    def test_search_endpoint(self):
+        response = self.client.get("/search", { "q": "team" }, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([entry["type"] for entry in response.json()["result"]], ["team", "team"])
+        self.assertIn("no-cache", response["Cache-Control"])
+        # the nav links the current data version, those URLs are cached until the next ingest
+        version = get_data_version()
+        response = self.client.get("/search", { "q": "team", "v": version }, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertIn("immutable", response["Cache-Control"])
+        DataVersion.objects.create(pk=1, version=version+1)
+        reset_data_version_memo()
+        response = self.client.get("/search", { "q": "team", "v": version }, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertIn("no-cache", response["Cache-Control"])
+        response = self.client.get("/search", { "q": "team", "limit": "0" }, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get("/search", { "q": "team" }).status_code, 302)
+
+class NameIndexTests(TransactionTestCase):
+    # SQLite cannot roll a virtual table back to a savepoint, so these tests commit
+
+    def setUp(self):
+        self.season = create_playerstats(num_teams=2, players_per_team=6)
+        clear_process_memos()
+        reset_data_version_memo()
+
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {NAME_INDEX_TABLE}")
+        name_index_state["synced"] = False
+        clear_process_memos()
+
+    def test_fts_index_matches_in_process_index(self):
+        self.assertEqual(build_name_index(), 12 + 2 + 1)
+        for query in ["fi", "first last 12", "TE 1", "team premier", "x", "prem", "last", "LAST 1"]:
+            for limit in [2, 10]:
+                self.assertEqual(search_name_index(query, limit), [
+                    { key: entry[key] for key in ["type", "id", "name", "logo"] }
+                    for entry in get_search_index().search(query, limit)
+                ])
+        # the views search the FTS index once it exists
+        clear_process_memos()
+        with patch("web.search.get_search_index") as get_search_index_mock:
+            self.assertEqual(search_names("prem")[0]["id"], 39)
+        get_search_index_mock.assert_not_called()
+
+    def test_short_prefixes_read_top_entries(self):
+        build_name_index()
+        # the top entries of every short prefix are read once per data version
+        get_data_version()
+        with self.assertNumQueries(1):
+            self.assertEqual([entry["id"] for entry in search_name_index("fi", limit=2)], [12, 6])
+        with self.assertNumQueries(0):
+            self.assertEqual([entry["name"] for entry in search_name_index("te")], ["team 0", "team 1"])
+        clear_process_memos()
+        with patch("web.search.SHORT_PREFIX_TOP_N", 1):
+            self.assertEqual([entry["id"] for entry in search_name_index("fi")], [12])
+            self.assertEqual([entry["id"] for entry in get_search_index().search("fi")], [12])
+            # longer prefixes are matched in the whole index
+            self.assertEqual(len(search_name_index("fir", limit=20)), 12)
+
+    def test_ingest_keeps_fts_index_in_sync(self):
+        command = DbUtilsCommand()
+        ensure_name_index()
+        country = { "name": "Spain", "code": "ES", "flag": None }
+        command.add_league({
+            "league": { "id": 140, "name": "La Liga", "type": "League", "logo": "" }, "country": country
+        })
+        command.add_team(
+            self.season, League.objects.get(league_id=140), { "team": { "id": 541, "name": "Real Madrid", "logo": "" } }
+        )
+        command.update_player({
+            "id": 1000, "firstname": "Raúl", "lastname": "González", "age": 44, "height": None, "weight": None,
+            "nationality": "Spain", "birth": { "date": None }
+        })
+        self.assertEqual([(entry["type"], entry["id"]) for entry in search_name_index("la liga")], [("league", 140)])
+        self.assertEqual([entry["id"] for entry in search_name_index("real")], [541])
+        # accents are folded in the index and in the query
+        self.assertEqual([entry["name"] for entry in search_name_index("raul gonz")], ["raúl gonzález"])
+        # minutes played rank the results once ingest has updated the stats
+        PlayerStat.objects.create(
+            team=Team.objects.get(team_id=541), player=Player.objects.get(player_id=1000),
+            **dict(STAT_DEFAULTS, minutes_played=5000)
+        )
+        update_name_index_minutes()
+        self.assertEqual(search_name_index("ra", limit=1)[0]["id"], 1000)
+
+#############################
+########### PAGES ###########
+#############################
+
+class PageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.season = create_playerstats(num_teams=1, players_per_team=5)
+        country = Country.objects.get(code="GB")
+        # navbar leagues
+        for league_id in initial_league_ids:
+            League.objects.get_or_create(
+                league_id=league_id,
+                defaults={ "name": f"league {league_id}", "league_type": "league", "logo": "", "country": country }
+            )
+
+    def setUp(self):
+        clear_cache()
+        clear_process_memos()
+        reset_data_version_memo()
+
+    def test_dashboard_revalidates_until_ingest(self):
+        url = f"/dashboard/{self.season.start_year}"
+        # without a CSRF cookie the page is rendered, which sets one
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        # matching etag skips the view entirely, only the session is loaded
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # per 90 toggle is part of the etag
+        session = self.client.session
+        session["per_ninety"] = True
+        session.save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        # a rotated CSRF cookie or a new release changes the etag
+        etag = self.client.get(url)["ETag"]
+        self.client.cookies[settings.CSRF_COOKIE_NAME] = "rotated"
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        etag = self.client.get(url)["ETag"]
+        with patch.dict(release_memo, release="next"):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        # ingest bumps the data version (what `bump_data_version` does once committed)
+        DataVersion.objects.create(pk=1, version=1)
+        reset_data_version_memo()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        # a date would answer 304s across per 90 toggles and CSRF rotations
+        self.assertNotIn("Last-Modified", response)
+        session = self.client.session
+        session["per_ninety"] = False
+        session.save()
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE="Fri, 01 Jan 2100 00:00:00 GMT")
+        self.assertEqual(response.status_code, 200)
+
+    def test_nav_context_is_cached_per_data_version(self):
+        # data version, nav leagues, season list
+        with self.assertNumQueries(3):
+            context = default_context(self.season.start_year)
+        self.assertEqual([league.league_id for league in context["first_row_leagues"]], [78, 61, 39, 140, 135])
+        with self.assertNumQueries(0):
+            self.assertEqual(default_context(self.season.start_year)["current_season"], self.season)
+        # a new data version reloads the nav context
+        DataVersion.objects.create(pk=1, version=1)
+        reset_data_version_memo()
+        with self.assertNumQueries(3):
+            default_context()
+
+    def test_team_page_is_constant_queries(self):
+        default_context(self.season.start_year)
+        # team seasons, squad, squad totals by position
+        with self.assertNumQueries(3):
+            team_page = get_team_page(1, self.season.start_year)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_team_page(1, self.season.start_year), team_page)
+        self.assertEqual(team_page["team"]["name"], "team 0")
+        self.assertEqual(team_page["seasons"], [{ "start_year": 2020, "end_year": 2021 }])
+        attackers = team_page["positions"][0]
+        self.assertEqual(attackers["name"], "attacker")
+        self.assertEqual([player["player__player_id"] for player in attackers["players"]], [1, 5])
+        self.assertEqual(attackers["totals"]["goals"], 4)
+        rows = { row[0]: row[1:] for row in team_page["summary"]["rows"] }
+        # players, minutes, goals
+        self.assertEqual(rows["total"][:3], [5, 4600, 10])
+        # per 90 minutes of the team, not of each player
+        self.assertEqual(rows["per 90"][2], round(10/(4600/(11*90)), 2))
+        response = self.client.get(f"/team/1/{self.season.start_year}")
+        self.assertContains(response, "/player/5/2020")
+        self.assertRedirects(self.client.get("/team/2/2020"), "/", fetch_redirect_response=False)
+
+    def test_player_profile_is_one_lookup(self):
+        Player.objects.filter(player_id=2).update(height="180 cm", weight="75 kg", height_cm=180.0, weight_kg=75.0)
+        # profiles missing before the first build are loaded from the stats
+        loaded = get_player_profile(2)
+        self.assertEqual(build_player_profiles(self.season), 5)
+        self.assertEqual(PlayerProfile.objects.count(), 5)
+        with self.assertNumQueries(1):
+            profile = get_player_profile(2)
+        self.assertEqual(profile, loaded)
+        self.assertEqual([season["start_year"] for season in profile["seasons"]], [2020])
+        team = profile["seasons"][0]["teams"][0]
+        bio = { title: value for title, value, _, _ in team["bio"] }
+        self.assertEqual((bio["Height"], bio["Weight"]), ("5'11''", "165 lbs"))
+        # goals=1 in 910 minutes, per 90 values are truncated to two decimals
+        self.assertIn(["Goals", 1], team["stats"][0][1])
+        self.assertIn(["Goals Per 90", "0.09"], team["stats_per_ninety"][0][1])
+        response = self.client.get(f"/player/2/{self.season.start_year}")
+        self.assertContains(response, "5&#x27;11&#x27;&#x27;")
+        self.assertRedirects(self.client.get("/player/999/2020"), "/", fetch_redirect_response=False)
+
+    def test_measurements_are_parsed(self):
+        self.assertEqual(Player.parse_measurement("180 cm"), 180.0)
+        self.assertEqual(Player.parse_measurement("72.5kg"), 72.5)
+        self.assertIsNone(Player.parse_measurement(None))
+        self.assertIsNone(Player.parse_measurement("unknown"))
+
+    def test_normalization_skips_unparseable_measurements(self):
+        Player.objects.filter(player_id=1).update(height="180 cm", weight="unknown")
+        Player.objects.filter(player_id=2).update(height="", weight=" 75 kg")
+        self.assertEqual(DbUtilsCommand().normalize_measurements(), 2)
+        measurements = {
+            player_id: (height_cm, weight_kg)
+            for player_id, height_cm, weight_kg in Player.objects.values_list("player_id", "height_cm", "weight_kg")
+        }
+        self.assertEqual((measurements[1], measurements[2]), ((180.0, None), (None, 75.0)))
+        # the values left unset do not parse, so they are not selected again
+        self.assertEqual(DbUtilsCommand().normalize_measurements(), 0)
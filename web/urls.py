@@ -9,8 +9,11 @@ urlpatterns = [
     path("player/<int:id>/<int:season>", views.players),
     path("builder", views.builder),
     path("make_query", views.make_query),
+    path("query_status", views.query_status),
+    path("cancel_query", views.cancel_query),
+    path("query_results", views.query_results),
+    path("export_query", views.export_query),
+    path("league_teams", views.league_teams),
     path("change_per_ninety", views.change_per_ninety),
-    path("get_players", views.get_players),
-    path("get_teams", views.get_teams),
-    path("get_leagues", views.get_leagues),
+    path("search", views.search),
 ]
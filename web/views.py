@@ -1,14 +1,27 @@
+from django.conf import settings
 from django.contrib import messages
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
+from django.template.defaultfilters import title
 from django.template.defaulttags import register
+from django.utils.cache import patch_cache_control
+from django.views.decorators.cache import cache_control
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition
+import hashlib
 import json
 
-from .builder import get_query_result, query_validator
-from .card_data import get_dashboard_data, get_player_data, get_from_cache, insert_to_cache
-from .queryset import get_max, modify_queryset
+from .builder import (
+    QUERY_PAGE_MAX_SIZE, QUERY_PAGE_SIZE, decode_cursor, export_cost_errors, get_query_page, peek_query_result,
+    query_cost_errors, query_validator, stream_query_csv, stream_query_ndjson
+)
+from .cache import get_data_version, get_process_memo, get_release
+from .card_data import get_card_fragments, get_player_profile, get_profile_cards, get_team_page
+from .guard import QueryBudgetError
+from .jobs import cancel_job, get_job, submit_query_job
 from .management.commands.helpers.config import top_five_league_ids, other_league_ids, international_league_ids
-from .models import Country, Season, League, Team, Player, PlayerStat 
+from .models import Country, Season, League, Team, PlayerStat 
+from .search import SEARCH_CACHE_MAX_AGE, SEARCH_RESULT_LIMIT, SEARCH_RESULT_MAX_LIMIT, search_names
 
 #################################
 ##### CUSTOM DJANGO FILTERS #####
@@ -38,11 +51,25 @@ def split(str, char):
 ########## HELPERS ##########
 #############################
 
+def load_nav_context():
+    # one query for every navbar league, one for the season list
+    nav_league_ids = top_five_league_ids + other_league_ids
+    leagues = { league.league_id: league for league in League.objects.filter(league_id__in=nav_league_ids) }
+    return {
+        "first_row_leagues": [ leagues[id] for id in top_five_league_ids ],
+        "second_row_leagues": [ leagues[id] for id in other_league_ids ],
+        "seasons": list(Season.objects.order_by("-start_year")),
+    }
+
+def get_nav_context():
+    return get_process_memo("nav-context", load_nav_context)
+
 def get_current_season(start_year = None):
-    default = Season.objects.all().order_by("-start_year")[0]
+    seasons = get_nav_context()["seasons"]
+    default = seasons[0]
     if start_year is None:
         return default
-    seasons = Season.objects.filter( start_year=start_year )
+    seasons = [season for season in seasons if season.start_year == start_year]
     if len(seasons) != 1:
         return default
     return seasons[0]
@@ -52,64 +79,62 @@ def get_per_ninety(request):
         request.session["per_ninety"] = False
     return request.session.get("per_ninety")
 
-def get_card_data(season, per_ninety, league = None):
-    # return stored result if present
-    card_cache_data = get_from_cache(season, per_ninety, league)
-    if card_cache_data is not None:
-        return card_cache_data
-
-    # generate dashboard cards 
-    # current league(s)
-    valid_leagues = [ 
-        league if league is not None
-        else League.objects.get(league_id=id) for id in top_five_league_ids 
-    ]
-    # initial queryset filter lambdas
-    lambdas = [
-        lambda q: q.filter(team__season=season),
-        lambda q: q.filter(team__league__in=valid_leagues),
-        lambda q: q.filter(minutes_played__gte=get_max(q, "minutes_played")/5)
-    ]
-    initial_queryset = modify_queryset(PlayerStat.objects.all(), lambdas)
-    card_data = get_dashboard_data(initial_queryset, per_ninety)
-    insert_to_cache(season, per_ninety, league, card_data)
-    return card_data
+def page_etag(request, *args, **kwargs):
+    # pages change when ingest bumps the data version, a deploy changes the release,
+    # the per 90 toggle flips, or the CSRF cookie their forms embed is rotated
+    csrf_cookie = request.COOKIES.get(settings.CSRF_COOKIE_NAME)
+    if csrf_cookie is None:
+        # no 304s without a CSRF cookie, the view runs and sets one
+        return None
+    csrf_hash = hashlib.sha1(csrf_cookie.encode()).hexdigest()[:8]
+    return f"{get_data_version()}-{get_release()}-{int(get_per_ninety(request))}-{csrf_hash}"
+
+def conditional_page(view):
+    # revalidate on every request, answering with a 304 until the etag changes. There is
+    # no Last-Modified: a date cannot reflect the per 90 toggle or the CSRF cookie
+    view = condition(etag_func=page_etag)(view)
+    return cache_control(no_cache=True)(view)
 
 def default_context(season = None):
-    # grab current season
-    current_season = get_current_season(season) 
+    # navbar leagues and season data, cached per process until the next ingest
+    nav_context = get_nav_context()
+    return {
+        "first_row_leagues": nav_context["first_row_leagues"],
+        "second_row_leagues": nav_context["second_row_leagues"],
+        "current_season": get_current_season(season),
+        "seasons": nav_context["seasons"],
+        # versions the nav search URLs, so browsers can keep results until the next ingest
+        "search_version": get_data_version(),
+    }
+
+def get_player_cards(profile, season, per_ninety):
+    teams = next((
+        profile_season["teams"] for profile_season in profile["seasons"]
+        if profile_season["start_year"] == season.start_year
+    ), [])
     return {
-        # navbar leagues
-        "first_row_leagues": [ League.objects.get(league_id=id) for id in top_five_league_ids ],
-        "second_row_leagues": [ League.objects.get(league_id=id) for id in other_league_ids ],
-        # season data
-        "current_season": current_season,
-        "seasons": Season.objects.order_by("-start_year"),
+        "cards": { team["id"]: get_profile_cards(team, per_ninety) for team in teams },
+        "teams": teams
     }
 
-def get_player_cards(playerstats, per_ninety):
-    card_dict = {}
-    for playerstat in playerstats:
-        card_dict[playerstat.team.id] = get_player_data(playerstat, per_ninety)
+def load_league_hierarchy():
+    # one joined query for every league with its teams per season, leagues without teams included
+    leagues, teams = {}, {}
+    rows = League.objects.values_list(
+        "league_id", "name", "country__name", "teams__season__id", "teams__id", "teams__name"
+    ).order_by("name", "country__name", "teams__name")
+    for league_id, league_name, country_name, season_id, team_id, team_name in rows:
+        leagues[league_id] = title(f"{league_name} ({country_name})")
+        if team_id is not None:
+            teams.setdefault((league_id, season_id), []).append({ "id": team_id, "name": title(team_name) })
     return {
-        "cards": card_dict,
-        "teams": sorted([ps.team for ps in playerstats], key=lambda team: team.id)
+        "leagues": [ { "id": league_id, "name": name } for league_id, name in leagues.items() ],
+        "teams": teams,
     }
 
-def get_all_leagues():
-    leagues_dict = {}
-    # create a dict with keys league, season, team
-    for league in League.objects.all():
-        league_str = f"{league.name} ({league.country.name})@{league.league_id}"
-        leagues_dict[league_str] = {}
-        for team in league.teams.all():
-            if team.season.start_year not in leagues_dict[league_str]:
-                leagues_dict[league_str][team.season.start_year] = []
-            leagues_dict[league_str][team.season.start_year].append(team)
-        # sort league.season values by team name
-        for season in leagues_dict[league_str]:
-            leagues_dict[league_str][season] = sorted( leagues_dict[league_str][season], key=lambda t: t.name )
-    return leagues_dict
+def get_league_hierarchy():
+    # league -> season -> team options of the builder form, cached per process until the next ingest
+    return get_process_memo("league-hierarchy", load_league_hierarchy)
     
 #############################
 ########## ROUTES ###########
@@ -118,16 +143,18 @@ def get_all_leagues():
 def home(request):
     return redirect(f"/dashboard/{get_current_season().start_year}")
 
+@conditional_page
 def dashboard(request, season):
     # create context dict
     context = default_context(season)
     # set/get per ninety
     context["per_ninety"] = get_per_ninety(request)
-    # grab page card_data
-    context["card_data"] = get_card_data(context["current_season"], context["per_ninety"])
+    # grab page card_data, rendered
+    context["card_fragments"] = get_card_fragments(context["current_season"], context["per_ninety"])
     # render page
     return render(request, "dashboard.html", context)
 
+@conditional_page
 def leagues(request, id, season):
     # create context dict
     context = default_context(season)
@@ -138,46 +165,46 @@ def leagues(request, id, season):
     context["current_league"] = leagues[0]
     # set/get per ninety
     context["per_ninety"] = get_per_ninety(request)
-    # grab page card_data
-    context["card_data"] = get_card_data(context["current_season"], context["per_ninety"], context["current_league"])
+    # grab page card_data, rendered
+    context["card_fragments"] = get_card_fragments(
+        context["current_season"], 
+        context["per_ninety"], 
+        context["current_league"]
+    )
     # render page
     return render(request, "dashboard.html", context)
 
+@conditional_page
 def teams(request, id, season):
     # create context dict
     context = default_context(season)
-    teams = Team.objects.filter( team_id=id, season=Season.objects.get(start_year=season) )
-    # get current team
-    context["current_team"] = teams[0]
-    for team in teams:
-        if team.league.league_id not in international_league_ids:
-            context["current_team"] = team
-    # get team seasons
-    context["seasons"] = list(set([t.season for t in Team.objects.filter( team_id=id )]))
-    # get current team's players
-    context["current_playerstats"] = context["current_team"].stats.all()
-    # get player positions 
-    context["positions"] = [pos for pos in PlayerStat.POSITIONS if pos[0] != PlayerStat.DEFAULT_POSITION]
+    # get team, squad, and season data, cached per team and season until the next ingest
+    team_page = get_team_page(id, season)
+    if team_page is None:
+        return redirect("/")
+    context["current_team"] = team_page["team"]
+    context["seasons"] = team_page["seasons"]
+    context["positions"] = team_page["positions"]
+    context["summary"] = team_page["summary"]
     # render page
     return render(request, "team.html", context)
 
+@conditional_page
 def players(request, id, season):
     # create context dict
     context = default_context(season)
     # set/get per ninety
     context["per_ninety"] = get_per_ninety(request)
-    # get current players
-    players = Player.objects.filter(player_id=id)
-    if len(players) != 1:
+    # get current player profile, bio and stat cards of every season in one lookup
+    profile = get_player_profile(id)
+    if profile is None:
         return redirect("/")
-    current_player = players[0]
-    context["current_player"] = current_player 
-    context["current_playerstats"] = current_player.stats.filter(
-        team__season = context["current_season"]
-    )
+    context["current_player"] = profile
     # get player seasons
-    context["seasons"] = list(set([ps.team.season for ps in current_player.stats.all()]))
-    context["player_cards"] = get_player_cards(context["current_playerstats"], context["per_ninety"])
+    context["seasons"] = [
+        { "start_year": season["start_year"], "end_year": season["end_year"] } for season in profile["seasons"]
+    ]
+    context["player_cards"] = get_player_cards(profile, context["current_season"], context["per_ninety"])
     # render page
     return render(request, "player.html", context)
 
@@ -190,45 +217,45 @@ def builder(request):
     context["positions"] = [pos for pos in PlayerStat.POSITIONS if pos[0] != PlayerStat.DEFAULT_POSITION]
     # get player stats 
     context["stats"] = PlayerStat.STATS
-    # get leagues/teams for each season
-    context["leagues"] = get_all_leagues()
-    # query result
+    # get leagues, their teams are loaded per league and season by the form
+    context["leagues"] = get_league_hierarchy()["leagues"]
+    # query result, or the job computing it for the page to poll
     if "query_data" in request.session:
-        context["builder_card"] = get_query_result(request.session["query_data"])
+        context["builder_card"] = peek_query_result(request.session["query_data"])
+        if context["builder_card"] is None:
+            context["builder_job"] = submit_query_job(request.session["query_data"])
     return render(request, "builder.html", context)
 
 #############################
 ####### AJAX REQUESTS #######
 #############################
 
-def get_players(request):
-    # return player first_name/last_name and id 
+@gzip_page
+def search(request):
+    # top matching players, teams and leagues for the nav search
     if request.method != "GET" or not request.is_ajax():
         return redirect("/")
-    return JsonResponse({"result": [{
-        "name": player.first_name + " " + player.last_name,
-        "id": player.player_id
-    } for player in Player.objects.all() ]}, status=200) 
+    limit = request.GET.get("limit", str(SEARCH_RESULT_LIMIT))
+    if not limit.isdecimal() or not 0 < int(limit) <= SEARCH_RESULT_MAX_LIMIT:
+        return JsonResponse({"searchErrors": [f"Limit must be between 1 and {SEARCH_RESULT_MAX_LIMIT}"]}, status=400)
+    response = JsonResponse({"result": search_names(request.GET.get("q", ""), int(limit))}, status=200)
+    # results only change when ingest bumps the data version, so a URL carrying the
+    # current version never changes and can be cached until the page links a new one
+    if request.GET.get("v") == str(get_data_version()):
+        patch_cache_control(response, public=True, max_age=SEARCH_CACHE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
 
-def get_teams(request):
-    # return team name, id, and logo
-    if request.method != "GET" or not request.is_ajax():
-        return redirect("/")
-    return JsonResponse({"result": [{
-        "name": team.name,
-        "id": team.team_id,
-        "logo": team.logo,
-    } for team in Team.objects.all() ]}, status=200) 
-
-def get_leagues(request):
-    # return league name, id, and logo
+def league_teams(request):
+    # teams of one league in one season for the builder form's club select
     if request.method != "GET" or not request.is_ajax():
-        return redirect("/")
-    return JsonResponse({"result": [{
-        "name": league.name,
-        "id": league.league_id,
-        "logo": league.logo,
-    } for league in League.objects.all() ]}, status=200) 
+        return redirect("/builder")
+    league_id, season_id = request.GET.get("league", ""), request.GET.get("season", "")
+    if not league_id.isdecimal() or not season_id.isdecimal():
+        return JsonResponse({"teamErrors": ["Select a valid league and season"]}, status=400)
+    teams = get_league_hierarchy()["teams"].get((int(league_id), int(season_id)), [])
+    return JsonResponse({"result": teams}, status=200)
 
 def change_per_ninety(request):
     if request.method != "POST" or not request.is_ajax():
@@ -240,10 +267,90 @@ def change_per_ninety(request):
 def make_query(request):
     if request.method != "POST" or not request.is_ajax():
         return redirect("/builder")
-    post_data = json.loads(list(request.POST.keys())[0])
+    try:
+        post_data = json.loads(list(request.POST.keys())[0])
+    except (IndexError, ValueError):
+        return JsonResponse({"queryErrors": ["Query is malformed"]}, status=400)
     # validate query
     errors = query_validator(post_data)
     if len(errors) > 0:
         return JsonResponse(errors, status=400) 
+    errors = query_cost_errors(post_data)
+    if len(errors) > 0:
+        return JsonResponse(errors, status=400)
     request.session["query_data"] = post_data
-    return JsonResponse({"result": "query was success"}, status=200)
+    job_id = submit_query_job(post_data)
+    return JsonResponse({"result": "query was success", "job": job_id}, status=200)
+
+def query_status(request):
+    if request.method != "GET" or not request.is_ajax():
+        return redirect("/builder")
+    status = get_job(request.GET.get("job", ""))
+    if status is None:
+        return JsonResponse({"jobErrors": ["Query job does not exist"]}, status=404)
+    return JsonResponse(status, status=200)
+
+def cancel_query(request):
+    if request.method != "POST" or not request.is_ajax():
+        return redirect("/builder")
+    status = cancel_job(request.POST.get("job", ""))
+    if status is None:
+        return JsonResponse({"jobErrors": ["Query job does not exist"]}, status=404)
+    return JsonResponse(status, status=200)
+
+
+def get_request_query(request):
+    # builder query from the `query` parameter, or else the session's last query
+    if "query" in request.GET:
+        try:
+            post_data = json.loads(request.GET["query"])
+        except ValueError:
+            return None, JsonResponse({"queryErrors": ["Query is malformed"]}, status=400)
+        errors = query_validator(post_data)
+        if len(errors) > 0:
+            return None, JsonResponse(errors, status=400)
+        return post_data, None
+    if "query_data" in request.session:
+        return request.session["query_data"], None
+    return None, JsonResponse({"queryErrors": ["No query was made"]}, status=400)
+
+def query_results(request):
+    # JSON builder results, paged with an opaque `cursor` from the previous page's `next`
+    if request.method != "GET":
+        return redirect("/builder")
+    post_data, error_response = get_request_query(request)
+    if error_response is not None:
+        return error_response
+    limit = request.GET.get("limit", str(QUERY_PAGE_SIZE))
+    if not limit.isdecimal() or not 0 < int(limit) <= QUERY_PAGE_MAX_SIZE:
+        return JsonResponse({"limitErrors": [f"Limit must be between 1 and {QUERY_PAGE_MAX_SIZE}"]}, status=400)
+    try:
+        after = decode_cursor(request.GET["cursor"]) if request.GET.get("cursor") else None
+    except ValueError:
+        return JsonResponse({"cursorErrors": ["Cursor is invalid"]}, status=400)
+    try:
+        page = get_query_page(post_data, after, int(limit))
+    except QueryBudgetError as e:
+        return JsonResponse({"queryErrors": [str(e)]}, status=400)
+    return JsonResponse(page, status=200)
+
+def export_query(request):
+    # every builder result row streamed as csv (default) or ndjson, `raw=1` skips display formatting
+    if request.method != "GET":
+        return redirect("/builder")
+    post_data, error_response = get_request_query(request)
+    if error_response is not None:
+        return error_response
+    export_format = request.GET.get("format", "csv")
+    if export_format not in ["csv", "ndjson"]:
+        return JsonResponse({"formatErrors": ["Format must be 'csv' or 'ndjson'"]}, status=400)
+    errors = export_cost_errors(post_data)
+    if len(errors) > 0:
+        return JsonResponse(errors, status=400)
+    raw = request.GET.get("raw") == "1"
+    if export_format == "csv":
+        response = StreamingHttpResponse(stream_query_csv(post_data, raw), content_type="text/csv")
+    else:
+        response = StreamingHttpResponse(stream_query_ndjson(post_data, raw), content_type="application/x-ndjson")
+    response["Content-Disposition"] = f'attachment; filename="query.{export_format}"'
+    return response
\ No newline at end of file